@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+##########################################################################################
+# Checks our alerts cache when it fills up with more volumes than CACHE_MAX_SIZE: it must
+# evict the least recently used alert intervals, never a resize debounce (which could resize
+# a volume twice), and warn that it's full once rather than on every eviction.  Then times
+# setting keys in a full cache, mostly of debounces.  Exits non-zero if any check fails.
+#   Usage: python3 benchmarks/cache.py [number-of-volumes]
+##########################################################################################
+import io
+import os
+import sys
+import time
+import contextlib
+
+# We don't talk to a real cluster or Prometheus here, so skip loading credentials on import
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('PROMETHEUS_URL', 'http://localhost:9090')
+import kubernetes
+kubernetes.config.load_incluster_config = lambda *args, **kwargs: None
+import helpers
+
+
+# An alerts cache like our clusters have, holding at most max_size keys
+def build_alerts_cache(max_size):
+    cache = helpers.Cluster(name='cache-check').cache
+    cache.max_size = max_size
+    cache.reset()
+    return cache
+
+
+# Resize every volume (setting its debounce), then keep counting alert intervals for far more volumes than fit
+def check(count):
+    failures = []
+    max_size = count // 2
+    cache = build_alerts_cache(max_size)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        for number in range(count // 4):
+            cache.set('ns.resized-{}-has-been-resized'.format(number), True)
+        for number in range(count):
+            cache.set('ns.volume-{}'.format(number), 1)
+            cache.set('ns.volume-{}-alert-counted-at'.format(number), 1700000000)
+
+    debounces = [key for key in cache.cache if key.endswith('-has-been-resized')]
+    if len(debounces) != count // 4:
+        failures.append("kept {} of {} resize debounces".format(len(debounces), count // 4))
+    if len(cache.cache) != max_size:
+        failures.append("holds {} keys, expected its maximum of {}".format(len(cache.cache), max_size))
+    if cache.get('ns.volume-{}'.format(count - 1)) != 1 or cache.get('ns.volume-0') is not None:
+        failures.append("didn't evict the least recently used alert intervals first")
+    warnings = [line for line in output.getvalue().splitlines() if line.startswith('WARNING')]
+    if len(warnings) != 1:
+        failures.append("warned {} times that it's full, expected once: {}".format(len(warnings), warnings[:2]))
+
+    # Only debounces, more than fit, are all kept until they expire
+    cache = build_alerts_cache(10)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for number in range(20):
+            cache.set('ns.volume-{}-has-been-resized'.format(number), True)
+    if len(cache.cache) != 20:
+        failures.append("kept {} of 20 resize debounces in a cache of 10 keys".format(len(cache.cache)))
+    return failures
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    failures = check(count)
+    if failures:
+        print("ERROR: {} checks failed:".format(len(failures)))
+        for failure in failures:
+            print("  " + failure)
+        exit(1)
+    print("Filled an alerts cache of {} keys with {} volumes, evicting only alert intervals and warning once".format(count // 2, count))
+
+    # A full cache where most keys are debounces, which every eviction has to pass over
+    cache = build_alerts_cache(count // 2)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for number in range(count // 2 - 100):
+            cache.set('ns.resized-{}-has-been-resized'.format(number), True)
+        start = time.perf_counter()
+        for number in range(count):
+            cache.set('ns.volume-{}'.format(number), 1)
+        elapsed = time.perf_counter() - start
+    print("Set {} keys in a full cache of {} debounces: {:8.1f} ms".format(count, count // 2 - 100, elapsed * 1000))
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+##########################################################################################
+# Checks our vectorized decision engine (decisions.plan) against deciding one PVC at a time
+# (decisions.decide_one), on random PVCs covering every decision, then times both.  Also
+# checks how both size a handful of volumes against what they should be resized to.
+# This doesn't import helpers, so it needs no cluster, Prometheus or credentials.  Exits
+# non-zero if any decision differs.
+#   Usage: python3 benchmarks/decisions.py [number-of-pvcs]
+##########################################################################################
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import decisions
+
+NOW = 1700000000
+GIGABYTE = 1000000000
+
+
+# A random PVC's columns, with settings and usage picked so we see every decision
+def random_row():
+    size = random.choice([1, 10, 100, 1000, 16000]) * GIGABYTE
+    growth = random.choice([0, 0, random.uniform(1, 100000000)])
+    return {
+        'volume_size_status_bytes': size,
+        'scale_above_percent': random.choice([50, 80, 90]),
+        'scale_after_intervals': random.choice([1, 5]),
+        'scale_up_percent': random.choice([10, 20, 100]),
+        'scale_up_min_increment': GIGABYTE,
+        'scale_up_max_increment': random.choice([16000 * GIGABYTE, 50 * GIGABYTE]),
+        'scale_up_max_size': random.choice([16000 * GIGABYTE, 16000 * GIGABYTE, 500 * GIGABYTE, size]),
+        'scale_cooldown_time': 22200,
+        'forecast_horizon': 3600,
+        'scale_up_growth_windows': random.choice([0, 0, 2]),
+        'last_resized_at': random.choice([0, 0, NOW - 100000, NOW - 1000]),
+        'ignore': random.random() < 0.1,
+        'volume_used_percent': random.randint(0, 100),
+        'volume_used_inode_percent': random.choice([-1, random.randint(0, 100)]),
+        'volume_growth_bytes_per_second': growth,
+        'volume_available_bytes': random.choice([-1, random.uniform(0, size)]) if growth else -1,
+        'alert_intervals': random.choice([0, 0, random.randint(1, 6)]),
+        'count_interval': random.random() < 0.9,
+        'recently_resized': random.random() < 0.1,
+    }
+
+
+# Volumes sized by their scale up percent, minimum and maximum increments, maximum size and growth, with what they should be
+# resized to (and their growth_size), regardless of the random PVCs above
+TERABYTE = 1000 * GIGABYTE
+SIZING_CASES = [
+    ({'volume_size_status_bytes': 10 * GIGABYTE}, 12 * GIGABYTE, 0),
+    ({'volume_size_status_bytes': 1 * GIGABYTE}, 2 * GIGABYTE, 0),                                        # At least the minimum increment
+    ({'volume_size_status_bytes': 10 * TERABYTE, 'scale_up_max_increment': TERABYTE}, 11 * TERABYTE, 0),  # At most the maximum increment
+    ({'volume_size_status_bytes': 15900 * GIGABYTE}, 16 * TERABYTE, 0),                                   # At most the maximum size
+    ({'volume_size_status_bytes': 16 * TERABYTE}, 16 * TERABYTE, 0),                                      # Already at the maximum size
+    ({'volume_size_status_bytes': 100 * GIGABYTE, 'scale_up_growth_windows': 2, 'volume_growth_bytes_per_second': 2000000}, 223500000000, 223500000000),
+    ({'volume_size_status_bytes': 100 * GIGABYTE, 'scale_up_growth_windows': 2, 'volume_growth_bytes_per_second': 100000}, 120 * GIGABYTE, 118050000000),
+    ({'volume_size_status_bytes': 100 * GIGABYTE, 'scale_up_growth_windows': 2, 'volume_growth_bytes_per_second': 2000000, 'volume_available_bytes': 80 * GIGABYTE}, 136 * GIGABYTE, 136 * GIGABYTE),
+    ({'volume_size_status_bytes': 100 * GIGABYTE, 'volume_growth_bytes_per_second': 2000000}, 120 * GIGABYTE, 0),  # Not sized by growth
+    # Settings as large as we allow (eg: annotations meant as unlimited, clamped to MAX_VALUE) mustn't overflow
+    ({'scale_up_max_increment': decisions.MAX_VALUE, 'scale_up_max_size': decisions.MAX_VALUE}, 12 * GIGABYTE, 0),
+    ({'scale_up_percent': decisions.MAX_VALUE}, 16 * TERABYTE, 0),
+    ({'scale_up_percent': -decisions.MAX_VALUE}, 11 * GIGABYTE, 0),
+    ({'volume_size_status_bytes': 100 * GIGABYTE, 'scale_up_growth_windows': decisions.MAX_VALUE, 'volume_growth_bytes_per_second': 2000000}, 16 * TERABYTE, 2 * decisions.MAX_VALUE),
+]
+SIZING_DEFAULTS = dict(volume_size_status_bytes=10 * GIGABYTE, scale_above_percent=80, scale_up_percent=20, scale_up_min_increment=GIGABYTE, scale_up_max_increment=16 * TERABYTE,
+                       scale_up_max_size=16 * TERABYTE, scale_cooldown_time=22200, scale_up_growth_windows=0, last_resized_at=0, ignore=False,
+                       volume_used_percent=90, volume_used_inode_percent=-1, volume_growth_bytes_per_second=0, volume_available_bytes=-1,
+                       alert_intervals=0, count_interval=True, recently_resized=False, scale_after_intervals=1, forecast_horizon=3600)
+
+
+# Check the sizing of our SIZING_CASES, both vectorized and one PVC at a time
+def check_sizing():
+    failures = []
+    rows = [dict(SIZING_DEFAULTS, **overrides) for overrides, _, _ in SIZING_CASES]
+    arrays = decisions.to_arrays({column: [row[column] for row in rows] for column in decisions.COLUMN_TYPES})
+    growth_sizes = decisions.bytes_to_last_cooldowns(arrays).tolist()
+    resizes_to_bytes = decisions.bytes_to_scale_to(arrays, decisions.bytes_to_last_cooldowns(arrays)).tolist()
+    for index, (overrides, resize_to, growth_size) in enumerate(SIZING_CASES):
+        one_resize_to = decisions.decide_one(rows[index], NOW)[2]
+        if (resizes_to_bytes[index], one_resize_to, growth_sizes[index]) != (resize_to, resize_to, growth_size):
+            failures.append("{} sized to {} (one at a time {}) for growth {}, expected {} for growth {}".format(overrides, resizes_to_bytes[index], one_resize_to, growth_sizes[index], resize_to, growth_size))
+    return failures
+
+
+def time_it(function, rounds=3):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None or elapsed < best else best
+    return best, result
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    random.seed(42)
+    rows = [random_row() for _ in range(count)]
+    columns = {column: [row[column] for row in rows] for column in decisions.COLUMN_TYPES}
+    arrays = decisions.to_arrays(columns)
+
+    failures = check_sizing()
+    decided = [0] * len(decisions.ACTION_NAMES)
+    for forecast_enabled in [False, True]:
+        per_pvc_time, expected = time_it(lambda: [decisions.decide_one(row, NOW, forecast_enabled) for row in rows])
+        vectorized_time, plan = time_it(lambda: decisions.plan(arrays, NOW, forecast_enabled))
+        converting_time, _ = time_it(lambda: decisions.to_arrays(columns))
+        actions = plan['action'].tolist()
+        alert_intervals = plan['alert_intervals'].tolist()
+        resizes_to_bytes = plan['resize_to_bytes'].tolist()
+        for index, (action, intervals, resize_to) in enumerate(expected):
+            decided[action] += 1
+            if actions[index] != action or alert_intervals[index] != intervals or (resize_to is not None and resizes_to_bytes[index] != resize_to):
+                failures.append("{} decided {} {} {}, expected {} {} {}".format(rows[index], decisions.ACTION_NAMES[actions[index]], alert_intervals[index], resizes_to_bytes[index],
+                                                                              decisions.ACTION_NAMES[action], intervals, resize_to))
+        print("Decided {} PVCs with forecasting {}".format(count, "enabled" if forecast_enabled else "disabled"))
+        print("       one PVC at a time: {:8.1f} ms".format(per_pvc_time * 1000))
+        print("              vectorized: {:8.1f} ms ({:.1f}x faster), plus {:.1f} ms converting columns from lists".format(vectorized_time * 1000, per_pvc_time / vectorized_time, converting_time * 1000))
+
+    print("Decisions: {}".format(", ".join("{} {}".format(name, decided[action]) for action, name in enumerate(decisions.ACTION_NAMES))))
+    if failures:
+        print("ERROR: {} decisions differ from deciding one PVC at a time or from how they should be sized, eg:".format(len(failures)))
+        for failure in failures[:5]:
+            print("  " + failure)
+        exit(1)
+    print("Both produced identical decisions")
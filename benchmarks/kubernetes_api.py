@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+##########################################################################################
+# Checks how we handle the Kubernetes API where it behaves differently from the simulator's
+# fleet, against a small fake API server with just those behaviours.  Exits non-zero if any
+# check fails.
+#   relist - a continue token expiring mid-list, after a PVC was created in a page we
+#            already listed, must not leave that PVC out of our informer's index
+#   events - repeats of an event with a different message must still bump its series, as
+#            Kubernetes rejects changing the note (or reason, action, regarding) of an event
+#   state  - two sharding replicas sharing one state ConfigMap (or SQLite file) must each keep
+#            the other's alert intervals and resize debounces, even when the other writes it
+#            between our read and write
+#   Usage: python3 benchmarks/kubernetes_api.py
+##########################################################################################
+import os
+import sys
+import json
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Configure the autoscaler before importing it, it reads its settings on import.  We talk to our fake API server through a
+# client of our own, so skip loading credentials on import
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('PROMETHEUS_URL', 'http://localhost:9090')
+os.environ['PVC_LIST_PAGE_SIZE'] = '2'
+import kubernetes
+kubernetes.config.load_incluster_config = lambda *args, **kwargs: None
+import helpers
+import sharding
+import state_store
+
+# Kubernetes rejects updates to these fields of an events.k8s.io/v1 Event
+IMMUTABLE_EVENT_FIELDS = ('note', 'reason', 'action', 'regarding')
+
+
+# What our fake API server has, and what it has been asked for
+class FakeAPI:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.resource_version = 10
+        self.pvcs = {}
+        self.events = {}
+        # Our ConfigMaps and Leases, by their path
+        self.objects = {}
+        self.requests = []
+        # Called with the continue token of each list request, to change things between pages.  Returning a dict fails that
+        # request with it as a 410, like an expired continue token
+        self.on_list = None
+        # Called with the path of each ConfigMap before we write it, to change it in between
+        self.on_write = None
+
+    def add_pvc(self, namespace, name):
+        self.resource_version += 1
+        self.pvcs[(namespace, name)] = {
+            'metadata': {'name': name, 'namespace': namespace, 'uid': 'uid-{}-{}'.format(namespace, name), 'resourceVersion': str(self.resource_version), 'annotations': {}},
+            'spec': {'resources': {'requests': {'storage': '10Gi'}}, 'storageClassName': 'gp3'},
+            'status': {'capacity': {'storage': '10Gi'}},
+        }
+
+    # Store a ConfigMap or Lease at a new resourceVersion
+    def put_object(self, path, body):
+        self.resource_version += 1
+        body['metadata']['resourceVersion'] = str(self.resource_version)
+        self.objects[path] = body
+        return body
+
+    # Pages through our PVCs in key order, the continue token is where the next page starts
+    def list_page(self, limit, continue_token):
+        keys = sorted(self.pvcs)
+        start = int(continue_token.split(':')[-1]) if continue_token else 0
+        metadata = {'resourceVersion': str(self.resource_version)}
+        if start + limit < len(keys):
+            metadata['continue'] = str(start + limit)
+        return {'kind': 'PersistentVolumeClaimList', 'apiVersion': 'v1', 'metadata': metadata, 'items': [self.pvcs[key] for key in keys[start:start + limit]]}
+
+
+def create_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            with api.lock:
+                api.requests.append(('GET', url.path, query))
+                if url.path == '/api/v1/persistentvolumeclaims':
+                    continue_token = query.get('continue', [''])[0]
+                    expired = api.on_list(continue_token) if api.on_list else None
+                    if expired:
+                        return self.send_json(410, expired)
+                    return self.send_json(200, api.list_page(int(query.get('limit', ['0'])[0]), continue_token))
+                if url.path in api.objects:
+                    return self.send_json(200, api.objects[url.path])
+                if url.path.endswith('/leases'):
+                    label, _, value = query.get('labelSelector', ['='])[0].partition('=')
+                    items = [lease for path, lease in api.objects.items() if path.startswith(url.path + '/') and lease['metadata'].get('labels', {}).get(label) == value]
+                    return self.send_json(200, {'kind': 'LeaseList', 'apiVersion': 'coordination.k8s.io/v1', 'metadata': {'resourceVersion': str(api.resource_version)}, 'items': items})
+            self.send_json(404, {'kind': 'Status', 'code': 404})
+
+        def read_json(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            return json.loads(self.rfile.read(length) or b'{}')
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            body = self.read_json()
+            with api.lock:
+                api.requests.append(('POST', url.path, body))
+                if url.path.endswith('/events'):
+                    key = url.path + '/' + body['metadata']['name']
+                    if key in api.events:
+                        return self.send_json(409, {'kind': 'Status', 'code': 409, 'reason': 'AlreadyExists'})
+                    api.events[key] = body
+                    return self.send_json(201, body)
+                if url.path.endswith('/configmaps') or url.path.endswith('/leases'):
+                    path = url.path + '/' + body['metadata']['name']
+                    if api.on_write and url.path.endswith('/configmaps'):
+                        api.on_write(path)
+                    if path in api.objects:
+                        return self.send_json(409, {'kind': 'Status', 'code': 409, 'reason': 'AlreadyExists'})
+                    return self.send_json(201, api.put_object(path, body))
+            self.send_json(404, {'kind': 'Status', 'code': 404})
+
+        # Replaces a ConfigMap or Lease, if it wasn't changed since the resourceVersion in the body (when there is one)
+        def do_PUT(self):
+            url = urlparse(self.path)
+            body = self.read_json()
+            with api.lock:
+                api.requests.append(('PUT', url.path, body))
+                if api.on_write and '/configmaps/' in url.path:
+                    api.on_write(url.path)
+                stored = api.objects.get(url.path)
+                if stored is None:
+                    return self.send_json(404, {'kind': 'Status', 'code': 404})
+                if body['metadata'].get('resourceVersion') not in (None, stored['metadata']['resourceVersion']):
+                    return self.send_json(409, {'kind': 'Status', 'code': 409, 'reason': 'Conflict'})
+                return self.send_json(200, api.put_object(url.path, body))
+
+        def do_DELETE(self):
+            url = urlparse(self.path)
+            with api.lock:
+                api.requests.append(('DELETE', url.path, None))
+                if api.objects.pop(url.path, None) is None:
+                    return self.send_json(404, {'kind': 'Status', 'code': 404})
+                return self.send_json(200, {'kind': 'Status', 'apiVersion': 'v1', 'status': 'Success'})
+
+        def do_PATCH(self):
+            url = urlparse(self.path)
+            body = self.read_json()
+            with api.lock:
+                api.requests.append(('PATCH', url.path, body))
+                event = api.events.get(url.path)
+                if event is None:
+                    return self.send_json(404, {'kind': 'Status', 'code': 404})
+                if any(field in body and body[field] != event.get(field) for field in IMMUTABLE_EVENT_FIELDS):
+                    return self.send_json(422, {'kind': 'Status', 'status': 'Failure', 'code': 422, 'reason': 'Invalid', 'message': 'field is immutable'})
+                event.update(body)
+                return self.send_json(200, event)
+
+    return Handler
+
+
+# Serve a fake API, and work on a cluster whose Kubernetes API is it
+def start_fake_api():
+    api = FakeAPI()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), create_handler(api))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    kubeconfig = tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False)
+    kubeconfig.write(json.dumps({
+        'apiVersion': 'v1', 'kind': 'Config', 'current-context': 'fake',
+        'clusters': [{'name': 'fake', 'cluster': {'server': 'http://127.0.0.1:{}'.format(server.server_address[1])}}],
+        'contexts': [{'name': 'fake', 'context': {'cluster': 'fake', 'user': 'fake'}}],
+        'users': [{'name': 'fake', 'user': {'token': 'fake'}}],
+    }))
+    kubeconfig.close()
+    api_client = kubernetes.config.new_client_from_config(config_file=kubeconfig.name)
+    os.unlink(kubeconfig.name)
+    helpers.current_cluster.set(helpers.Cluster(api_client=api_client))
+    return api, server
+
+
+def check_relist():
+    api, server = start_fake_api()
+    for name in ['b', 'c', 'd', 'e']:
+        api.add_pvc('ns', name)
+    expired_once = []
+
+    # Once our first page was listed create ns.a, which sorts before it, then expire the continue token for our second page,
+    # offering one which continues at a newer resourceVersion like Kubernetes does
+    def on_list(continue_token):
+        if continue_token and not expired_once:
+            expired_once.append(continue_token)
+            api.add_pvc('ns', 'a')
+            return {'kind': 'Status', 'apiVersion': 'v1', 'metadata': {'continue': 'inconsistent:3'}, 'status': 'Failure', 'reason': 'Expired', 'code': 410}
+        return None
+    api.on_list = on_list
+
+    informer = helpers.PVCInformer()
+    informer.relist()
+    server.shutdown()
+    listed = sorted(informer.get_pvcs())
+    expected = ['ns.{}'.format(name) for name in 'abcde']
+    if listed != expected or informer.resource_version != str(api.resource_version):
+        return "listed {} at resourceVersion {}, expected {} at {}".format(listed, informer.resource_version, expected, api.resource_version)
+    return None
+
+
+def check_events():
+    api, server = start_fake_api()
+    pvc = helpers.build_simpler_pvc_dict('data', 'ns', 'uid-ns-data', '1', 'gp3', '10Gi', '10Gi', {})
+    for seconds in [300, 600, 900]:
+        helpers.send_kubernetes_event('ns', 'data', 'VolumeResizeRequestFailed', "FAILED requesting to scale up over the last {} seconds".format(seconds), type="Warning", pvc=pvc)
+    server.shutdown()
+    events = list(api.events.values())
+    counts = [(event.get('series') or {}).get('count', 1) for event in events]
+    rejected = [request for request in api.requests if request[0] == 'PATCH' and 'note' in request[2]]
+    if counts != [3] or rejected:
+        return "sent events with series counts {} and {} patches changing their note, expected one event with a count of 3".format(counts, len(rejected))
+    return None
+
+
+def check_state():
+    api, server = start_fake_api()
+    api_client = helpers.get_cluster().api_client
+    shards = [sharding.ShardMembership(identity=identity, namespace='ns', lease_duration=2, renew_interval=0.2, api_client=api_client) for identity in ['replica-a', 'replica-b']]
+    for shard in shards:
+        shard.start()
+
+    # Wait until both replicas have seen each other for their lease_duration, then each PVC belongs to one of them
+    pvcs = ['pvc-{}'.format(number) for number in range(20)]
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline and not all(sum(shard.owns('ns', pvc) for shard in shards) == 1 for pvc in pvcs):
+        time.sleep(0.1)
+    owned = [sum(shard.owns('ns', pvc) for pvc in pvcs) for shard in shards]
+    if sum(owned) != len(pvcs) or not all(owned):
+        for shard in shards:
+            shard.stop()
+        server.shutdown()
+        return "our replicas own {} of {} PVCs, expected each to own some and each PVC to be owned once".format(owned, len(pvcs))
+
+    # Each replica has keys about every PVC (eg: loaded from our store when it started), valued by the replica, and should
+    # only save those of its own.  Every key should end up stored with the value of the replica it belongs to
+    expiration = time.time() + 3600
+    states = [{key: [shard.identity, expiration] for pvc in pvcs for key in ['ns.' + pvc, 'ns.{}-has-been-resized'.format(pvc)]} for shard in shards]
+    expected = {key: [next(shard.identity for shard in shards if shard.owns_cache_key(key)), expiration] for key in states[0]}
+
+    # The first time our ConfigMap is written, have the other replica write its keys to it first
+    def on_write(path):
+        api.on_write = None
+        body = {'metadata': {'name': path.split('/')[-1], 'namespace': 'ns'}, 'data': {'state': json.dumps({key: value for key, value in states[1].items() if shards[1].owns_cache_key(key)})}}
+        api.put_object(path, body)
+    api.on_write = on_write
+
+    failures = []
+    stores = [state_store.ConfigMapStateStore('volume-autoscaler-state', 'ns', api_client=api_client) for shard in shards]
+    for store, state, shard in zip(stores, states, shards):
+        store.load()
+        store.save(state, owns=shard.owns_cache_key)
+    stored = state_store.ConfigMapStateStore('volume-autoscaler-state', 'ns', api_client=api_client).load()
+    if stored != expected:
+        failures.append("our ConfigMap has {} of {} keys stored by the replica they belong to".format(sum(stored.get(key) == value for key, value in expected.items()), len(expected)))
+
+    with tempfile.TemporaryDirectory() as directory:
+        stores = [state_store.SQLiteStateStore(os.path.join(directory, 'state.db')) for shard in shards]
+        for store, state, shard in zip(stores, states, shards):
+            store.load()
+            store.save(state, owns=shard.owns_cache_key)
+        stored = state_store.SQLiteStateStore(os.path.join(directory, 'state.db')).load()
+        if stored != expected:
+            failures.append("our SQLite file has {} of {} keys stored by the replica they belong to".format(sum(stored.get(key) == value for key, value in expected.items()), len(expected)))
+
+    for shard in shards:
+        shard.stop()
+    server.shutdown()
+    if api.on_write:
+        failures.append("the other replica never wrote our ConfigMap between our read and write")
+    return ", ".join(failures) or None
+
+
+CHECKS = {
+    'relist': check_relist,
+    'events': check_events,
+    'state': check_state,
+}
+
+
+if __name__ == "__main__":
+    failures = 0
+    for name, check in CHECKS.items():
+        failure = check()
+        print("{:>8}: {}".format(name, "FAILED, {}".format(failure) if failure else "ok"))
+        failures += 1 if failure else 0
+    if failures:
+        exit(1)
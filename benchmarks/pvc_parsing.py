@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+##########################################################################################
+# Benchmarks listing PVCs through the kubernetes-client models (convert_pvc_to_simpler_dict)
+# against our raw JSON fast path (convert_raw_pvc_to_simpler_dict), and checks that both
+# produce exactly the same records.  Exits non-zero if they don't.  Also measures how much
+# memory we use per PVC we track, which is what pod memory limits should be sized from.
+# With --check this only checks both produce the same records, on a few PVCs without timing
+# or measuring them, and that annotations too large for our decisions are clamped (this is in
+# `make test-local`).
+#   Usage: python3 benchmarks/pvc_parsing.py [--check] [number-of-pvcs]
+##########################################################################################
+import os
+import sys
+import json
+import time
+import random
+import tracemalloc
+
+# We don't talk to a real cluster or Prometheus here, so skip loading credentials on import
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('PROMETHEUS_URL', 'http://localhost:9090')
+import kubernetes
+kubernetes.config.load_incluster_config = lambda *args, **kwargs: None
+import helpers
+import decisions
+
+
+# Every setting we can override with an annotation, some PVCs have all of them
+ALL_SETTING_ANNOTATIONS = {annotation: '1' if setting == 'scale_after_intervals' else '3600' for setting, annotation in helpers.PVC_ANNOTATION_SETTINGS}
+
+
+# Generate a PVC list response like the API server would send us, with a mix of annotations, and some PVCs missing the
+# fields which are missing until they're bound (or which are optional)
+def generate_pvc_list(count):
+    items = []
+    for i in range(count):
+        annotations = {
+            'pv.kubernetes.io/bind-completed': 'yes',
+            'volume.beta.kubernetes.io/storage-provisioner': 'ebs.csi.aws.com',
+        }
+        if i % 3 == 0:
+            annotations['volume.autoscaler.kubernetes.io/scale-above-percent'] = str(random.randint(50, 95))
+        if i % 5 == 0:
+            annotations['volume.autoscaler.kubernetes.io/last-resized-at'] = str(int(time.time()) - random.randint(0, 100000))
+        if i % 7 == 0:
+            annotations['volume.autoscaler.kubernetes.io/ignore'] = 'true'
+        if i % 11 == 0:
+            annotations['volume.autoscaler.kubernetes.io/scale-up-max-size'] = 'not-a-number'
+        if i % 23 == 0:
+            annotations.update(ALL_SETTING_ANNOTATIONS)
+        size = random.choice(['1Gi', '10Gi', '100G', '500Mi', '2Ti', '1000000000'])
+        item = {
+            'apiVersion': 'v1',
+            'kind': 'PersistentVolumeClaim',
+            'metadata': {
+                'name': 'data-pvc-{}'.format(i),
+                'namespace': 'namespace-{}'.format(i % 50),
+                'uid': 'a1b2c3d4-0000-0000-0000-{:012d}'.format(i),
+                'resourceVersion': str(1000000 + i),
+                'creationTimestamp': '2023-01-01T00:00:00Z',
+                'labels': {'app': 'app-{}'.format(i % 20)},
+                'annotations': annotations,
+                'finalizers': ['kubernetes.io/pvc-protection'],
+            },
+            'spec': {
+                'accessModes': ['ReadWriteOnce'],
+                'resources': {'requests': {'storage': size}},
+                'storageClassName': 'gp3',
+                'volumeMode': 'Filesystem',
+                'volumeName': 'pvc-{:012d}'.format(i),
+            },
+            'status': {
+                'accessModes': ['ReadWriteOnce'],
+                'capacity': {'storage': size},
+                'phase': 'Bound',
+            },
+        }
+        if i % 13 == 0:
+            item['status'] = {'phase': 'Pending'}
+        if i % 17 == 0:
+            del item['metadata']['annotations']
+        if i % 19 == 0:
+            del item['spec']['storageClassName']
+        items.append(item)
+    return json.dumps({'apiVersion': 'v1', 'kind': 'PersistentVolumeClaimList', 'metadata': {'resourceVersion': '2000000'}, 'items': items})
+
+
+# The current path: deserialize into the kubernetes-client models, then convert every PVC
+def parse_with_models(response_text):
+    api_response = kubernetes.client.ApiClient().deserialize(response_text, 'V1PersistentVolumeClaimList', 'application/json')
+    return {"{}.{}".format(item.metadata.namespace,item.metadata.name): helpers.convert_pvc_to_simpler_dict(item) for item in api_response.items}
+
+
+# The fast path: plain JSON decoding, then only pull out the fields we use
+def parse_raw(response_text):
+    api_response = json.loads(response_text)
+    return {"{}.{}".format(item['metadata']['namespace'],item['metadata']['name']): helpers.convert_raw_pvc_to_simpler_dict(item) for item in api_response['items']}
+
+
+def time_it(function, argument, rounds=3):
+    best = None
+    for _ in range(rounds):
+        # Don't let one round re-use the settings parsed by the last one
+        helpers.prune_pvc_settings_cache(set())
+        start = time.perf_counter()
+        result = function(argument)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None or elapsed < best else best
+    return best, result
+
+
+# Exit non-zero if our fast path produced different records than the models did
+def check_identical(models_result, raw_result):
+    if models_result != raw_result:
+        mismatched = [key for key in models_result if models_result[key] != raw_result.get(key)]
+        print("ERROR: The fast path differs from convert_pvc_to_simpler_dict for {} PVCs, eg: {}".format(len(mismatched), mismatched[:5]))
+        exit(1)
+    print("Both paths produced identical results")
+
+
+# A PVC with settings annotated larger than an int64 should have them clamped, so deciding about it doesn't overflow
+HUGE_ANNOTATIONS = {
+    'volume.autoscaler.kubernetes.io/scale-up-max-size': '100000000000000000000',
+    'volume.autoscaler.kubernetes.io/scale-up-max-increment': '100000000000000000000',
+    'volume.autoscaler.kubernetes.io/scale-up-percent': '-100000000000000000000',
+}
+USAGE_COLUMNS = dict(volume_used_percent=90, volume_used_inode_percent=-1, volume_growth_bytes_per_second=0.0, volume_available_bytes=-1.0, alert_intervals=10,
+                     count_interval=True, recently_resized=False)
+
+
+# Returns what went wrong deciding about a PVC with HUGE_ANNOTATIONS, or None
+def check_huge_annotations():
+    record = helpers.build_simpler_pvc_dict('huge', 'namespace-0', 'uid-huge', '1', 'gp3', '10Gi', '10Gi', HUGE_ANNOTATIONS)
+    row = dict(USAGE_COLUMNS, **{column: record[column] for column in decisions.RECORD_COLUMNS})
+    settings = (record['scale_up_max_size'], record['scale_up_max_increment'], record['scale_up_percent'])
+    if settings != (decisions.MAX_VALUE, decisions.MAX_VALUE, -decisions.MAX_VALUE):
+        return "parsed scale_up_max_size, scale_up_max_increment and scale_up_percent as {}, expected them clamped to {}".format(settings, decisions.MAX_VALUE)
+    try:
+        plan = decisions.plan({column: [value] for column, value in row.items()}, time.time())
+    except Exception as e:
+        return "deciding failed with {}: {}".format(type(e).__name__, e)
+    decided = (plan['action'][0], plan['resize_to_bytes'][0])
+    expected = decisions.decide_one(row, time.time())
+    if decided != (expected[0], expected[2]):
+        return "decided {}, expected {} as decided one PVC at a time".format(decided, (expected[0], expected[2]))
+    return None
+
+
+if __name__ == "__main__":
+    check = '--check' in sys.argv[1:]
+    args = [arg for arg in sys.argv[1:] if arg != '--check']
+    count = int(args[0]) if args else 500 if check else 10000
+    random.seed(42)
+    response_text = generate_pvc_list(count)
+
+    # Only check our fast path against the models, once each
+    if check:
+        real_stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            models_result = parse_with_models(response_text)
+            helpers.prune_pvc_settings_cache(set())
+            raw_result = parse_raw(response_text)
+            huge_failure = check_huge_annotations()
+        finally:
+            sys.stdout.close()
+            sys.stdout = real_stdout
+        print("Parsed {} PVCs both ways".format(count))
+        check_identical(models_result, raw_result)
+        if huge_failure:
+            print("ERROR: A PVC with annotations too large for an int64 {}".format(huge_failure))
+            exit(1)
+        print("Annotations too large for an int64 were clamped")
+        exit(0)
+
+    # The invalid annotation we inject above would print once per PVC per round, silence it while timing
+    real_stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        models_time, models_result = time_it(parse_with_models, response_text)
+        raw_time, raw_result = time_it(parse_raw, response_text)
+    finally:
+        sys.stdout.close()
+        sys.stdout = real_stdout
+
+    print("Parsed {} PVCs ({:.1f} MB of JSON)".format(count, len(response_text) / 1000000))
+    print("  kubernetes-client models: {:8.1f} ms".format(models_time * 1000))
+    print("         raw JSON fast path: {:8.1f} ms ({:.1f}x faster)".format(raw_time * 1000, models_time / raw_time))
+
+    # Measure the memory our index of records takes, including the parsed settings each record has
+    helpers.prune_pvc_settings_cache(set())
+    raw_result = None
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        tracemalloc.start()
+        raw_result = parse_raw(response_text)
+        index_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    finally:
+        sys.stdout.close()
+        sys.stdout = real_stdout
+    print("  memory per tracked PVC: {} bytes measured, {} bytes estimated by estimate_memory_per_pvc".format(int(index_bytes / count), helpers.estimate_memory_per_pvc(raw_result)))
+    print("  memory for 50000 PVCs: {:.1f} MB".format(index_bytes / count * 50000 / 1000000))
+
+    check_identical(models_result, raw_result)
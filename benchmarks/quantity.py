@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+##########################################################################################
+# Checks convert_storage_to_bytes and convert_bytes_to_storage against the Kubernetes Quantity
+# rules with a table of known quantities and thousands of random ones, then times them with and
+# without their LRU cache.  Exits non-zero if any check fails.
+#   Usage: python3 benchmarks/quantity.py [number-of-random-quantities]
+##########################################################################################
+import os
+import sys
+import time
+import random
+import decimal
+
+# We don't talk to a real cluster or Prometheus here, so skip loading credentials on import
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('PROMETHEUS_URL', 'http://localhost:9090')
+import kubernetes
+kubernetes.config.load_incluster_config = lambda *args, **kwargs: None
+import helpers
+
+# Quantities and how many bytes Kubernetes considers them, rounding any fraction of a byte up
+KNOWN_QUANTITIES = [
+    ('0', 0), ('1', 1), ('1000', 1000), ('+5', 5),
+    ('1Ki', 1024), ('1.5Gi', 1610612736), ('.5Ki', 512), ('10Gi', 10737418240), ('2Pi', 2 * 1024**5), ('1Ei', 1024**6),
+    ('100m', 1), ('1500m', 2), ('1k', 1000), ('1M', 1000000), ('100G', 100000000000), ('1.5T', 1500000000000),
+    ('1P', 1000**5), ('1E', 1000**6), ('1E3', 1000), ('500e6', 500000000), ('5e-1', 1), ('1.e3', 1000),
+]
+INVALID_QUANTITIES = ['', 'Gi', '1K', '1 Gi', '1Gb', '1.2.3', '1e', '1ee3', '1Mi3', 'e3', '--1', '1i']
+
+BINARY_SUFFIXES = ['Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei']
+DECIMAL_SUFFIXES = ['m', '', 'k', 'M', 'G', 'T', 'P', 'E']
+DECIMAL_MULTIPLIERS = {'m': -3, '': 0, 'k': 3, 'M': 6, 'G': 9, 'T': 12, 'P': 15, 'E': 18}
+
+
+# A random quantity, and how many bytes it should be, worked out separately with Decimal instead of our parser's Fraction
+def random_quantity():
+    whole = str(random.randint(0, 100000))
+    fraction = ''.join(random.choice('0123456789') for _ in range(random.randint(0, 4)))
+    number = whole + ('.' + fraction if fraction or random.random() < 0.1 else '')
+    kind = random.choice(['binary', 'decimal', 'exponent'])
+    if kind == 'binary':
+        suffix = random.choice(BINARY_SUFFIXES)
+        expected = decimal.Decimal(number) * (1024 ** (BINARY_SUFFIXES.index(suffix) + 1))
+    elif kind == 'decimal':
+        suffix = random.choice(DECIMAL_SUFFIXES)
+        expected = decimal.Decimal(number).scaleb(DECIMAL_MULTIPLIERS[suffix])
+    else:
+        exponent = random.randint(-6, 18)
+        suffix = random.choice('eE') + str(exponent)
+        expected = decimal.Decimal(number).scaleb(exponent)
+    return number + suffix, int(expected.to_integral_value(rounding=decimal.ROUND_CEILING))
+
+
+def check(count):
+    failures = []
+    for quantity, expected in KNOWN_QUANTITIES:
+        if helpers.convert_storage_to_bytes(quantity) != expected:
+            failures.append("{} parsed as {}, expected {}".format(quantity, helpers.convert_storage_to_bytes(quantity), expected))
+    for quantity in INVALID_QUANTITIES:
+        try:
+            failures.append("{} should be invalid, but parsed as {}".format(quantity, helpers.convert_storage_to_bytes(quantity)))
+        except ValueError:
+            pass
+
+    for _ in range(count):
+        # Parsing random quantities
+        quantity, expected = random_quantity()
+        if helpers.convert_storage_to_bytes(quantity) != expected:
+            failures.append("{} parsed as {}, expected {}".format(quantity, helpers.convert_storage_to_bytes(quantity), expected))
+
+        # Whole numbers of a unit format exactly in that unit's base, and parse back to the same bytes
+        binary = random.random() < 0.5
+        suffix, size_multiplier = random.choice(helpers.QUANTITY_FORMAT_UNITS[binary])
+        bytes = random.randint(1, 1023) * size_multiplier
+        formatted = helpers.convert_bytes_to_storage(bytes, binary)
+        if helpers.convert_storage_to_bytes(formatted) != bytes or helpers.is_binary_storage(formatted) != binary:
+            failures.append("{} bytes formatted as {}, which is not exact in the {} base".format(bytes, formatted, 'binary' if binary else 'decimal'))
+
+        # Anything else formats into a valid quantity within 10% of the bytes given
+        bytes = random.randint(0, 10**19)
+        formatted = helpers.convert_bytes_to_storage(bytes, random.random() < 0.5)
+        if abs(helpers.convert_storage_to_bytes(str(formatted)) - bytes) > bytes * 0.1:
+            failures.append("{} bytes formatted as {}, which is more than 10% off".format(bytes, formatted))
+    return failures
+
+
+def time_it(function, arguments, rounds=3):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for argument in arguments:
+            function(*argument)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None or elapsed < best else best
+    return best
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    random.seed(42)
+
+    failures = check(count)
+    if failures:
+        print("ERROR: {} checks failed, eg:".format(len(failures)))
+        for failure in failures[:10]:
+            print("  " + failure)
+        exit(1)
+    print("Checked {} known, {} invalid and {} random quantities against the Kubernetes rules".format(len(KNOWN_QUANTITIES), len(INVALID_QUANTITIES), count))
+
+    # What we actually do each loop: convert the same few sizes of every PVC over and over
+    sizes = [random.choice(['1Gi', '10Gi', '100G', '500Mi', '2Ti', '1.5Gi', '1000000000']) for _ in range(count)]
+    parse_arguments = [(size,) for size in sizes]
+    format_arguments = [(helpers.convert_storage_to_bytes(size), helpers.is_binary_storage(size)) for size in sizes]
+    parse_uncached = time_it(helpers.convert_storage_to_bytes.__wrapped__, parse_arguments)
+    parse_cached = time_it(helpers.convert_storage_to_bytes, parse_arguments)
+    format_uncached = time_it(helpers.format_bytes_to_storage.__wrapped__, format_arguments)
+    format_cached = time_it(helpers.format_bytes_to_storage, format_arguments)
+    print("Converted {} PVC sizes".format(count))
+    print("  convert_storage_to_bytes: {:8.1f} ms uncached, {:8.1f} ms cached".format(parse_uncached * 1000, parse_cached * 1000))
+    print("  convert_bytes_to_storage: {:8.1f} ms uncached, {:8.1f} ms cached".format(format_uncached * 1000, format_cached * 1000))
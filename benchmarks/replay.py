@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+##########################################################################################
+# Checks replay.py end to end on a short synthetic history.  A fake Prometheus serves the
+# history to fetch_history, which dumps it in chunks, then we replay that dump (as one file,
+# and as one file per chunk) with a sweep of settings through replay.py's command line, each
+# set of settings in its own process.  Every result must match replaying the same history one
+# volume and one sample at a time through decisions.decide_one.  Exits non-zero if any differ.
+#   Usage: python3 benchmarks/replay.py
+##########################################################################################
+import os
+import sys
+import json
+import math
+import tempfile
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+REPLAY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'replay.py')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import decisions
+import replay
+
+GIGABYTE = 1000000000
+START = 1700000000
+STEP = 60
+HOURS = 6
+CHUNK_SECONDS = 2 * 3600
+
+# The settings we replay with, low enough that our volumes are resized a few times within our history
+SETTINGS = ['scale_after_intervals=3', 'scale_cooldown_time=300', 'scale_up_min_increment={}'.format(GIGABYTE)]
+SWEEPS = ['scale_up_percent=20,100', 'scale_above_percent=70,90']
+
+# Our synthetic volumes: their namespace and name, size, used bytes at the start, how fast they fill up (bytes per second),
+# their inodes used percent if they report it, and the hours of our history they have no samples in
+VOLUMES = [
+    ('default', 'steady',   10 * GIGABYTE, 5 * GIGABYTE,  400000,  None, []),
+    ('default', 'fast',     10 * GIGABYTE, 8 * GIGABYTE,  2000000, None, []),
+    ('default', 'flat',     50 * GIGABYTE, 10 * GIGABYTE, 0,       None, []),
+    ('logging', 'inodes',   20 * GIGABYTE, 2 * GIGABYTE,  0,       95,   []),
+    ('logging', 'gaps',     10 * GIGABYTE, 6 * GIGABYTE,  600000,  None, [1, 2]),
+    ('metrics', 'late',     5 * GIGABYTE,  4 * GIGABYTE,  300000,  None, [0, 1, 2]),
+]
+
+
+# The samples of our volumes between start and end (inclusive), as a query_range response of our history query
+def build_history_response(start, end, step):
+    result = []
+    for namespace, name, size, used, growth, inodes, missing_hours in VOLUMES:
+        timestamps = [timestamp for timestamp in range(start, end + 1, step) if (timestamp - START) // 3600 not in missing_hours]
+        series = [
+            ('capacity', [[timestamp, str(size)] for timestamp in timestamps]),
+            ('available', [[timestamp, str(size - used - growth * (timestamp - START))] for timestamp in timestamps]),
+        ]
+        if inodes is not None:
+            series.append(('inodes', [[timestamp, str(inodes)] for timestamp in timestamps]))
+        for metric_type, values in series:
+            if values:
+                result.append({'metric': {'namespace': namespace, 'persistentvolumeclaim': name, 'metric_type': metric_type}, 'values': values})
+    return {'status': 'success', 'data': {'resultType': 'matrix', 'result': result}}
+
+
+class PrometheusHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path != '/api/v1/query_range' or query['query'][0] != replay.build_history_query(''):
+            self.send_response(400)
+            self.end_headers()
+            return
+        payload = json.dumps(build_history_response(int(query['start'][0]), int(query['end'][0]), int(query['step'][0]))).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+# Replay our history with one set of settings one volume and one sample at a time, the same way replay.Replay does
+def replay_one_at_a_time(parameters):
+    samples = {}
+    for item in build_history_response(START, START + HOURS * 3600, STEP)['data']['result']:
+        volume = (item['metric']['namespace'], item['metric']['persistentvolumeclaim'])
+        for timestamp, value in item['values']:
+            samples.setdefault(float(timestamp), {}).setdefault(volume, {})[item['metric']['metric_type']] = float(value)
+
+    sizes, last_resized_at, alert_intervals, resizes = {}, {}, {}, {}
+    peak_percent = 0
+    next_evaluation = 0
+    for timestamp in sorted(samples):
+        evaluate = timestamp >= next_evaluation
+        if evaluate:
+            next_evaluation = timestamp + parameters['interval_time']
+        for volume, sample in sorted(samples[timestamp].items()):
+            size = sizes.setdefault(volume, sample['capacity'])
+            used_bytes = max(0, sample['capacity'] - sample['available'])
+            peak_percent = max(peak_percent, used_bytes / size * 100)
+            if not evaluate:
+                continue
+            row = {column: parameters[column] for column in decisions.RECORD_COLUMNS if column in parameters}
+            row.update({
+                'volume_size_status_bytes': int(size),
+                'last_resized_at': last_resized_at.get(volume, 0),
+                'ignore': False,
+                'volume_used_percent': math.ceil(used_bytes / size * 100),
+                'volume_used_inode_percent': sample.get('inodes', -1),
+                'volume_growth_bytes_per_second': 0,
+                'volume_available_bytes': -1,
+                'alert_intervals': alert_intervals.get(volume, 0),
+                'count_interval': True,
+                'recently_resized': 0 < last_resized_at.get(volume, 0) and timestamp - last_resized_at[volume] < parameters['interval_time'] * replay.DEBOUNCE_INTERVALS,
+            })
+            action, alert_intervals[volume], resize_to = decisions.decide_one(row, int(timestamp))
+            if action == decisions.RESIZE:
+                sizes[volume] = resize_to
+                last_resized_at[volume] = int(timestamp)
+                resizes[volume] = resizes.get(volume, 0) + 1
+    return {'resizes': sum(resizes.values()), 'most_resizes_of_a_volume': max(resizes.values(), default=0), 'peak_used_percent': round(peak_percent, 1), 'volumes': len(sizes)}
+
+
+# Run replay.py's command line on these dump files, returning its results for each set of settings
+def run_replay(paths):
+    command = [sys.executable, REPLAY_PATH, '--json', '--processes', '2']
+    for path in paths:
+        command += ['--file', path]
+    for setting in SETTINGS:
+        command += ['--set', setting]
+    for sweep in SWEEPS:
+        command += ['--sweep', sweep]
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    return [json.loads(line) for line in output.splitlines() if line.strip()]
+
+
+if __name__ == "__main__":
+    server = ThreadingHTTPServer(('127.0.0.1', 0), PrometheusHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    failures = []
+    with tempfile.TemporaryDirectory() as directory:
+        # Fetch our history into a dump, then also split it into a file per chunk
+        dump_path = os.path.join(directory, 'history.jsonl')
+        chunks = replay.fetch_history('http://127.0.0.1:{}'.format(server.server_address[1]), '', START, START + HOURS * 3600, STEP, CHUNK_SECONDS, dump_path)
+        server.shutdown()
+        chunk_paths = []
+        with open(dump_path) as dump_file:
+            for number, line in enumerate(dump_file):
+                chunk_paths.append(os.path.join(directory, 'history-{}.jsonl'.format(number)))
+                with open(chunk_paths[-1], 'w') as chunk_file:
+                    chunk_file.write(line)
+        print("Fetched our history in {} chunks".format(chunks))
+
+        parameter_sets = replay.build_parameter_sets(SETTINGS, SWEEPS)
+        expected = [replay_one_at_a_time(parameters) for parameters in parameter_sets]
+        for paths in [[dump_path], chunk_paths]:
+            results = run_replay(paths)
+            if [result['parameters'] for result in results] != parameter_sets:
+                failures.append("replaying {} file(s) gave results for {}, expected {}".format(len(paths), [result['parameters'] for result in results], parameter_sets))
+                continue
+            for parameters, result, one_at_a_time in zip(parameter_sets, results, expected):
+                replayed = {key: result[key] for key in one_at_a_time}
+                if replayed != one_at_a_time:
+                    failures.append("replaying {} file(s) with {} gave {}, expected {}".format(len(paths), parameters, replayed, one_at_a_time))
+
+    for parameters, one_at_a_time in zip(parameter_sets, expected):
+        print("  {}: {} resizes, peak {}% used".format(", ".join("{}={}".format(sweep.split('=')[0], parameters[sweep.split('=')[0]]) for sweep in SWEEPS), one_at_a_time['resizes'], one_at_a_time['peak_used_percent']))
+    if failures:
+        print("ERROR: {} replays differ from replaying one volume at a time, eg:".format(len(failures)))
+        for failure in failures[:5]:
+            print("  " + failure)
+        exit(1)
+    print("Replayed our history the same as one volume at a time")
@@ -0,0 +1,481 @@
+#!/usr/bin/env python3
+##########################################################################################
+# Simulates a cluster full of volumes, so we can see how our main loop behaves at 10k or 100k
+# PVCs without a real cluster.  A fake Kubernetes API (PVC list/patch, events) and a fake
+# Prometheus (query, buildinfo) run in a child process, serving a synthetic fleet of volumes
+# which fill up along growth curves, with optional injected latency and errors.  We then run
+# the real run_loop() from main.py against them, one simulated interval at a time, and report
+# loop wall time, API calls per loop, peak RSS and resize decision latency.
+#
+# Results are compared against benchmarks/baseline.json with --check (this is `make test-local`)
+# and that baseline is updated with --update-baseline after an intentional change.
+#   Usage: python3 benchmarks/simulator.py [--check | --update-baseline] [--scenario name]
+#          python3 benchmarks/simulator.py --pvcs 100000 --loops 5 --growth exponential
+##########################################################################################
+import os
+import sys
+import json
+import math
+import time
+import random
+import hashlib
+import resource
+import tempfile
+import threading
+import subprocess
+import statistics
+import multiprocessing
+import urllib.request
+from optparse import OptionParser, SUPPRESS_HELP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILE = os.path.join(BENCHMARKS_PATH, 'baseline.json')
+
+# The scenarios we keep a baseline for, `make test-local` runs all of these
+SCENARIOS = {
+    'small':  {'pvcs': 1000,  'loops': 10, 'growth': 'mixed'},
+    'medium': {'pvcs': 10000, 'loops': 6,  'growth': 'mixed'},
+    'faulty': {'pvcs': 2000,  'loops': 10, 'growth': 'mixed', 'api_latency': 0.01, 'prometheus_latency': 0.05, 'error_rate': 0.02},
+}
+SCENARIO_DEFAULTS = {'namespaces': 100, 'growth_rate': 2.0, 'api_latency': 0, 'prometheus_latency': 0, 'error_rate': 0, 'seed': 42}
+
+# How far off the baseline we allow each result to be before --check fails.  Counts should barely move, timings
+# depend on the machine we're running on so they get a lot more room
+TOLERANCES = {
+    'api_calls_per_loop': 0.10,
+    'resizes': 0.10,
+    'intervals_to_resize': 0.10,
+    'loop_seconds': 1.00,
+    'decision_latency_p95_seconds': 1.00,
+    'peak_rss_mb': 0.25,
+}
+
+# Settings for the autoscaler we run, the rest are its defaults
+SCALE_ABOVE_PERCENT = 80
+SCALE_AFTER_INTERVALS = 3
+SIZES = [1 * 1024**3, 10 * 1024**3, 50 * 1024**3, 100 * 10**9, 500 * 1024**3]
+# Kubernetes rejects updates to these fields of an events.k8s.io/v1 Event
+IMMUTABLE_EVENT_FIELDS = ('note', 'reason', 'action', 'regarding')
+
+
+##########################################################################################
+# The synthetic fleet, this lives in our fake servers' process
+##########################################################################################
+class Fleet:
+    def __init__(self, options):
+        self.options = options
+        self.lock = threading.Lock()
+        self.random = random.Random(options['seed'])
+        self.tick = 0
+        self.tick_started = time.time()
+        self.resource_version = 1000
+        self.pvcs = {}
+        self.events = {}
+        self.calls = {}
+        self.attempts = {}
+        self.crossed_at = {}
+        self.resizes = []
+        growths = ['flat', 'linear', 'exponential', 'burst'] if options['growth'] == 'mixed' else [options['growth']]
+        for number in range(options['pvcs']):
+            namespace = 'namespace-{}'.format(number % options['namespaces'])
+            name = 'data-{}'.format(number)
+            size = self.random.choice(SIZES)
+            annotations = {}
+            if number % 20 == 0:
+                annotations['volume.autoscaler.kubernetes.io/ignore'] = 'true'
+            self.pvcs[(namespace, name)] = {
+                'namespace': namespace,
+                'name': name,
+                'uid': hashlib.sha1(name.encode()).hexdigest(),
+                'resource_version': self.next_resource_version(),
+                'size': size,
+                'requested': str(size),
+                'annotations': annotations,
+                'used': size * self.random.uniform(0.3, 0.78),
+                'inodes_percent': self.random.uniform(5, 60),
+                'growth': self.random.choice(growths),
+                'burst_at': self.random.randint(1, max(1, options['loops'])),
+            }
+        self.keys = sorted(self.pvcs)
+
+    def next_resource_version(self):
+        self.resource_version += 1
+        return str(self.resource_version)
+
+    def used_percent(self, pvc):
+        return min(100, math.ceil(pvc['used'] / pvc['size'] * 100))
+
+    # Move to the next interval: grow every volume along its curve, and note when each first crosses our threshold
+    def advance(self):
+        with self.lock:
+            self.tick += 1
+            self.tick_started = time.time()
+            rate = self.options['growth_rate'] / 100
+            for key, pvc in self.pvcs.items():
+                if pvc['growth'] == 'linear':
+                    pvc['used'] += pvc['size'] * rate
+                elif pvc['growth'] == 'exponential':
+                    pvc['used'] *= 1 + rate * 2
+                elif pvc['growth'] == 'burst' and pvc['burst_at'] == self.tick:
+                    pvc['used'] += pvc['size'] * 0.25
+                pvc['used'] = min(pvc['used'], pvc['size'])
+                if key not in self.crossed_at and self.used_percent(pvc) >= SCALE_ABOVE_PERCENT and 'volume.autoscaler.kubernetes.io/ignore' not in pvc['annotations']:
+                    self.crossed_at[key] = self.tick
+
+    def to_kubernetes(self, pvc):
+        return {
+            'apiVersion': 'v1',
+            'kind': 'PersistentVolumeClaim',
+            'metadata': {
+                'name': pvc['name'], 'namespace': pvc['namespace'], 'uid': pvc['uid'],
+                'resourceVersion': pvc['resource_version'], 'annotations': pvc['annotations'],
+                'creationTimestamp': '2023-01-01T00:00:00Z',
+            },
+            'spec': {'accessModes': ['ReadWriteOnce'], 'resources': {'requests': {'storage': pvc['requested']}}, 'storageClassName': 'gp3', 'volumeMode': 'Filesystem'},
+            'status': {'accessModes': ['ReadWriteOnce'], 'capacity': {'storage': str(pvc['size'])}, 'phase': 'Bound'},
+        }
+
+    def list_page(self, limit, continue_token):
+        with self.lock:
+            start = int(continue_token or 0)
+            end = start + limit if limit else len(self.keys)
+            items = [self.to_kubernetes(self.pvcs[key]) for key in self.keys[start:end]]
+            metadata = {'resourceVersion': str(self.resource_version)}
+            if end < len(self.keys):
+                metadata['continue'] = str(end)
+            return {'apiVersion': 'v1', 'kind': 'PersistentVolumeClaimList', 'metadata': metadata, 'items': items}
+
+    # Resizing completes right away in our fleet, so the next interval sees the new size
+    def patch(self, namespace, name, body):
+        with self.lock:
+            pvc = self.pvcs.get((namespace, name))
+            if pvc is None:
+                return None
+            pvc['annotations'].update(body.get('metadata', {}).get('annotations', {}))
+            storage = body.get('spec', {}).get('resources', {}).get('requests', {}).get('storage')
+            if storage is not None:
+                pvc['requested'] = str(storage)
+                pvc['size'] = max(pvc['size'], int(storage))
+                self.resizes.append({
+                    'intervals': self.tick - self.crossed_at.get((namespace, name), self.tick),
+                    'seconds': time.time() - self.tick_started,
+                })
+                self.crossed_at.pop((namespace, name), None)
+            pvc['resource_version'] = self.next_resource_version()
+            return self.to_kubernetes(pvc)
+
+    # The Prometheus query we're sent, with a threshold if we were asked to only return volumes at or above it
+    def query(self, query):
+        threshold = None
+        if ') >= ' in query:
+            threshold = int(query.split(') >= ')[1].split(' ')[0])
+        result = []
+        with self.lock:
+            for pvc in self.pvcs.values():
+                used_percent = self.used_percent(pvc)
+                inodes_percent = math.ceil(pvc['inodes_percent'])
+                if threshold is not None and used_percent < threshold and inodes_percent < threshold:
+                    continue
+                labels = {'namespace': pvc['namespace'], 'persistentvolumeclaim': pvc['name']}
+                result.append({'metric': dict(labels, metric_type='bytes'), 'value': [self.tick, str(used_percent)]})
+                result.append({'metric': dict(labels, metric_type='inodes'), 'value': [self.tick, str(inodes_percent)]})
+        return {'status': 'success', 'data': {'resultType': 'vector', 'result': result}}
+
+    # Whether to fail this request.  Decided by a hash of the request and how many times we've seen it this interval, so
+    # the same requests fail every run no matter which order our threads send them in, and retries can succeed
+    def should_fail(self, request):
+        if not self.options['error_rate']:
+            return False
+        with self.lock:
+            key = (self.tick, request)
+            self.attempts[key] = self.attempts.get(key, 0) + 1
+            digest = hashlib.sha1(repr((self.options['seed'], key, self.attempts[key])).encode()).digest()
+        return int.from_bytes(digest[:4], 'big') / 2**32 < self.options['error_rate']
+
+    def count_call(self, kind):
+        with self.lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            return {'tick': self.tick, 'calls': dict(self.calls), 'resizes': list(self.resizes)}
+
+
+# Serves both the Kubernetes API and Prometheus, telling them apart by path
+def create_handler(fleet):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def read_json(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            return json.loads(self.rfile.read(length) or b'{}')
+
+        # Count, delay and maybe fail a request like the real thing would.  Returns False if we failed it
+        def simulate(self, kind, latency):
+            fleet.count_call(kind)
+            if latency:
+                time.sleep(latency)
+            if fleet.should_fail(self.command + ' ' + self.path):
+                self.send_json(500, {'kind': 'Status', 'status': 'Failure', 'code': 500, 'message': 'injected error'})
+                return False
+            return True
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            parts = url.path.strip('/').split('/')
+            if url.path == '/_sim/stats':
+                return self.send_json(200, fleet.stats())
+            if url.path == '/api/v1/status/buildinfo':
+                return self.send_json(200, {'status': 'success', 'data': {'version': '2.45.0'}})
+            if url.path == '/api/v1/query':
+                if self.simulate('prometheus_query', fleet.options['prometheus_latency']):
+                    self.send_json(200, fleet.query(query.get('query', [''])[0]))
+                return
+            if url.path == '/api/v1/persistentvolumeclaims':
+                if self.simulate('pvc_list', fleet.options['api_latency']):
+                    self.send_json(200, fleet.list_page(int(query.get('limit', ['0'])[0]), query.get('continue', [''])[0]))
+                return
+            if 'events' in parts:
+                if self.simulate('event_get', fleet.options['api_latency']):
+                    event = fleet.events.get(url.path)
+                    self.send_json(200 if event else 404, event or {'kind': 'Status', 'code': 404})
+                return
+            self.send_json(404, {'kind': 'Status', 'code': 404})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path == '/_sim/advance':
+                fleet.advance()
+                return self.send_json(200, fleet.stats())
+            body = self.read_json()
+            if '/events' in url.path:
+                if self.simulate('event_create', fleet.options['api_latency']):
+                    key = url.path + '/' + body['metadata']['name']
+                    if key in fleet.events:
+                        return self.send_json(409, {'kind': 'Status', 'code': 409, 'reason': 'AlreadyExists'})
+                    fleet.events[key] = body
+                    self.send_json(201, body)
+                return
+            self.send_json(404, {'kind': 'Status', 'code': 404})
+
+        def do_PATCH(self):
+            url = urlparse(self.path)
+            parts = url.path.strip('/').split('/')
+            body = self.read_json()
+            if '/events/' in url.path:
+                if self.simulate('event_patch', fleet.options['api_latency']):
+                    event = fleet.events.get(url.path)
+                    if event and any(field in body and body[field] != event.get(field) for field in IMMUTABLE_EVENT_FIELDS):
+                        return self.send_json(422, {'kind': 'Status', 'status': 'Failure', 'code': 422, 'reason': 'Invalid', 'message': 'field is immutable'})
+                    if event:
+                        event.update(body)
+                    self.send_json(200 if event else 404, event or {'kind': 'Status', 'code': 404})
+                return
+            if '/persistentvolumeclaims/' in url.path:
+                if self.simulate('pvc_patch', fleet.options['api_latency']):
+                    pvc = fleet.patch(parts[-3], parts[-1], body)
+                    self.send_json(200 if pvc else 404, pvc or {'kind': 'Status', 'code': 404})
+                return
+            self.send_json(404, {'kind': 'Status', 'code': 404})
+
+    return Handler
+
+
+def serve_fleet(options, ready):
+    fleet = Fleet(options)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), create_handler(fleet))
+    server.daemon_threads = True
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+##########################################################################################
+# Running the autoscaler against our fleet
+##########################################################################################
+def sim_request(url, method='GET'):
+    request = urllib.request.Request(url, method=method, data=b'' if method == 'POST' else None)
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def run_scenario(options):
+    # Start our fake cluster in its own process, so its memory and CPU don't count against ours
+    ready = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve_fleet, args=(options, ready), daemon=True)
+    server.start()
+    url = 'http://127.0.0.1:{}'.format(ready.get(timeout=120))
+
+    kubeconfig = tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False)
+    kubeconfig.write(json.dumps({
+        'apiVersion': 'v1', 'kind': 'Config', 'current-context': 'simulator',
+        'clusters': [{'name': 'simulator', 'cluster': {'server': url}}],
+        'contexts': [{'name': 'simulator', 'context': {'cluster': 'simulator', 'user': 'simulator'}}],
+        'users': [{'name': 'simulator', 'user': {'token': 'simulator'}}],
+    }))
+    kubeconfig.close()
+
+    # Configure the autoscaler before importing it, it reads its settings on import
+    os.environ.update({
+        'KUBECONFIG': kubeconfig.name,
+        'PROMETHEUS_URL': url,
+        'PVC_WATCH_ENABLED': 'false',
+        'SCALE_ABOVE_PERCENT': str(SCALE_ABOVE_PERCENT),
+        'SCALE_AFTER_INTERVALS': str(SCALE_AFTER_INTERVALS),
+        'STATE_BACKEND': 'none',
+        'SLACK_WEBHOOK_URL': '',
+    })
+    sys.path.insert(0, os.path.join(BENCHMARKS_PATH, '..'))
+    # The autoscaler prints a lot about every volume (and every error we inject), we only want our results
+    real_stdout, real_stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = open(os.devnull, 'w')
+    try:
+        import helpers
+        import main
+        import state_store
+        helpers.testIfPrometheusIsAccessible(url)
+        resize_executor = helpers.ResizeExecutor()
+        pvc_state_store = state_store.StateStore()
+
+        loop_seconds = []
+        api_calls = []
+        calls_before = {}
+        for loop in range(options['loops']):
+            sim_request(url + '/_sim/advance', 'POST')
+            started = time.perf_counter()
+            main.run_loop(None, resize_executor, pvc_state_store)
+            # Include the resizes this loop queued, they're part of what a loop costs us
+            while resize_executor.pending:
+                time.sleep(0.001)
+            loop_seconds.append(time.perf_counter() - started)
+            calls = sim_request(url + '/_sim/stats')['calls']
+            api_calls.append(sum(calls.values()) - sum(calls_before.values()))
+            calls_before = calls
+        resize_executor.shutdown()
+        stats = sim_request(url + '/_sim/stats')
+    finally:
+        sys.stdout.close()
+        sys.stdout, sys.stderr = real_stdout, real_stderr
+        server.terminate()
+        os.unlink(kubeconfig.name)
+
+    resizes = stats['resizes']
+    return {
+        'pvcs': options['pvcs'],
+        'loops': options['loops'],
+        'loop_seconds': round(statistics.mean(loop_seconds), 4),
+        'loop_seconds_max': round(max(loop_seconds), 4),
+        'api_calls_per_loop': round(statistics.mean(api_calls), 1),
+        'api_calls': stats['calls'],
+        'resizes': len(resizes),
+        'intervals_to_resize': round(statistics.mean([resize['intervals'] for resize in resizes]), 2) if resizes else 0,
+        'decision_latency_p50_seconds': round(percentile([resize['seconds'] for resize in resizes], 50), 4),
+        'decision_latency_p95_seconds': round(percentile([resize['seconds'] for resize in resizes], 95), 4),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+# Run each scenario in its own process, so they don't share our caches, metrics or peak RSS
+def run_scenario_in_subprocess(name, options):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--scenario-options', json.dumps(options)],
+                            stdout=subprocess.PIPE, check=True).stdout
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def print_results(name, results, baseline=None):
+    print("Scenario {}: {} PVCs over {} loops".format(name, results['pvcs'], results['loops']))
+    for key in ['loop_seconds', 'loop_seconds_max', 'api_calls_per_loop', 'resizes', 'intervals_to_resize',
+                'decision_latency_p50_seconds', 'decision_latency_p95_seconds', 'peak_rss_mb']:
+        line = "  {:>30}: {:>10}".format(key, results[key])
+        if baseline and key in baseline:
+            line += "   (baseline {})".format(baseline[key])
+        print(line)
+    print("  {:>30}: {}".format('api_calls', ", ".join("{} {}".format(kind, count) for kind, count in sorted(results['api_calls'].items()))))
+
+
+# Which results are worse than our baseline by more than we tolerate
+def find_regressions(results, baseline):
+    regressions = []
+    for key, tolerance in TOLERANCES.items():
+        if key in baseline and results[key] > baseline[key] * (1 + tolerance) + 0.01:
+            regressions.append("{} is {}, more than {:.0f}% above the baseline of {}".format(key, results[key], tolerance * 100, baseline[key]))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [--check | --update-baseline] [--scenario name] [--pvcs N --loops N ...]")
+    parser.add_option("--check", action="store_true", dest="check", default=False, help="Run our scenarios and fail if any are worse than benchmarks/baseline.json")
+    parser.add_option("--update-baseline", action="store_true", dest="update_baseline", default=False, help="Run our scenarios and save their results as benchmarks/baseline.json")
+    parser.add_option("--scenario", dest="scenario", default=None, help="Only run this scenario ({})".format(", ".join(SCENARIOS)))
+    parser.add_option("--pvcs", dest="pvcs", type="int", default=None, help="Run a custom scenario with this many PVCs")
+    parser.add_option("--loops", dest="loops", type="int", default=10, help="How many intervals to run a custom scenario for")
+    parser.add_option("--namespaces", dest="namespaces", type="int", default=SCENARIO_DEFAULTS['namespaces'], help="How many namespaces to spread the PVCs of a custom scenario over")
+    parser.add_option("--growth", dest="growth", default="mixed", help="How volumes fill up: flat, linear, exponential, burst or mixed")
+    parser.add_option("--growth-rate", dest="growth_rate", type="float", default=SCENARIO_DEFAULTS['growth_rate'], help="How many percent of its size a linear volume grows each interval")
+    parser.add_option("--api-latency", dest="api_latency", type="float", default=0, help="Seconds of latency to add to every Kubernetes API call")
+    parser.add_option("--prometheus-latency", dest="prometheus_latency", type="float", default=0, help="Seconds of latency to add to every Prometheus query")
+    parser.add_option("--error-rate", dest="error_rate", type="float", default=0, help="The fraction (0-1) of Kubernetes and Prometheus calls to fail with a 500")
+    parser.add_option("--seed", dest="seed", type="int", default=SCENARIO_DEFAULTS['seed'], help="The random seed our fleet is generated from")
+    parser.add_option("--scenario-options", dest="scenario_options", default=None, help=SUPPRESS_HELP)
+    (options, args) = parser.parse_args()
+
+    # We were started by run_scenario_in_subprocess, run one scenario and print its results as JSON
+    if options.scenario_options:
+        print(json.dumps(run_scenario(json.loads(options.scenario_options))))
+        exit(0)
+
+    if options.pvcs:
+        scenarios = {'custom': dict(SCENARIO_DEFAULTS, pvcs=options.pvcs, loops=options.loops, namespaces=options.namespaces, growth=options.growth,
+                                    growth_rate=options.growth_rate, api_latency=options.api_latency, prometheus_latency=options.prometheus_latency,
+                                    error_rate=options.error_rate, seed=options.seed)}
+    else:
+        scenarios = {name: dict(SCENARIO_DEFAULTS, **scenario) for name, scenario in SCENARIOS.items() if options.scenario in (None, name)}
+
+    baselines = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as baseline_file:
+            baselines = json.load(baseline_file)
+
+    regressions = []
+    for name, scenario in scenarios.items():
+        results = run_scenario_in_subprocess(name, scenario)
+        print_results(name, results, baselines.get(name))
+        if options.check:
+            if name not in baselines:
+                print("  WARNING: No baseline for this scenario, run with --update-baseline to save one")
+            else:
+                regressions += ["{}: {}".format(name, regression) for regression in find_regressions(results, baselines[name])]
+        if options.update_baseline:
+            baselines[name] = results
+
+    if options.update_baseline:
+        with open(BASELINE_FILE, 'w') as baseline_file:
+            json.dump(baselines, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write("\n")
+        print("Saved our results as the baseline in {}".format(BASELINE_FILE))
+
+    if regressions:
+        print("ERROR: Regressions compared to our baseline:")
+        for regression in regressions:
+            print("  " + regression)
+        exit(1)
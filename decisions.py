@@ -0,0 +1,188 @@
+##########################################################################################
+# Our scaling decisions for every PVC at once.  Given columns (one entry per PVC) of their
+# usage, sizes, settings and alert state, this decides what to do with each of them in one
+# vectorized pass with NumPy, the same checks in the same order our main loop always made
+# them one PVC at a time.  decide_one() makes those checks for one PVC without NumPy, as the
+# reference plan() is checked against.  This has no I/O and doesn't import helpers, so it
+# can be run, checked and benchmarked on its own (see benchmarks/decisions.py).
+##########################################################################################
+import math
+import numpy
+
+# What we decided to do with each PVC, in the order we check for them.  Only RESIZE resizes it
+BELOW_THRESHOLD = 0        # It isn't in alert, so its alert intervals are reset
+WAITING_FOR_INTERVALS = 1  # It's in alert, but hasn't been for scale_after_intervals yet
+COOLING_DOWN = 2           # It's in alert long enough, but it was resized within scale_cooldown_time
+INVALID_SIZE = 3           # We would resize it smaller than it is, eg: scale_up_max_size is too small
+AT_MAX_SIZE = 4            # It's already at scale_up_max_size
+IGNORED = 5                # It has the ignore annotation
+DEBOUNCED = 6              # We already resized it within recent intervals
+RESIZE = 7                 # Resize it to resize_to_bytes
+ACTION_NAMES = ['below_threshold', 'waiting_for_intervals', 'cooling_down', 'invalid_size', 'at_max_size', 'ignored', 'debounced', 'resize']
+
+# The columns we decide from, and their types.  Usage we don't know is -1.  Those in RECORD_COLUMNS are read from the keys
+# of the same names of our PVC records, the rest come from Prometheus and our alert state
+COLUMN_TYPES = {
+    'volume_size_status_bytes':       numpy.int64,
+    'scale_above_percent':            numpy.int64,
+    'scale_after_intervals':          numpy.int64,
+    'scale_up_percent':               numpy.int64,
+    'scale_up_min_increment':         numpy.int64,
+    'scale_up_max_increment':         numpy.int64,
+    'scale_up_max_size':              numpy.int64,
+    'scale_cooldown_time':            numpy.int64,
+    'forecast_horizon':               numpy.int64,
+    'scale_up_growth_windows':        numpy.int64,
+    'last_resized_at':                numpy.int64,
+    'ignore':                         numpy.bool_,
+    'volume_used_percent':            numpy.int64,    # Percent of its disk space used
+    'volume_used_inode_percent':      numpy.int64,    # Percent of its inodes used, or -1
+    'volume_growth_bytes_per_second': numpy.float64,  # How fast it's filling up, or 0
+    'volume_available_bytes':         numpy.float64,  # Its bytes available, or -1
+    'alert_intervals':                numpy.int64,    # How many intervals it has been in alert before this one, or 0
+    'count_interval':                 numpy.bool_,    # Whether this counts as another interval in alert if it still is
+    'recently_resized':               numpy.bool_,    # Whether we resized it within recent intervals, for debouncing
+}
+RECORD_COLUMNS = ('volume_size_status_bytes', 'scale_above_percent', 'scale_after_intervals', 'scale_up_percent', 'scale_up_min_increment',
+                  'scale_up_max_increment', 'scale_up_max_size', 'scale_cooldown_time', 'forecast_horizon', 'scale_up_growth_windows',
+                  'last_resized_at', 'ignore')
+
+# The largest sizes and settings (either way from 0) we decide with, so adding any two of them can't overflow an int64.
+# Larger settings (eg: a scale-up-max-size annotation meant as unlimited) are clamped to this when they're parsed
+MAX_VALUE = 2**61
+
+
+# Turn lists (or arrays) of every column into arrays of the right types, all of the same length
+def to_arrays(columns):
+    arrays = {column: numpy.asarray(columns[column], dtype=column_type) for column, column_type in COLUMN_TYPES.items()}
+    lengths = set(len(array) for array in arrays.values())
+    if len(lengths) > 1:
+        raise ValueError("Every column must have one entry per PVC, got lengths {}".format(sorted(lengths)))
+    return arrays
+
+
+# How large each volume needs to be to stay below scale_above_percent for its growth windows of cooldowns at the rate it is
+# growing, or 0 if it isn't growing or isn't sized by growth.  So a fast growing volume isn't resized again every cooldown,
+# and doesn't fill up while it waits for one
+def bytes_to_last_cooldowns(arrays):
+    size = arrays['volume_size_status_bytes']
+    available = arrays['volume_available_bytes']
+    growth = arrays['volume_growth_bytes_per_second']
+    used_bytes = numpy.where(available > -1, numpy.maximum(0, size - available), size * arrays['volume_used_percent'] / 100)
+    sized = (growth > 0) & (arrays['scale_up_growth_windows'] > 0) & (arrays['scale_above_percent'] > 0)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        needed = numpy.ceil((used_bytes + growth * arrays['scale_up_growth_windows'] * arrays['scale_cooldown_time']) * 100 / arrays['scale_above_percent'])
+    return numpy.where(sized, numpy.minimum(needed, 2 * MAX_VALUE), 0).astype(numpy.int64)
+
+
+# How many bytes to resize each volume to, from its scale up percent (or growth_size if larger) limited by its minimum
+# and maximum increments and maximum size.  This is the original size if there's nothing to resize
+def bytes_to_scale_to(arrays, growth_size):
+    size = arrays['volume_size_status_bytes']
+    # Past 2 * MAX_VALUE this would overflow, clipping it there is more than any increment or maximum size lets us resize to
+    resize_to = numpy.clip(size * (0.01 * arrays['scale_up_percent']) + size, -2 * MAX_VALUE, 2 * MAX_VALUE).astype(numpy.int64)
+    resize_to = numpy.maximum(resize_to, growth_size)
+    resize_to = numpy.where(resize_to - size < arrays['scale_up_min_increment'], size + arrays['scale_up_min_increment'], resize_to)
+    resize_to = numpy.where(resize_to - size > arrays['scale_up_max_increment'], size + arrays['scale_up_max_increment'], resize_to)
+    return numpy.minimum(resize_to, arrays['scale_up_max_size'])
+
+
+# Decide what to do with every PVC.  now is the time to compare last_resized_at against, and forecast_enabled is whether
+# volumes forecast to be full within their forecast_horizon are in alert (and don't wait for scale_after_intervals).
+# Returns a dict of arrays with one entry per PVC: its action, its alert_intervals including this one (0 if it isn't in
+# alert), why it is in alert (space_alert, inode_alert, forecast_alert), seconds_until_full (or -1), growth_size (or 0)
+# and resize_to_bytes
+def plan(columns, now, forecast_enabled=False):
+    arrays = to_arrays(columns)
+    above_percent = arrays['scale_above_percent']
+
+    # Which volumes are in alert, and why
+    space_alert = arrays['volume_used_percent'] >= above_percent
+    inode_alert = arrays['volume_used_inode_percent'] >= above_percent
+    growth = arrays['volume_growth_bytes_per_second']
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        seconds_until_full = numpy.where(growth > 0, arrays['volume_available_bytes'] / growth, -1)
+    seconds_until_full = numpy.where((growth > 0) & (arrays['volume_available_bytes'] > -1), numpy.trunc(seconds_until_full), -1).astype(numpy.int64)
+    forecast_alert = (seconds_until_full > -1) & (seconds_until_full < arrays['forecast_horizon']) if forecast_enabled else numpy.zeros(len(above_percent), dtype=bool)
+    in_alert = space_alert | inode_alert | forecast_alert
+
+    # Count this interval in alert, starting from 1, or reset it if it's not in alert
+    previous = arrays['alert_intervals']
+    alert_intervals = numpy.where(in_alert, numpy.where(previous > 0, previous + arrays['count_interval'], 1), 0)
+
+    growth_size = bytes_to_last_cooldowns(arrays)
+    resize_to_bytes = bytes_to_scale_to(arrays, growth_size)
+    size = arrays['volume_size_status_bytes']
+
+    # Our checks in order, the first one which applies to a volume is what we decide for it
+    conditions = [
+        ~in_alert,
+        ~forecast_alert & (alert_intervals < arrays['scale_after_intervals']),
+        arrays['last_resized_at'] + arrays['scale_cooldown_time'] >= now,
+        resize_to_bytes < size,
+        resize_to_bytes == size,
+        arrays['ignore'],
+        arrays['recently_resized'],
+    ]
+    action = numpy.select(conditions, [BELOW_THRESHOLD, WAITING_FOR_INTERVALS, COOLING_DOWN, INVALID_SIZE, AT_MAX_SIZE, IGNORED, DEBOUNCED], default=RESIZE)
+
+    return {
+        'action': action,
+        'alert_intervals': alert_intervals,
+        'space_alert': space_alert,
+        'inode_alert': inode_alert,
+        'forecast_alert': forecast_alert,
+        'seconds_until_full': seconds_until_full,
+        'growth_size': growth_size,
+        'resize_to_bytes': resize_to_bytes,
+    }
+
+
+# Decide what to do with one PVC, given a dict of its columns, the same as plan() but one PVC at a time in plain Python.
+# Returns (action, alert_intervals, resize_to_bytes), where resize_to_bytes is None if we didn't get as far as sizing it
+def decide_one(row, now, forecast_enabled=False):
+    seconds_until_full = -1
+    if row['volume_growth_bytes_per_second'] > 0 and row['volume_available_bytes'] > -1:
+        seconds_until_full = int(row['volume_available_bytes'] / row['volume_growth_bytes_per_second'])
+    forecast_alert = forecast_enabled and -1 < seconds_until_full < row['forecast_horizon']
+    if not forecast_alert and row['volume_used_percent'] < row['scale_above_percent'] and row['volume_used_inode_percent'] < row['scale_above_percent']:
+        return BELOW_THRESHOLD, 0, None
+
+    alert_intervals = 1
+    if row['alert_intervals']:
+        alert_intervals = row['alert_intervals'] + (1 if row['count_interval'] else 0)
+    if not forecast_alert and alert_intervals < row['scale_after_intervals']:
+        return WAITING_FOR_INTERVALS, alert_intervals, None
+    if row['last_resized_at'] + row['scale_cooldown_time'] >= now:
+        return COOLING_DOWN, alert_intervals, None
+
+    # How large it needs to be to last its growth windows, see bytes_to_last_cooldowns
+    growth_size = 0
+    if row['scale_up_growth_windows'] > 0 and row['volume_growth_bytes_per_second'] > 0 and row['scale_above_percent'] > 0:
+        if row['volume_available_bytes'] > -1:
+            used_bytes = max(0, row['volume_size_status_bytes'] - row['volume_available_bytes'])
+        else:
+            used_bytes = row['volume_size_status_bytes'] * row['volume_used_percent'] / 100
+        growth_size = math.ceil((used_bytes + row['volume_growth_bytes_per_second'] * row['scale_up_growth_windows'] * row['scale_cooldown_time']) * 100 / row['scale_above_percent'])
+
+    # How many bytes to resize it to, see bytes_to_scale_to
+    size = row['volume_size_status_bytes']
+    resize_to = int((size * (0.01 * row['scale_up_percent'])) + size)
+    if resize_to < growth_size:
+        resize_to = int(growth_size)
+    if resize_to - size < row['scale_up_min_increment']:
+        resize_to = size + row['scale_up_min_increment']
+    if resize_to - size > row['scale_up_max_increment']:
+        resize_to = size + row['scale_up_max_increment']
+    if resize_to > row['scale_up_max_size']:
+        resize_to = row['scale_up_max_size']
+
+    if resize_to < size:
+        return INVALID_SIZE, alert_intervals, resize_to
+    if resize_to == size:
+        return AT_MAX_SIZE, alert_intervals, resize_to
+    if row['ignore']:
+        return IGNORED, alert_intervals, resize_to
+    if row['recently_resized']:
+        return DEBOUNCED, alert_intervals, resize_to
+    return RESIZE, alert_intervals, resize_to
@@ -19,6 +19,8 @@ tar -C $TMPFOLDER/charts/deployment/templates -hcf - ./ > $TMPFOLDER/stripped.ta
 tar -C ./templates -xf $TMPFOLDER/stripped.tar
 # cp -L -a $TMPFOLDER/charts/deployment/templates/* ./templates/
 cp -a $TMPFOLDER/charts/deployment/values.yaml ./values.yaml.upstream
+# Then add our own templates on top of the upstream ones
+cp -a ./extra-templates/* ./templates/
 
 # Remove cloned folder
 rm -Rf $TMPFOLDER
@@ -1,14 +1,31 @@
 from os import getenv          # Environment variable handling
 import time                    # Sleep/time
 import datetime
+import json
 import requests                # For making HTTP requests to Prometheus
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 import kubernetes              # For talking to the Kubernetes API
+import yaml                    # For reading our CLUSTERS_CONFIG
 from kubernetes.client import ApiException
 from packaging import version  # For checking if prometheus version is new enough to use a new function present_over_time()
 import signal                  # For sigkill handling
-import random                  # Random string generation
+import sys
+import threading               # For our background PVC informer and resize workers
+import asyncio                 # For overlapping our requests to Kubernetes and Prometheus
+import contextvars             # For knowing which cluster we're working on, in every thread working on it
+import collections
+import contextlib
+import heapq                  # For expiring our cache keys in order
+import functools               # For memoizing our storage size conversions
+import fractions               # For exact math converting storage sizes
+import math
+import re
+import hashlib                 # For naming our events consistently per PVC and reason
 import traceback               # Debugging/trace outputs
 import slack                   # For sending slack messages
+import decisions               # For the largest settings we can decide with
+from prometheus_client import Histogram, Counter, Gauge
 
 # Used below in init variables
 def detectPrometheusURL():
@@ -33,7 +50,8 @@ SCALE_UP_MIN_INCREMENT = int(getenv('SCALE_UP_MIN_INCREMENT') or 1000000000)
 SCALE_UP_MAX_INCREMENT = int(getenv('SCALE_UP_MAX_INCREMENT') or 16000000000000) # How many bytes is the maximum that we can resize up by, default is 16TB (in bytes, so 16000000000000)
 SCALE_UP_MAX_SIZE = int(getenv('SCALE_UP_MAX_SIZE') or 16000000000000)           # How many bytes is the maximum disk size that we can resize up, default is 16TB for EBS volumes in AWS (in bytes, so 16000000000000)
 SCALE_COOLDOWN_TIME = int(getenv('SCALE_COOLDOWN_TIME') or 22200)                # How long (in seconds) we must wait before scaling this volume again.  For AWS EBS, this is 6 hours which is 21600 seconds but for good measure we add an extra 10 minutes to this, so 22200
-PROMETHEUS_URL = getenv('PROMETHEUS_URL') or detectPrometheusURL()               # Where prometheus is, if not provided it can auto-detect it if it's in the same namespace as us
+CLUSTERS_CONFIG = getenv('CLUSTERS_CONFIG') or ''                                # A YAML file of the clusters (kubeconfig contexts) to manage, each with its Prometheus, instead of only the cluster we run in
+PROMETHEUS_URL = getenv('PROMETHEUS_URL') or ('' if CLUSTERS_CONFIG else detectPrometheusURL()) # Where prometheus is, if not provided it can auto-detect it if it's in the same namespace as us
 DRY_RUN = True if getenv('DRY_RUN', "false").lower() == "true" else False        # If we want to dry-run this
 PROMETHEUS_LABEL_MATCH = getenv('PROMETHEUS_LABEL_MATCH') or ''                  # A PromQL label query to restrict volumes for this to see and scale, without braces.  eg: 'namespace="dev"'
 HTTP_TIMEOUT = int(getenv('HTTP_TIMEOUT', "15")) or 15                           # Allows to set the timeout for calls to Prometheus and Kubernetes.  This might be needed if your Prometheus or Kubernetes is over a remote WAN link with high latency and/or is heavily loaded
@@ -41,6 +59,23 @@ PROMETHEUS_VERSION = "0.0.0"
 VERBOSE = True if getenv('VERBOSE', "false").lower() == "true" else False        # If we want to verbose mode
 VICTORIAMETRICS_COMPAT = True if getenv('VICTORIAMETRICS_MODE', "false").lower() == "true" else False # Whether to skip the prometheus check and assume victoriametrics
 SCOPE_ORGID_AUTH_HEADER = getenv('SCOPE_ORGID_AUTH_HEADER') or ''                # If we want to use Mimir or AgentMode which requires an orgid header.  See: https://grafana.com/docs/mimir/latest/references/http-api/#authentication
+PVC_WATCH_ENABLED = False if getenv('PVC_WATCH_ENABLED', "true").lower() == "false" else True # If we want to keep an in-memory PVC index updated via a Kubernetes watch, instead of listing every PVC every interval
+PVC_WATCH_TIMEOUT = int(getenv('PVC_WATCH_TIMEOUT') or 300)                      # How long (in seconds) each watch request to Kubernetes stays open before we re-open it from the last resourceVersion
+PVC_LIST_PAGE_SIZE = int(getenv('PVC_LIST_PAGE_SIZE') or 500)                    # How many PVCs to request per page when listing all PVCs, this bounds how much memory a full list takes
+EVENT_SERIES_TTL = int(getenv('EVENT_SERIES_TTL') or 3600)                      # How long (in seconds) we remember an event we sent so a repeat of it updates its series count instead of creating a new event.  Kubernetes keeps events for 1 hour by default
+RESIZE_CONCURRENCY = int(getenv('RESIZE_CONCURRENCY') or 4)                      # How many volumes we resize in parallel (each resize is an event, a patch, and possibly a Slack message)
+CACHE_MAX_SIZE = int(getenv('CACHE_MAX_SIZE') or 100000)                         # The maximum number of keys we keep in each in-memory cache, the least recently used are evicted past this
+PROMETHEUS_RETRIES = int(getenv('PROMETHEUS_RETRIES') or 3)                       # How many times to retry a request to Prometheus which failed to connect or returned a 429 or 5xx
+PROMETHEUS_RETRY_BACKOFF = float(getenv('PROMETHEUS_RETRY_BACKOFF') or 0.5)      # The backoff factor (in seconds) between retries to Prometheus, doubled every retry.  A Retry-After header from Prometheus takes precedence
+PROMETHEUS_POOL_SIZE = int(getenv('PROMETHEUS_POOL_SIZE') or 4)                   # How many keep-alive connections to Prometheus we keep open for re-use
+PROMETHEUS_FILTER_BY_THRESHOLD = False if getenv('PROMETHEUS_FILTER_BY_THRESHOLD', "true").lower() == "false" else True # If we want Prometheus to only return PVCs at or above the lowest scale-above-percent, instead of every PVC.  This is always disabled in VERBOSE mode so we can print every volume
+FORECAST_ENABLED = True if getenv('FORECAST_ENABLED', "false").lower() == "true" else False # If we want to also scale volumes forecast to be full within FORECAST_HORIZON seconds, without waiting SCALE_AFTER_INTERVALS
+FORECAST_HORIZON = int(getenv('FORECAST_HORIZON') or 3600)                         # How soon (in seconds) a volume must be forecast to be full before we scale it, when forecasting
+FORECAST_LOOKBACK = int(getenv('FORECAST_LOOKBACK') or 1800)                       # How far back (in seconds) we look at how fast each volume is filling up, to forecast when it will be full
+ADAPTIVE_SCHEDULING_ENABLED = True if getenv('ADAPTIVE_SCHEDULING_ENABLED', "false").lower() == "true" else False # If we want to check each PVC on its own schedule, sooner the closer it is to scaling, instead of every PVC every INTERVAL_TIME
+ADAPTIVE_MIN_INTERVAL = int(getenv('ADAPTIVE_MIN_INTERVAL') or 10)                 # How often (in seconds) we check the PVCs closest to scaling, when scheduling adaptively
+ADAPTIVE_MAX_INTERVAL = int(getenv('ADAPTIVE_MAX_INTERVAL') or 600)                # How often (in seconds) we check the PVCs furthest from scaling, when scheduling adaptively
+SCALE_UP_GROWTH_WINDOWS = int(getenv('SCALE_UP_GROWTH_WINDOWS') or 0)              # If set, scale up by enough that a volume growing at its rate over FORECAST_LOOKBACK stays below SCALE_ABOVE_PERCENT for this many SCALE_COOLDOWN_TIMEs (if that is more than SCALE_UP_PERCENT).  0 disables this
 
 
 # Simple helper to pass back
@@ -60,6 +95,23 @@ def get_settings_for_prometheus_metrics():
         'prometheus_version_detected': PROMETHEUS_VERSION,
         'http_timeout_seconds': str(HTTP_TIMEOUT),
         'verbose_enabled': "true" if VERBOSE else "false",
+        'pvc_watch_enabled': "true" if PVC_WATCH_ENABLED else "false",
+        'pvc_watch_timeout_seconds': str(PVC_WATCH_TIMEOUT),
+        'pvc_list_page_size': str(PVC_LIST_PAGE_SIZE),
+        'event_series_ttl_seconds': str(EVENT_SERIES_TTL),
+        'resize_concurrency': str(RESIZE_CONCURRENCY),
+        'prometheus_retries': str(PROMETHEUS_RETRIES),
+        'prometheus_retry_backoff_seconds': str(PROMETHEUS_RETRY_BACKOFF),
+        'prometheus_pool_size': str(PROMETHEUS_POOL_SIZE),
+        'prometheus_filter_by_threshold': "true" if PROMETHEUS_FILTER_BY_THRESHOLD and not VERBOSE else "false",
+        'forecast_enabled': "true" if FORECAST_ENABLED else "false",
+        'forecast_horizon_seconds': str(FORECAST_HORIZON),
+        'forecast_lookback_seconds': str(FORECAST_LOOKBACK),
+        'scale_up_growth_windows': str(SCALE_UP_GROWTH_WINDOWS),
+        'adaptive_scheduling_enabled': "true" if ADAPTIVE_SCHEDULING_ENABLED else "false",
+        'adaptive_min_interval_seconds': str(ADAPTIVE_MIN_INTERVAL),
+        'adaptive_max_interval_seconds': str(ADAPTIVE_MAX_INTERVAL),
+        'clusters_config': CLUSTERS_CONFIG,
     }
 
 # Set headers if desired from above
@@ -67,6 +119,93 @@ headers = {}
 if len(SCOPE_ORGID_AUTH_HEADER) > 0:
     headers['X-Scope-OrgID'] = SCOPE_ORGID_AUTH_HEADER
 
+# Metrics for our outbound HTTP requests, these are published along with the ones in main.py
+HTTP_METRICS = {}
+HTTP_METRICS['request_duration']    = Histogram('volume_autoscaler_http_request_duration_seconds', 'Histogram of how long our outbound HTTP requests took, including retries', ['target', 'cluster'])
+HTTP_METRICS['requests']            = Counter('volume_autoscaler_http_requests',            'Counter which is increased every time we make an outbound HTTP request', ['target', 'cluster'])
+HTTP_METRICS['connections_opened']  = Counter('volume_autoscaler_http_connections_opened',  'Counter which is increased every time we open a new connection for an outbound HTTP request instead of re-using one', ['target', 'cluster'])
+
+# Metrics for our in-memory caches, by the name of the cache
+CACHE_METRICS = {}
+CACHE_METRICS['hits']                = Counter('volume_autoscaler_cache_hits',                'Counter which is increased every time we read a key from a cache which was present', ['cache', 'cluster'])
+CACHE_METRICS['misses']              = Counter('volume_autoscaler_cache_misses',              'Counter which is increased every time we read a key from a cache which was missing or expired', ['cache', 'cluster'])
+CACHE_METRICS['evictions']           = Counter('volume_autoscaler_cache_evictions',           'Counter which is increased every time a key is removed from a cache because it expired or the cache was full', ['cache', 'reason', 'cluster'])
+CACHE_METRICS['size']                = Gauge('volume_autoscaler_cache_size',                  'The number of keys currently in a cache', ['cache', 'cluster'])
+
+# An HTTPAdapter which counts every connection its pools open (including re-opening one which was dropped) as it connects,
+# in connections_opened.  Requests running at the same time (eg: our concurrent queries) can each open one, so we count
+# them where they're opened rather than by how many a request's pool grew while it ran
+class ConnectionCountingAdapter(HTTPAdapter):
+    def __init__(self, connections_opened, **kwargs):
+        self.connections_opened = connections_opened
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.count_connections(self.poolmanager)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+        self.count_connections(manager)
+        return manager
+
+    # Have a pool manager create pools whose connections count themselves when they connect
+    def count_connections(self, manager):
+        if getattr(manager, 'counting_connections', False):
+            return
+        connections_opened = self.connections_opened
+        pool_classes = {}
+        for scheme, pool_class in manager.pool_classes_by_scheme.items():
+            class CountingConnection(pool_class.ConnectionCls):
+                def connect(self):
+                    super().connect()
+                    connections_opened.inc()
+            pool_classes[scheme] = type(pool_class.__name__, (pool_class,), {'ConnectionCls': CountingConnection})
+        manager.pool_classes_by_scheme = pool_classes
+        manager.counting_connections = True
+
+# Setup one shared session for all our requests to a cluster's Prometheus.  This keeps connections (and TLS sessions) alive
+# and pooled between queries, asks for gzipped responses, and retries with a backoff on connection errors, 429s and 5xxs
+def create_prometheus_session(cluster=""):
+    session = requests.Session()
+    retries = Retry(
+        total=PROMETHEUS_RETRIES,
+        backoff_factor=PROMETHEUS_RETRY_BACKOFF,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET", "POST"],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = ConnectionCountingAdapter(HTTP_METRICS['connections_opened'].labels('prometheus', cluster), pool_connections=1, pool_maxsize=PROMETHEUS_POOL_SIZE, max_retries=retries)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update(headers)
+    session.headers['Accept-Encoding'] = 'gzip'
+    return session
+
+# Record how long an outbound request to a target (prometheus, kubernetes or slack) took, even if it raised
+@contextlib.contextmanager
+def record_http_request(target):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_http_request(target, time.perf_counter() - started)
+
+def observe_http_request(target, seconds):
+    HTTP_METRICS['request_duration'].labels(target, get_cluster().name).observe(seconds)
+    HTTP_METRICS['requests'].labels(target, get_cluster().name).inc()
+
+# Make a request to Prometheus through our shared session, recording how long it took.  Our session counts the connections
+# it opens itself
+def prometheus_request(method, url, params=None, data=None):
+    with record_http_request('prometheus'):
+        return get_cluster().prometheus_session.request(method, url, params=params, data=data, timeout=HTTP_TIMEOUT)
+
+def prometheus_get(url, params=None):
+    return prometheus_request('GET', url, params=params)
+
+
 # This handler helps handle sigint/term gracefully (not in the middle of an runloop)
 class GracefulKiller:
   kill_now = False
@@ -78,37 +217,317 @@ class GracefulKiller:
     self.kill_now = True
 
 
-# Setup a cache helper for caching and expiring things with TTLs, used for debouncing
+# Besides its alert intervals under its volume description ("<namespace>.<name>"), we keep these keys about each volume in
+# our cache: when we last counted an alert interval for it, and that we recently resized it
+VOLUME_CACHE_KEY_SUFFIXES = ("-alert-counted-at", "-has-been-resized")
+
+
+# The namespace and name of the PVC a key of our cache is about
+def get_pvc_of_cache_key(key):
+    for suffix in VOLUME_CACHE_KEY_SUFFIXES:
+        if key.endswith(suffix):
+            key = key[:-len(suffix)]
+            break
+    namespace, _, name = key.partition('.')
+    return namespace, name
+
+
+# Setup a cache helper for caching and expiring things with TTLs, used for debouncing.  Keys ending in one of pinned_suffixes
+# (eg: our resize debounces) are only ever removed when they expire, never evicted to make room, as losing one early could
+# resize a volume twice
 class Cache:
-    def __init__(self, ttl=60):
+    def __init__(self, ttl=60, max_size=CACHE_MAX_SIZE, name="cache", cluster="", pinned_suffixes=()):
         self.ttl = ttl
-        self.cache = {}
+        self.max_size = max_size
+        self.name = name
+        self.cluster = cluster
+        self.pinned_suffixes = tuple(pinned_suffixes)
+        self.warned_full = False
+        self.lock = threading.RLock()
+        self.reset()
 
     def set(self, key, value, ttl=False):
         expiration = time.time() + self.ttl
         if ttl != False:
             expiration = time.time() + ttl
-        self.cache[key] = (value, expiration)
+        with self.lock:
+            self.expire()
+            self.cache[key] = (value, expiration)
+            self.cache.move_to_end(key)
+            self.push_expiration(key, expiration)
+            self.evict()
+            CACHE_METRICS['size'].labels(self.name, self.cluster).set(len(self.cache))
 
     def get(self, key):
-        if key in self.cache:
-            value, expiration = self.cache[key]
-            if time.time() < expiration:
-                return value
-            else:
-                del self.cache[key]
-        return None
+        with self.lock:
+            self.expire()
+            if key in self.cache:
+                value, expiration = self.cache[key]
+                if time.time() < expiration:
+                    self.cache.move_to_end(key)
+                    CACHE_METRICS['hits'].labels(self.name, self.cluster).inc()
+                    return value
+                else:
+                    del self.cache[key]
+                    CACHE_METRICS['evictions'].labels(self.name, 'expired', self.cluster).inc()
+                    CACHE_METRICS['size'].labels(self.name, self.cluster).set(len(self.cache))
+            CACHE_METRICS['misses'].labels(self.name, self.cluster).inc()
+            return None
 
     def unset(self, key):
-        if key in self.cache:
-            del self.cache[key]
+        with self.lock:
+            if key in self.cache:
+                del self.cache[key]
+                CACHE_METRICS['size'].labels(self.name, self.cluster).set(len(self.cache))
 
     def reset(self):
-        self.cache = {}
-
-# Note: We want the TTL time to be 10x the interval time by default to ensure items in it
-#       last through a few intervals incase of jitter and for debouncing volume changes
-cache = Cache(ttl=INTERVAL_TIME * 10)
+        with self.lock:
+            # Our keys in least-recently-used order, and a heap of (expiration, sequence, key) to sweep them in expiry order.
+            # Setting or removing a key leaves its old heap entry behind, those are skipped (and compacted) when we get to them
+            self.cache = collections.OrderedDict()
+            self.expirations = []
+            self.sequence = 0
+            CACHE_METRICS['size'].labels(self.name, self.cluster).set(0)
+
+    # Everything which hasn't expired, as {key: [value, expiration]}, expirations are unix timestamps so they survive restarts
+    def dump(self):
+        with self.lock:
+            self.expire()
+            return {key: [value, expiration] for key, (value, expiration) in self.cache.items()}
+
+    # Restore what dump() returned, skipping anything which expired since
+    def load(self, entries):
+        now = time.time()
+        for key, (value, expiration) in entries.items():
+            if expiration > now:
+                self.set(key, value, ttl=expiration - now)
+
+    # Evict the least recently used keys which aren't pinned while we're over our maximum size.  Pinned keys we pass over are
+    # moved to the end, so we don't look at them again every time we evict.  If only pinned keys are left we keep them all
+    def evict(self):
+        if len(self.cache) < self.max_size:
+            self.warned_full = False
+        if len(self.cache) <= self.max_size:
+            return
+        evicted = 0
+        skipped = 0
+        while len(self.cache) > self.max_size and skipped < len(self.cache):
+            key = next(iter(self.cache))
+            if self.pinned_suffixes and key.endswith(self.pinned_suffixes):
+                self.cache.move_to_end(key)
+                skipped += 1
+                continue
+            del self.cache[key]
+            evicted += 1
+            CACHE_METRICS['evictions'].labels(self.name, 'size', self.cluster).inc()
+        # Warn once each time we fill up (until keys expire and we have room again), as we're evicting keys which were still in
+        # use and CACHE_MAX_SIZE may be too small
+        if not self.warned_full:
+            self.warned_full = True
+            print("WARNING: The {} cache{} is full at {} keys (CACHE_MAX_SIZE is {}), evicted {} least recently used key(s) to make room{}".format(
+                self.name, " of cluster {}".format(self.cluster) if self.cluster else "", len(self.cache), self.max_size, evicted,
+                ", passing over {} key(s) which are never evicted".format(skipped) if skipped else ""))
+
+    def push_expiration(self, key, expiration):
+        self.sequence += 1
+        heapq.heappush(self.expirations, (expiration, self.sequence, key))
+        # If most of our heap is stale entries (eg: a key re-set every interval), rebuild it from what's actually cached
+        if len(self.expirations) > 2 * len(self.cache) + 64:
+            self.expirations = [(expiration, sequence, key) for sequence, (key, (value, expiration)) in enumerate(self.cache.items())]
+            heapq.heapify(self.expirations)
+            self.sequence = len(self.expirations)
+
+    # Remove everything which has expired, so keys which are never read again (eg: from deleted PVCs) don't stay forever
+    def expire(self):
+        now = time.time()
+        while self.expirations and self.expirations[0][0] <= now:
+            expiration, sequence, key = heapq.heappop(self.expirations)
+            if key in self.cache and self.cache[key][1] == expiration:
+                del self.cache[key]
+                CACHE_METRICS['evictions'].labels(self.name, 'expired', self.cluster).inc()
+        CACHE_METRICS['size'].labels(self.name, self.cluster).set(len(self.cache))
+
+
+# Runs resize actions on a pool of worker threads, so one slow resize doesn't hold up every other volume behind it.
+# Work is queued per-namespace and handed out round-robin, so a namespace with many volumes can't starve the others.
+# Each key (volume) can only be queued or running once at a time
+class ResizeExecutor:
+    def __init__(self, concurrency=RESIZE_CONCURRENCY):
+        self.queues = collections.OrderedDict()
+        self.pending = set()
+        self.stopping = False
+        self.condition = threading.Condition()
+        self.workers = []
+        for number in range(max(1, concurrency)):
+            worker = threading.Thread(target=contextvars.copy_context().run, args=(self.work,), name="resize-worker-{}".format(number), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    # Queue a function to run for a key in a namespace, returns False if that key is already queued or running
+    def submit(self, namespace, key, function, *args, **kwargs):
+        with self.condition:
+            if self.stopping or key in self.pending:
+                return False
+            self.pending.add(key)
+            self.queues.setdefault(namespace, collections.deque()).append((key, function, args, kwargs))
+            self.condition.notify()
+            return True
+
+    def is_pending(self, key):
+        with self.condition:
+            return key in self.pending
+
+    # Take the next task from the namespace which has waited the longest, then put that namespace at the back of the line
+    def next_task(self):
+        namespace, queue = self.queues.popitem(last=False)
+        task = queue.popleft()
+        if queue:
+            self.queues[namespace] = queue
+        return task
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.queues and not self.stopping:
+                    self.condition.wait()
+                if not self.queues:
+                    return
+                key, function, args, kwargs = self.next_task()
+            try:
+                function(*args, **kwargs)
+            except Exception:
+                print("Exception caught while running resize for {}".format(key))
+                traceback.print_exc()
+            finally:
+                with self.condition:
+                    self.pending.discard(key)
+
+    # Stop accepting work, and wait for everything already queued or running to finish
+    def shutdown(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join()
+
+
+# Decides when each PVC is next due to have its usage checked, when scheduling adaptively.  PVCs close to (or above) their
+# scale-above-percent, or filling up quickly, are checked every min_interval seconds and idle ones only every max_interval
+# seconds.  Keeps a heap of (next check, sequence, volume), rescheduling a volume leaves its old entry behind to be skipped
+class PVCScheduler:
+    def __init__(self, min_interval=ADAPTIVE_MIN_INTERVAL, max_interval=ADAPTIVE_MAX_INTERVAL):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        # If we don't hear about a volume we checked, eg: Prometheus failed, check it again as if we were on a fixed interval
+        self.retry_interval = min(max(INTERVAL_TIME, self.min_interval), self.max_interval)
+        self.next_checks = {}
+        self.heap = []
+        self.sequence = 0
+        self.synced_at = 0
+
+    def schedule(self, volume_description, delay, now=None):
+        next_check = (now or time.time()) + delay
+        self.next_checks[volume_description] = next_check
+        self.sequence += 1
+        heapq.heappush(self.heap, (next_check, self.sequence, volume_description))
+        # If most of our heap is stale entries, rebuild it from our actual next checks
+        if len(self.heap) > 2 * len(self.next_checks) + 64:
+            self.heap = [(next_check, sequence, volume_description) for sequence, (volume_description, next_check) in enumerate(self.next_checks.items())]
+            heapq.heapify(self.heap)
+            self.sequence = len(self.heap)
+
+    # Schedule any new volumes to be checked right away, and forget the ones which no longer exist
+    def sync(self, volume_descriptions, now=None):
+        now = now or time.time()
+        for volume_description in volume_descriptions:
+            if volume_description not in self.next_checks:
+                self.schedule(volume_description, 0, now)
+        for volume_description in [volume_description for volume_description in self.next_checks if volume_description not in volume_descriptions]:
+            del self.next_checks[volume_description]
+        self.synced_at = now
+
+    # Every volume due to be checked by now, each is rescheduled at our retry_interval until it's rescheduled by its usage
+    def pop_due(self, now=None):
+        now = now or time.time()
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            next_check, sequence, volume_description = heapq.heappop(self.heap)
+            if self.next_checks.get(volume_description) == next_check:
+                due.append(volume_description)
+        for volume_description in due:
+            self.schedule(volume_description, self.retry_interval, now)
+        return due
+
+    # When we next have a volume due, or need to sync to find new volumes, whichever is sooner
+    def next_due_at(self):
+        next_due = self.synced_at + self.max_interval
+        while self.heap and self.next_checks.get(self.heap[0][2]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        if self.heap:
+            next_due = min(next_due, self.heap[0][0])
+        return next_due
+
+    # How long until we should check a volume again, from its usage (and growth and forecast if we have them).  Volumes in
+    # alert are checked every INTERVAL_TIME, since that's how often we count their alert intervals.  Volumes below it are
+    # checked sooner the closer they are to scale_above_percent, and at least twice before they're expected to reach it
+    def get_next_check_delay(self, pvc):
+        if pvc['ignore']:
+            return self.max_interval
+        used_percent = max(pvc.get('volume_used_percent', 0), pvc.get('volume_used_inode_percent', -1))
+        if used_percent >= pvc['scale_above_percent']:
+            return self.retry_interval
+        headroom = (pvc['scale_above_percent'] - used_percent) / max(1, pvc['scale_above_percent'])
+        delay = self.min_interval + (self.max_interval - self.min_interval) * headroom ** 2
+        growth = pvc.get('volume_growth_bytes_per_second', 0)
+        if growth > 0:
+            delay = min(delay, (pvc['scale_above_percent'] - used_percent) / 100 * pvc['volume_size_status_bytes'] / growth / 2)
+        if FORECAST_ENABLED and pvc.get('volume_seconds_until_full', -1) > -1:
+            delay = min(delay, (pvc['volume_seconds_until_full'] - pvc['forecast_horizon']) / 2)
+        return min(max(delay, self.min_interval), self.max_interval)
+
+
+# The longest namespace regex we put in one Prometheus query when scheduling adaptively, our queries are sent as URLs
+PROMETHEUS_MAX_NAMESPACE_REGEX_LENGTH = 2000
+# Selecting PVCs by name makes for longer label matches, which we send in the body of a POST instead of the URL
+PROMETHEUS_MAX_PVC_REGEX_LENGTH = 20000
+PROMETHEUS_MAX_GET_QUERY_LENGTH = 4000
+
+# The label matches to query Prometheus for only the PVCs in these namespaces, as few as we can while keeping each
+# query's namespace regex under max_length.  If that's every namespace we know of, we don't need to match any
+def build_namespace_label_matches(namespaces, all_namespaces=None, label_match=PROMETHEUS_LABEL_MATCH, max_length=PROMETHEUS_MAX_NAMESPACE_REGEX_LENGTH):
+    if all_namespaces is not None and set(namespaces) >= set(all_namespaces):
+        return [label_match]
+    batches = [[]]
+    length = 0
+    for namespace in sorted(namespaces):
+        if batches[-1] and length + len(namespace) + 1 > max_length:
+            batches.append([])
+            length = 0
+        batches[-1].append(namespace)
+        length += len(namespace) + 1
+    prefix = label_match + ", " if label_match.strip() else ""
+    return ['{}namespace=~"{}"'.format(prefix, "|".join(batch)) for batch in batches if batch]
+
+
+# The label matches to query Prometheus for only these PVCs (eg: our shard of them), as few as we can while keeping the
+# regexes of each query's namespaces and names under max_length.  Each of these may also match a few PVCs of the same
+# names in other namespaces of the same query, so filter out any PVCs we don't know of from what they return
+def build_pvc_label_matches(pvcs, label_match=PROMETHEUS_LABEL_MATCH, max_length=PROMETHEUS_MAX_PVC_REGEX_LENGTH):
+    batches = [(set(), set())]
+    length = 0
+    for pvc in sorted(pvcs, key=lambda pvc: (pvc['namespace'], pvc['name'])):
+        namespaces, names = batches[-1]
+        added = (len(pvc['namespace']) + 1 if pvc['namespace'] not in namespaces else 0) + (len(pvc['name']) + 1 if pvc['name'] not in names else 0)
+        if names and length + added > max_length:
+            batches.append((set(), set()))
+            namespaces, names = batches[-1]
+            length = 0
+            added = len(pvc['namespace']) + len(pvc['name']) + 2
+        namespaces.add(pvc['namespace'])
+        names.add(pvc['name'])
+        length += added
+    prefix = label_match + ", " if label_match.strip() else ""
+    return ['{}namespace=~"{}", persistentvolumeclaim=~"{}"'.format(prefix, "|".join(sorted(namespaces)), "|".join(sorted(names))) for namespaces, names in batches if names]
 
 
 #############################
@@ -122,22 +541,104 @@ except Exception as e:
         # If we aren't running in kubernetes, try to use the kubectl config file as a fallback
         kubernetes.config.load_kube_config()
     except Exception as ex:
-        raise ex
-kubernetes_core_api  = kubernetes.client.CoreV1Api()
+        # With CLUSTERS_CONFIG every cluster we manage comes from a context in our kubeconfig, we may not have a default one
+        if not CLUSTERS_CONFIG:
+            raise ex
+
+# Who we report our events as.  In Kubernetes our hostname is our pod name, which identifies which instance sent an event
+EVENT_REPORTING_CONTROLLER = "volume-autoscaler"
+EVENT_REPORTING_INSTANCE = (getenv('HOSTNAME') or EVENT_REPORTING_CONTROLLER)[:128]
+
+
+# Everything we keep per cluster we manage: how we talk to its Kubernetes API and its Prometheus, and our caches of its
+# PVCs.  Without CLUSTERS_CONFIG we only manage one, the cluster we run in (or our kubeconfig's current context) with the
+# Prometheus at PROMETHEUS_URL, whose name is empty.  With it, each is named and labelled as such in our metrics
+class Cluster:
+    def __init__(self, name="", prometheus_url=PROMETHEUS_URL, api_client=None):
+        self.name = name
+        self.prometheus_url = prometheus_url
+        self.prometheus_version = PROMETHEUS_VERSION
+        self.prometheus_session = create_prometheus_session(name)
+        self.api_client = api_client
+        self.kubernetes_core_api = kubernetes.client.CoreV1Api(api_client)
+        self.kubernetes_events_api = kubernetes.client.EventsV1Api(api_client)
+        # How many intervals each volume has been in alert, and which we recently resized.  We want the TTL time to be 10x the
+        # interval time by default to ensure items in it last through a few intervals incase of jitter and for debouncing volume changes
+        self.cache = Cache(ttl=INTERVAL_TIME * 10, name="alerts", cluster=name, pinned_suffixes=["-has-been-resized"])
+        # Remembers the series count of the events we've sent, keyed by event name, so a repeat doesn't need a lookup
+        self.event_series_cache = Cache(ttl=EVENT_SERIES_TTL, name="event_series", cluster=name)
+        # Parsed settings per PVC uid, along with the resourceVersion they were parsed from.  Our main loop and PVC informer
+        # both parse and prune these, so they're locked
+        self.pvc_settings = {}
+        self.pvc_settings_lock = threading.Lock()
+        # What our main loop last evaluated each PVC with, and the usage query it last made, see main.py
+        self.last_evaluations = {}
+        self.last_usage_query = None
+
+default_cluster = Cluster()
+current_cluster = contextvars.ContextVar('current_cluster', default=default_cluster)
+
+# The cluster we're working on.  This follows us into the threads working on it (our resize workers, PVC informer and
+# asyncio.to_thread), so everything in here talks to the right cluster without passing it everywhere
+def get_cluster():
+    return current_cluster.get()
+
+# Load the clusters to manage from our CLUSTERS_CONFIG file, a YAML list with the name, kubeconfig context (defaults to its
+# name) and Prometheus URL of each, eg: [{"name": "production", "context": "prod-admin", "prometheus_url": "http://..."}]
+def load_clusters(path=CLUSTERS_CONFIG):
+    with open(path) as clusters_file:
+        clusters_config = yaml.safe_load(clusters_file) or []
+    clusters = []
+    for cluster_config in clusters_config:
+        name = str(cluster_config.get('name') or cluster_config['context'])
+        if not cluster_config.get('prometheus_url'):
+            raise Exception("Cluster {} in {} has no prometheus_url".format(name, path))
+        if name in [cluster.name for cluster in clusters]:
+            raise Exception("Cluster {} is in {} more than once".format(name, path))
+        api_client = kubernetes.config.new_client_from_config(context=cluster_config.get('context') or name)
+        clusters.append(Cluster(name=name, prometheus_url=str(cluster_config['prometheus_url']).rstrip('/'), api_client=api_client))
+    return clusters
+
+
+# Prefixes every line we print with the name of the cluster it's about, so the logs of every cluster we manage can be told
+# apart.  Lines about no cluster in particular (or when we only manage one) are printed as they are
+class ClusterPrefixedStream:
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.line_started = threading.local()
+
+    def write(self, text):
+        name = get_cluster().name
+        if name:
+            prefix = "[{}] ".format(name)
+            lines = text.splitlines(keepends=True)
+            text = "".join(line if index == 0 and getattr(self.line_started, 'value', False) else prefix + line for index, line in enumerate(lines))
+            self.line_started.value = bool(lines) and not lines[-1].endswith("\n")
+        with self.lock:
+            return self.stream.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
 
 
 #############################
 # Helper functions
 #############################
 # Simple header printing before the program starts, prints the variables this is configured for at runtime
-def printHeaderAndConfiguration():
+def printHeaderAndConfiguration(clusters=None):
     print("-------------------------------------------------------------------------------------------------------------")
     print("               Volume Autoscaler - Configuration               ")
     print("-------------------------------------------------------------------------------------------------------------")
-    print("                 Prometheus URL: {}".format(PROMETHEUS_URL))
-    print("             Prometheus Version: {}{}".format(PROMETHEUS_VERSION," (upgrade to >= 2.30.0 to prevent some false positives)" if version.parse(PROMETHEUS_VERSION) < version.parse("2.30.0") else ""))
+    if clusters:
+        for cluster in clusters:
+            print("                        Cluster: {} with Prometheus at {}".format(cluster.name, cluster.prometheus_url))
+    else:
+        print("                 Prometheus URL: {}".format(PROMETHEUS_URL))
+        print("             Prometheus Version: {}{}".format(PROMETHEUS_VERSION," (upgrade to >= 2.30.0 to prevent some false positives)" if version.parse(PROMETHEUS_VERSION) < version.parse("2.30.0") else ""))
     print("              Prometheus Labels: {{{}}}".format(PROMETHEUS_LABEL_MATCH))
     print("        Interval to query usage: every {} seconds".format(INTERVAL_TIME))
+    print("            Adaptive scheduling: {}".format("ENABLED, each PVC every {} to {} seconds depending on how close it is to scaling".format(ADAPTIVE_MIN_INTERVAL, ADAPTIVE_MAX_INTERVAL) if ADAPTIVE_SCHEDULING_ENABLED else "disabled"))
     print("                 Scale up after: {} intervals ({} seconds total)".format(SCALE_AFTER_INTERVALS, SCALE_AFTER_INTERVALS * INTERVAL_TIME))
     print("         Scale above percentage: disk is over {}% full".format(SCALE_ABOVE_PERCENT))
     print("     Scale up minimum increment: {} bytes, or {}".format(SCALE_UP_MIN_INCREMENT, convert_bytes_to_storage(SCALE_UP_MIN_INCREMENT)))
@@ -145,9 +646,18 @@ def printHeaderAndConfiguration():
     print("          Scale up maximum size: {} bytes, or {}".format(SCALE_UP_MAX_SIZE, convert_bytes_to_storage(SCALE_UP_MAX_SIZE)))
     print("            Scale up percentage: {}% of current disk size".format(SCALE_UP_PERCENT))
     print("              Scale up cooldown: only resize every {} seconds".format(SCALE_COOLDOWN_TIME))
+    print("     Scale up to last cooldowns: {}".format("ENABLED, large enough to last {} cooldowns at the rate of the last {} seconds".format(SCALE_UP_GROWTH_WINDOWS, FORECAST_LOOKBACK) if SCALE_UP_GROWTH_WINDOWS > 0 else "disabled"))
     print("                   Verbose Mode: {}".format("ENABLED" if VERBOSE else "disabled"))
     print("                        Dry Run: {}".format("ENABLED, no scaling will occur!" if DRY_RUN else "disabled"))
     print("     HTTP Timeouts for k8s/prom: {} seconds".format(HTTP_TIMEOUT))
+    print("          Watch PVCs (informer): {}".format("ENABLED, re-opened every {} seconds".format(PVC_WATCH_TIMEOUT) if PVC_WATCH_ENABLED else "disabled, listing all PVCs every interval"))
+    print("             PVC list page size: {} PVCs per request".format(PVC_LIST_PAGE_SIZE))
+    print("             Resize concurrency: {} volumes at a time".format(RESIZE_CONCURRENCY))
+    print("             Cache maximum size: up to {} keys each, least recently used (besides resize debounces) evicted past that".format(CACHE_MAX_SIZE))
+    print("     Prometheus retries/backoff: {} retries, {} second backoff".format(PROMETHEUS_RETRIES, PROMETHEUS_RETRY_BACKOFF))
+    print("     Prometheus connection pool: {} keep-alive connections".format(PROMETHEUS_POOL_SIZE))
+    print(" Filter by threshold Prometheus: {}".format("ENABLED" if PROMETHEUS_FILTER_BY_THRESHOLD and not VERBOSE else "disabled"))
+    print("  Forecast time until disk full: {}".format("ENABLED, scale if full within {} seconds at the rate of the last {} seconds".format(FORECAST_HORIZON, FORECAST_LOOKBACK) if FORECAST_ENABLED else "disabled"))
     print("           VictoriaMetrics mode: {}".format("ENABLED" if VICTORIAMETRICS_COMPAT else "disabled"))
     print("X-Scope-OrgID Header for Cortex: {}".format(SCOPE_ORGID_AUTH_HEADER if len(SCOPE_ORGID_AUTH_HEADER) else "disabled"))
     print(" Sending notifications to Slack: {}".format("ENABLED" if len(slack.SLACK_WEBHOOK_URL) > 0 else "disabled"))
@@ -155,38 +665,10 @@ def printHeaderAndConfiguration():
         print("                  Slack channel: {}".format(slack.SLACK_CHANNEL))
         print("           Slack message prefix: {}".format(slack.SLACK_MESSAGE_PREFIX))
         print("           Slack message suffix: {}".format(slack.SLACK_MESSAGE_SUFFIX))
+        print("     Slack batching/queue limit: combine messages within {} seconds, queue up to {} messages".format(slack.SLACK_BATCH_WINDOW, slack.SLACK_QUEUE_SIZE))
     print("-------------------------------------------------------------------------------------------------------------")
 
 
-# Figure out how many bytes to scale to based on the original size, scale up percent, minimum increment and maximum size
-def calculateBytesToScaleTo(original_size, scale_up_percent, min_increment, max_increment, maximum_size):
-    try:
-        resize_to_bytes = int((original_size * (0.01 * scale_up_percent)) + original_size)
-        # Check if resize bump is too small
-        if resize_to_bytes - original_size < min_increment:
-            # Using default scale up if too small
-            resize_to_bytes = original_size + min_increment
-
-        # Check if resize bump is too large
-        if resize_to_bytes - original_size > max_increment:
-            # Using default scale up if too large
-            resize_to_bytes = original_size + max_increment
-
-        # Now check if it is too large overall (max disk size)
-        if resize_to_bytes > maximum_size:
-            resize_to_bytes = maximum_size
-
-        # Now check if we're already maxed (16TB?) then we don't need to complete this scale activity
-        if original_size == resize_to_bytes:
-            return False
-
-        # If we're good, send back our resizeto byets
-        return resize_to_bytes
-    except Exception as e:
-        print("Exception, unable to calculate bytes to scale to: ")
-        print(e)
-        return False
-
 # Check if is integer or float
 def is_integer_or_float(n):
     try:
@@ -196,49 +678,49 @@ def is_integer_or_float(n):
     else:
         return float(n).is_integer()
 
-# Convert the K8s storage size definitions (eg: 10G, 5Ti, etc) into number of bytes
+# The suffixes of the Kubernetes Quantity grammar and how many bytes each is, see
+# https://github.com/kubernetes/apimachinery/blob/master/pkg/api/resource/quantity.go
+#   BinarySI  == Ki | Mi | Gi | Ti | Pi | Ei
+#   DecimalSI == m | "" | k | M | G | T | P | E    (note: m is milli, not mega)
+QUANTITY_BINARY_SUFFIXES = {'Ki': 1024, 'Mi': 1024**2, 'Gi': 1024**3, 'Ti': 1024**4, 'Pi': 1024**5, 'Ei': 1024**6}
+QUANTITY_DECIMAL_SUFFIXES = {'m': fractions.Fraction(1, 1000), '': 1, 'k': 1000, 'M': 1000**2, 'G': 1000**3, 'T': 1000**4, 'P': 1000**5, 'E': 1000**6}
+# <signedNumber><suffix>, where the suffix can also be a decimalExponent (e or E followed by a signed integer).  Note
+# "1E" is Exa, but "1E3" is an exponent, which is why the exponent is tried after the suffixes fail to match
+QUANTITY_REGEX = re.compile(r'^([+-]?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+))(?:(Ki|Mi|Gi|Ti|Pi|Ei|m|k|M|G|T|P|E)|[eE]([+-]?[0-9]+))?$')
+# The units we format into, largest first, per base
+QUANTITY_FORMAT_UNITS = {
+    True:  [('Ei', 1024**6), ('Pi', 1024**5), ('Ti', 1024**4), ('Gi', 1024**3), ('Mi', 1024**2)],
+    False: [('E', 1000**6), ('P', 1000**5), ('T', 1000**4), ('G', 1000**3), ('M', 1000**2)],
+}
+# How many distinct quantities we remember the conversion of, we convert the same handful of sizes over and over
+QUANTITY_CACHE_SIZE = 4096
+
+# Convert the K8s storage size definitions (eg: 10G, 5Ti, 1.5Gi, 500e6, etc) into number of bytes.  Like Kubernetes, this
+# is exact (no floats) and any fraction of a byte is rounded up.  Raises ValueError if this isn't a valid quantity
+@functools.lru_cache(maxsize=QUANTITY_CACHE_SIZE)
 def convert_storage_to_bytes(storage):
+    match = QUANTITY_REGEX.match(str(storage).strip())
+    if not match:
+        raise ValueError("Invalid Kubernetes quantity: {}".format(storage))
+    number, suffix, exponent = match.groups()
+    # Most sizes are whole numbers of bytes, skip the (slower) Fraction math for them
+    if '.' not in number and suffix in QUANTITY_BINARY_SUFFIXES:
+        return int(number) * QUANTITY_BINARY_SUFFIXES[suffix]
+    if '.' not in number and exponent is None and suffix != 'm':
+        return int(number) * QUANTITY_DECIMAL_SUFFIXES[suffix or '']
+    value = fractions.Fraction(number)
+    if exponent is not None:
+        value *= fractions.Fraction(10) ** int(exponent)
+    elif suffix in QUANTITY_BINARY_SUFFIXES:
+        value *= QUANTITY_BINARY_SUFFIXES[suffix]
+    else:
+        value *= QUANTITY_DECIMAL_SUFFIXES[suffix or '']
+    return math.ceil(value)
+
 
-    # BinarySI == Ki | Mi | Gi | Ti | Pi | Ei
-    if storage.endswith('Ki'):
-        return int(storage.replace("Ki","")) * 1024
-    if storage.endswith('Mi'):
-        return int(storage.replace("Mi","")) * 1024 * 1024
-    if storage.endswith('Gi'):
-        return int(storage.replace("Gi","")) * 1024 * 1024 * 1024
-    if storage.endswith('Ti'):
-        return int(storage.replace("Ti","")) * 1024 * 1024 * 1024 * 1024
-    if storage.endswith('Pi'):
-        return int(storage.replace("Pi","")) * 1024 * 1024 * 1024 * 1024 * 1024
-    if storage.endswith('Ei'):
-        return int(storage.replace("Ei","")) * 1024 * 1024 * 1024 * 1024 * 1024 * 1024
-
-    # decimalSI == m | k | M | G | T | P | E | "" (this last one is the fallthrough at the end)
-    if storage.endswith('k'):
-        return int(storage.replace("k","")) * 1000
-    if storage.endswith('K'):
-        return int(storage.replace("K","")) * 1000
-    if storage.endswith('m'):
-        return int(storage.replace("m","")) * 1000 * 1000
-    if storage.endswith('M'):
-        return int(storage.replace("M","")) * 1000 * 1000
-    if storage.endswith('G'):
-        return int(storage.replace("G","")) * 1000 * 1000 * 1000
-    if storage.endswith('T'):
-        return int(storage.replace("T","")) * 1000 * 1000 * 1000 * 1000
-    if storage.endswith('P'):
-        return int(storage.replace("P","")) * 1000 * 1000 * 1000 * 1000 * 1000
-    if storage.endswith('E'):
-        return int(storage.replace("E","")) * 1000 * 1000 * 1000 * 1000 * 1000 * 1000
-
-    # decimalExponent == e | E (in the middle of two integers)
-    lowercaseDecimalExponent = storage.split('e')
-    uppercaseDecimalExponent = storage.split('E')
-    if len(lowercaseDecimalExponent) > 1 or len(uppercaseDecimalExponent) > 1:
-        return int(float(str(format(float(storage)))))
-
-    # If none above match, then it should just be an integer value (in bytes)
-    return int(storage)
+# Whether a K8s storage size definition was written in base2 (eg: 10Gi) or not (eg: 10G, 10000000000)
+def is_binary_storage(storage):
+    return str(storage).strip().endswith('i')
 
 
 # Try a numeric format to see if it's close enough (within 10 percent, aka 0.1) to the definition
@@ -257,55 +739,28 @@ def try_numeric_format(bytes, size_multiplier, suffix, match_by_percentage = 0.1
     return False
 
 
-# Convert bytes (int) to an "sexY" kubernetes storage definition (10G, 5Ti, etc)
-# TODO?: If possible, add hinting of which to try first, base10 or base2, based on what was used previously to get closer to the right amount
-def convert_bytes_to_storage(bytes):
-
-    # Todo: Add Petabytes/Exobytes?
-
-    # Ensure its an intger
-    bytes = int(bytes)
-
-    # First, we'll try all base10 values...
-    # Check if we can convert this into terrabytes
-    result = try_numeric_format(bytes, 1000000000000, 'T')
-    if result:
-        return result
-
-    # Check if we can convert this into gigabytes
-    result = try_numeric_format(bytes, 1000000000, 'G')
-    if result:
-        return result
-
-    # Check if we can convert this into megabytes
-    result = try_numeric_format(bytes, 1000000, 'M')
-    if result:
-        return result
-
-    # Do we ever use things this small?  For now going to skip this...
-    # result = try_numeric_format(bytes, 1000, 'k')
-    # if result:
-    #     return result
-
-    # Next, we'll try all base2 values...
-    result = try_numeric_format(bytes, 1099511627776, 'Ti')
-    if result:
-        return result
+# Convert bytes (int) to an "sexY" kubernetes storage definition (10G, 5Ti, etc).  If this is exactly a whole number of
+# some unit we use that, otherwise we round to within 10% in the base given by binary (eg: from is_binary_storage() of
+# the PVC's original size, so a 10Gi volume is described in Gi) falling back to the other base, or to just bytes
+def convert_bytes_to_storage(bytes, binary=False):
+    return format_bytes_to_storage(int(bytes), bool(binary))
 
-    # Next, we'll try all base2 values...
-    result = try_numeric_format(bytes, 1073741824, 'Gi')
-    if result:
-        return result
+@functools.lru_cache(maxsize=QUANTITY_CACHE_SIZE)
+def format_bytes_to_storage(bytes, binary):
+    bases = [binary, not binary]
 
-    # Next, we'll try all base2 values...
-    result = try_numeric_format(bytes, 1048576, 'Mi')
-    if result:
-        return result
+    # First, an exact match, in the largest unit of either base
+    for base in bases:
+        for suffix, size_multiplier in QUANTITY_FORMAT_UNITS[base]:
+            if bytes >= size_multiplier and bytes % size_multiplier == 0:
+                return "{}{}".format(bytes // size_multiplier, suffix)
 
-    # # Do we ever use things this small?  For now going to skip this...
-    # result = try_numeric_format(bytes, 1024, 'Ki')
-    # if result:
-    #     return result
+    # Then, the closest we can get in our preferred base, then the other base
+    for base in bases:
+        for suffix, size_multiplier in QUANTITY_FORMAT_UNITS[base]:
+            result = try_numeric_format(bytes, size_multiplier, suffix)
+            if result:
+                return result
 
     # Worst-case just return bytes, a non-sexy value
     return bytes
@@ -314,127 +769,430 @@ def convert_bytes_to_storage(bytes):
 # The PVC definition from Kubernetes has tons of variables in various maps of maps of maps, simplify
 # it to a flat dict for the values we care about, along with allowing per-pvc overrides from annotations
 def convert_pvc_to_simpler_dict(pvc):
-    return_dict = {}
-    return_dict['name'] = pvc.metadata.name
     try:
-        return_dict['volume_size_spec'] = pvc.spec.resources.requests['storage']
+        volume_size_spec = pvc.spec.resources.requests['storage']
     except:
-        return_dict['volume_size_spec'] = "0"
-    return_dict['volume_size_spec_bytes'] = convert_storage_to_bytes(return_dict['volume_size_spec'])
+        volume_size_spec = "0"
     try:
-        return_dict['volume_size_status'] = pvc.status.capacity['storage']
+        volume_size_status = pvc.status.capacity['storage']
     except:
-        return_dict['volume_size_status'] = "0"
-    return_dict['volume_size_status_bytes'] = convert_storage_to_bytes(return_dict['volume_size_status'])
-    return_dict['namespace'] = pvc.metadata.namespace
+        volume_size_status = "0"
     try:
-        return_dict['storage_class'] = pvc.spec.storage_class_name
+        storage_class = pvc.spec.storage_class_name
     except:
-        return_dict['storage_class'] = ""
+        storage_class = ""
     try:
-        return_dict['resource_version'] = pvc.metadata.resource_version
+        resource_version = pvc.metadata.resource_version
     except:
-        return_dict['resource_version'] = ""
+        resource_version = ""
     try:
-        return_dict['uid'] = pvc.metadata.uid
+        uid = pvc.metadata.uid
     except:
-        return_dict['uid'] = ""
-
-    # Set our defaults
-    return_dict['last_resized_at']        = 0
-    return_dict['scale_above_percent']    = SCALE_ABOVE_PERCENT
-    return_dict['scale_after_intervals']  = SCALE_AFTER_INTERVALS
-    return_dict['scale_up_percent']       = SCALE_UP_PERCENT
-    return_dict['scale_up_min_increment'] = SCALE_UP_MIN_INCREMENT
-    return_dict['scale_up_max_increment'] = SCALE_UP_MAX_INCREMENT
-    return_dict['scale_up_max_size']      = SCALE_UP_MAX_SIZE
-    return_dict['scale_cooldown_time']    = SCALE_COOLDOWN_TIME
-    return_dict['ignore']                 = False
-
-    # Override defaults with annotations on the PVC
-    try:
-        if 'volume.autoscaler.kubernetes.io/last-resized-at' in pvc.metadata.annotations:
-            return_dict['last_resized_at'] = int(pvc.metadata.annotations['volume.autoscaler.kubernetes.io/last-resized-at'])
-    except Exception as e:
-        print("Could not convert last_resized_at to int: {}".format(e))
-
-    try:
-        if 'volume.autoscaler.kubernetes.io/scale-above-percent' in pvc.metadata.annotations:
-            return_dict['scale_above_percent'] = int(pvc.metadata.annotations['volume.autoscaler.kubernetes.io/scale-above-percent'])
-    except Exception as e:
-        print("Could not convert scale_above_percent to int: {}".format(e))
-
-    try:
-        if 'volume.autoscaler.kubernetes.io/scale-after-intervals' in pvc.metadata.annotations:
-            return_dict['scale_after_intervals'] = int(pvc.metadata.annotations['volume.autoscaler.kubernetes.io/scale-after-intervals'])
-    except Exception as e:
-        print("Could not convert scale_after_intervals to int: {}".format(e))
+        uid = ""
+    return build_simpler_pvc_dict(
+        name               = pvc.metadata.name,
+        namespace          = pvc.metadata.namespace,
+        uid                = uid,
+        resource_version   = resource_version,
+        storage_class      = storage_class,
+        volume_size_spec   = volume_size_spec,
+        volume_size_status = volume_size_status,
+        annotations        = pvc.metadata.annotations,
+    )
 
-    try:
-        if 'volume.autoscaler.kubernetes.io/scale-up-percent' in pvc.metadata.annotations:
-            return_dict['scale_up_percent'] = int(pvc.metadata.annotations['volume.autoscaler.kubernetes.io/scale-up-percent'])
-    except Exception as e:
-        print("Could not convert scale_up_percent to int: {}".format(e))
 
+# Same as above, but for the raw JSON of a PVC as returned by the API (eg: with _preload_content=False).  This skips
+# deserializing into the kubernetes-client models entirely, which is the most expensive part of listing PVCs
+def convert_raw_pvc_to_simpler_dict(pvc):
+    metadata = pvc.get('metadata') or {}
+    spec = pvc.get('spec') or {}
+    status = pvc.get('status') or {}
     try:
-        if 'volume.autoscaler.kubernetes.io/scale-up-min-increment' in pvc.metadata.annotations:
-            return_dict['scale_up_min_increment'] = int(pvc.metadata.annotations['volume.autoscaler.kubernetes.io/scale-up-min-increment'])
-    except Exception as e:
-        print("Could not convert scale_up_min_increment to int: {}".format(e))
-
+        volume_size_spec = spec['resources']['requests']['storage']
+    except:
+        volume_size_spec = "0"
     try:
-        if 'volume.autoscaler.kubernetes.io/scale-up-max-increment' in pvc.metadata.annotations:
-            return_dict['scale_up_max_increment'] = int(pvc.metadata.annotations['volume.autoscaler.kubernetes.io/scale-up-max-increment'])
-    except Exception as e:
-        print("Could not convert scale_up_max_increment to int: {}".format(e))
+        volume_size_status = status['capacity']['storage']
+    except:
+        volume_size_status = "0"
+    return build_simpler_pvc_dict(
+        name               = metadata.get('name'),
+        namespace          = metadata.get('namespace'),
+        uid                = metadata.get('uid'),
+        resource_version   = metadata.get('resourceVersion'),
+        storage_class      = spec.get('storageClassName'),
+        volume_size_spec   = volume_size_spec,
+        volume_size_status = volume_size_status,
+        annotations        = metadata.get('annotations'),
+    )
 
-    try:
-        if 'volume.autoscaler.kubernetes.io/scale-up-max-size' in pvc.metadata.annotations:
-            return_dict['scale_up_max_size'] = int(pvc.metadata.annotations['volume.autoscaler.kubernetes.io/scale-up-max-size'])
-    except Exception as e:
-        print("Could not convert scale_up_max_size to int: {}".format(e))
 
+# The annotations which override our settings per-PVC, and which setting each one overrides
+PVC_ANNOTATION_SETTINGS = [
+    ('last_resized_at',        'volume.autoscaler.kubernetes.io/last-resized-at'),
+    ('scale_above_percent',    'volume.autoscaler.kubernetes.io/scale-above-percent'),
+    ('scale_after_intervals',  'volume.autoscaler.kubernetes.io/scale-after-intervals'),
+    ('scale_up_percent',       'volume.autoscaler.kubernetes.io/scale-up-percent'),
+    ('scale_up_min_increment', 'volume.autoscaler.kubernetes.io/scale-up-min-increment'),
+    ('scale_up_max_increment', 'volume.autoscaler.kubernetes.io/scale-up-max-increment'),
+    ('scale_up_max_size',      'volume.autoscaler.kubernetes.io/scale-up-max-size'),
+    ('scale_cooldown_time',    'volume.autoscaler.kubernetes.io/scale-cooldown-time'),
+    ('forecast_horizon',       'volume.autoscaler.kubernetes.io/forecast-horizon'),
+    ('scale_up_growth_windows', 'volume.autoscaler.kubernetes.io/scale-up-growth-windows'),
+]
+
+
+# The settings of a PVC, our defaults overridden by any annotations on the PVC.  These only change when the PVC does
+class PVCSettings:
+    __slots__ = ('last_resized_at', 'scale_above_percent', 'scale_after_intervals', 'scale_up_percent', 'scale_up_min_increment',
+                 'scale_up_max_increment', 'scale_up_max_size', 'scale_cooldown_time', 'forecast_horizon', 'scale_up_growth_windows', 'ignore')
+
+    def __init__(self, namespace, name, annotations):
+        # Set our defaults
+        self.last_resized_at        = 0
+        self.scale_above_percent    = SCALE_ABOVE_PERCENT
+        self.scale_after_intervals  = SCALE_AFTER_INTERVALS
+        self.scale_up_percent       = SCALE_UP_PERCENT
+        self.scale_up_min_increment = SCALE_UP_MIN_INCREMENT
+        self.scale_up_max_increment = SCALE_UP_MAX_INCREMENT
+        self.scale_up_max_size      = SCALE_UP_MAX_SIZE
+        self.scale_cooldown_time    = SCALE_COOLDOWN_TIME
+        self.forecast_horizon       = FORECAST_HORIZON
+        self.scale_up_growth_windows = SCALE_UP_GROWTH_WINDOWS
+        self.ignore                 = False
+
+        # Override defaults with annotations on the PVC
+        for setting, annotation in PVC_ANNOTATION_SETTINGS:
+            if annotation in annotations:
+                try:
+                    value = int(annotations[annotation])
+                except Exception as e:
+                    print("Could not convert {} to int on PVC {}.{}: {}".format(setting, namespace, name, e))
+                    continue
+                # We decide with int64s, so clamp what is too large for them (eg: a huge scale-up-max-size meant as unlimited)
+                if abs(value) > decisions.MAX_VALUE:
+                    value = max(-decisions.MAX_VALUE, min(value, decisions.MAX_VALUE))
+                    print("Clamping {} on PVC {}.{} to {}, the largest we support".format(setting, namespace, name, value))
+                setattr(self, setting, value)
+        try:
+            if 'volume.autoscaler.kubernetes.io/ignore' in annotations and annotations['volume.autoscaler.kubernetes.io/ignore'].lower() == "true":
+                self.ignore = True
+        except Exception as e:
+            print("Could not convert ignore to bool on PVC {}.{}: {}".format(namespace, name, e))
+
+
+# Our simplified view of a PVC with the handful of fields we use, and its settings.  This uses slots to keep the memory
+# used per PVC small, but still behaves like the flat dict it replaced (eg: pvc['scale_above_percent'], iterating its keys)
+class PVCRecord:
+    __slots__ = ('name', 'volume_size_spec', 'volume_size_spec_bytes', 'volume_size_status', 'volume_size_status_bytes', 'namespace',
+                 'storage_class', 'resource_version', 'uid', 'settings', 'volume_used_percent', 'volume_used_inode_percent',
+                 'volume_growth_bytes_per_second', 'volume_seconds_until_full')
+    RECORD_KEYS = ('name', 'volume_size_spec', 'volume_size_spec_bytes', 'volume_size_status', 'volume_size_status_bytes', 'namespace',
+                   'storage_class', 'resource_version', 'uid')
+    SETTINGS_KEYS = PVCSettings.__slots__
+    USAGE_KEYS = ('volume_used_percent', 'volume_used_inode_percent', 'volume_growth_bytes_per_second', 'volume_seconds_until_full')
+
+    def __getitem__(self, key):
+        try:
+            if key in self.SETTINGS_KEYS:
+                return getattr(self.settings, key)
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.SETTINGS_KEYS:
+            raise KeyError("{} is a setting of this PVC, it can only be changed by changing the PVC".format(key))
+        try:
+            setattr(self, key, value)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.RECORD_KEYS or key in self.SETTINGS_KEYS or (key in self.USAGE_KEYS and hasattr(self, key))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return list(self.RECORD_KEYS) + list(self.SETTINGS_KEYS) + [key for key in self.USAGE_KEYS if hasattr(self, key)]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self):
+        return {key: self[key] for key in self.keys()}
+
+    # A copy of this record sharing its settings, to add what we learn about it (eg: its usage) without changing this one
+    def copy(self):
+        record = PVCRecord()
+        for key in self.__slots__:
+            if hasattr(self, key):
+                setattr(record, key, getattr(self, key))
+        return record
+
+    def __eq__(self, other):
+        if isinstance(other, PVCRecord):
+            other = other.to_dict()
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+# The parsed settings of the cluster we're working on's PVCs, see Cluster.pvc_settings.  We only re-parse a PVC's annotations
+# when its resourceVersion changes, so unchanged PVCs are never re-parsed and warnings about bad annotations print once
+def get_pvc_settings(namespace, name, uid, resource_version, annotations):
+    cluster = get_cluster()
+    with cluster.pvc_settings_lock:
+        cached = cluster.pvc_settings.get(uid)
+    if cached is not None and cached[0] == resource_version:
+        return cached[1]
+    settings = PVCSettings(namespace, name, annotations if annotations is not None else {})
+    if uid:
+        with cluster.pvc_settings_lock:
+            cluster.pvc_settings[uid] = (resource_version, settings)
+    return settings
+
+# Forget the settings of PVCs which no longer exist, pass the uids of every PVC which still does
+def prune_pvc_settings_cache(existing_uids):
+    cluster = get_cluster()
+    with cluster.pvc_settings_lock:
+        for uid in [uid for uid in cluster.pvc_settings if uid not in existing_uids]:
+            del cluster.pvc_settings[uid]
+
+# Forget the settings of a PVC which was deleted
+def forget_pvc_settings(uid):
+    cluster = get_cluster()
+    with cluster.pvc_settings_lock:
+        cluster.pvc_settings.pop(uid, None)
+
+
+# Build our record from the handful of fields we use, with our defaults overridden by any annotations on the PVC
+def build_simpler_pvc_dict(name, namespace, uid, resource_version, storage_class, volume_size_spec, volume_size_status, annotations):
+    record = PVCRecord()
+    record.name = name
+    record.volume_size_spec = volume_size_spec
+    record.volume_size_spec_bytes = convert_storage_to_bytes(volume_size_spec)
+    record.volume_size_status = volume_size_status
+    record.volume_size_status_bytes = convert_storage_to_bytes(volume_size_status)
+    record.namespace = namespace
+    record.storage_class = storage_class
+    record.resource_version = resource_version
+    record.uid = uid
+    record.settings = get_pvc_settings(namespace, name, uid, resource_version, annotations)
+    return record
+
+
+# Estimate how many bytes of memory we use per PVC we track, from a sample of them.  Settings are shared between records
+# of the same PVC version, so they are counted once per record here which slightly over-estimates
+def estimate_memory_per_pvc(pvcs, sample_size=100):
+    total = 0
+    sampled = 0
+    for record in pvcs.values():
+        total += sys.getsizeof(record) + sys.getsizeof(record.settings)
+        for key in PVCRecord.RECORD_KEYS:
+            total += sys.getsizeof(getattr(record, key))
+        sampled += 1
+        if sampled >= sample_size:
+            break
+    # Our key in the index (namespace.name) and its slot in the index dict
+    return int(total / sampled) + 100 if sampled else 0
+
+
+# When a continue token expires, Kubernetes may hand us a new one in the 410 response which continues the list from
+# where we were (at a newer resourceVersion, so the list is no longer a consistent snapshot but we don't have to restart)
+def get_continue_token_from_expired_exception(e):
     try:
-        if 'volume.autoscaler.kubernetes.io/scale-cooldown-time' in pvc.metadata.annotations:
-            return_dict['scale_cooldown_time'] = int(pvc.metadata.annotations['volume.autoscaler.kubernetes.io/scale-cooldown-time'])
-    except Exception as e:
-        print("Could not convert scale_cooldown_time to int: {}".format(e))
+        return json.loads(e.body)['metadata']['continue'] or None
+    except Exception:
+        return None
 
-    try:
-        if 'volume.autoscaler.kubernetes.io/ignore' in pvc.metadata.annotations and pvc.metadata.annotations['volume.autoscaler.kubernetes.io/ignore'].lower() == "true":
-            return_dict['ignore'] = True
-    except Exception as e:
-        print("Could not convert ignore to bool: {}".format(e))
 
-    # Return our cleaned up and simple flat dict with the values we care about, with overrides if specified
-    return return_dict
+# Iterate through every PVC in the cluster one page at a time (using limit/continue).  Only one page of PVCs is ever held
+# in memory, each page is dropped before the next is fetched.  If list_metadata (a dict) is passed we fill in the
+# resourceVersion of the list in it, so a watch can be started from there.  A watch only sees changes after that, so the
+# list must then be a consistent snapshot, and an expired continue token is raised (as a 410 ApiException) for the caller
+# to restart from the first page.  If raw is set, we yield the raw JSON dicts from the API instead of deserializing them
+# into kubernetes-client models (use convert_raw_pvc_to_simpler_dict on them)
+def iterate_all_pvcs(page_size=PVC_LIST_PAGE_SIZE, list_metadata=None, raw=False):
+    continue_token = None
+    while True:
+        try:
+            with record_http_request('kubernetes'):
+                if raw:
+                    response = get_cluster().kubernetes_core_api.list_persistent_volume_claim_for_all_namespaces(limit=page_size, _continue=continue_token, timeout_seconds=HTTP_TIMEOUT, _preload_content=False)
+                    api_response = json.loads(response.data)
+                    response = None
+                else:
+                    api_response = get_cluster().kubernetes_core_api.list_persistent_volume_claim_for_all_namespaces(limit=page_size, _continue=continue_token, timeout_seconds=HTTP_TIMEOUT)
+        except ApiException as e:
+            if e.status != 410 or not continue_token or list_metadata is not None:
+                raise
+            # Our continue token expired mid-list, continue with the one Kubernetes gave us or restart from the first page
+            # if it didn't give us one.  Callers key PVCs by namespace and name, so any we see twice simply overwrite themselves
+            continue_token = get_continue_token_from_expired_exception(e)
+            print("PVC list continue token expired, {}".format("continuing from a newer resourceVersion" if continue_token else "restarting list from the first page"))
+            continue
+
+        if raw:
+            if list_metadata is not None:
+                list_metadata['resource_version'] = api_response['metadata'].get('resourceVersion')
+            continue_token = api_response['metadata'].get('continue')
+            items = api_response.get('items') or []
+        else:
+            if list_metadata is not None:
+                list_metadata['resource_version'] = api_response.metadata.resource_version
+            continue_token = api_response.metadata._continue
+            items = api_response.items
+        # Pop items off as we yield them, so each can be freed as soon as the caller is done with it
+        api_response = None
+        items.reverse()
+        while items:
+            yield items.pop()
+        if not continue_token:
+            return
 
 
 # Describe all the PVCs in Kubernetes
-# TODO: Check if we need to page this, and how well it handles scale (100+ PVCs, etc)
 def describe_all_pvcs(simple=False):
-    api_response = kubernetes_core_api.list_persistent_volume_claim_for_all_namespaces(timeout_seconds=HTTP_TIMEOUT)
     output_objects = {}
-    for item in api_response.items:
-        if simple:
-            output_objects["{}.{}".format(item.metadata.namespace,item.metadata.name)] = convert_pvc_to_simpler_dict(item)
-        else:
+    # If the user only wants our simple records, we don't need the kubernetes-client models at all
+    if simple:
+        for item in iterate_all_pvcs(raw=True):
+            output_objects["{}.{}".format(item['metadata']['namespace'],item['metadata']['name'])] = convert_raw_pvc_to_simpler_dict(item)
+        prune_pvc_settings_cache(set(record.uid for record in output_objects.values()))
+    else:
+        for item in iterate_all_pvcs():
             output_objects["{}.{}".format(item.metadata.namespace,item.metadata.name)] = item
 
     return output_objects
 
 
+# A watch which hands back the raw JSON of every object instead of deserializing it into kubernetes-client models.  We
+# can't use stream(deserialize=False) for this because it breaks the handling of ERROR events (eg: 410 Gone)
+class RawWatch(kubernetes.watch.Watch):
+    def get_return_type(self, func):
+        return None
+
+
+# Keeps an in-memory index of every PVC in the cluster up to date.  We do one full list at startup, and from then
+# on we only receive changes via a watch stream (with bookmarks to keep our resourceVersion fresh).  We only need to
+# re-list if Kubernetes tells us our resourceVersion is too old (410 Gone).  This keeps the load on the API server
+# and the time it takes for us to describe all PVCs flat no matter how many PVCs are in the cluster
+class PVCInformer:
+    def __init__(self, watch_timeout=PVC_WATCH_TIMEOUT, retry_delay=5):
+        self.watch_timeout = watch_timeout
+        self.retry_delay = retry_delay
+        self.index = {}
+        self.resource_version = None
+        self.synced = False
+        self.stop_requested = False
+        self.watcher = None
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=contextvars.copy_context().run, args=(self.run,), name="pvc-informer", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_requested = True
+        if self.watcher:
+            self.watcher.stop()
+
+    def has_synced(self):
+        return self.synced
+
+    # Returns a snapshot of our index, in the same format as describe_all_pvcs(simple=True)
+    def get_pvcs(self):
+        with self.lock:
+            return dict(self.index)
+
+    # Do a full list of all PVCs, replacing our whole index, and remember where to start watching from
+    def relist(self):
+        while True:
+            list_metadata = {}
+            new_index = {}
+            try:
+                for item in iterate_all_pvcs(list_metadata=list_metadata, raw=True):
+                    new_index["{}.{}".format(item['metadata']['namespace'],item['metadata']['name'])] = convert_raw_pvc_to_simpler_dict(item)
+                break
+            except ApiException as e:
+                if e.status != 410:
+                    raise
+                # Continuing at a newer resourceVersion would miss PVCs created in the pages we already listed, and our watch
+                # would start after they were created, so we'd never see them.  Start over for a consistent list instead
+                print("PVC list continue token expired, restarting our PVC informer's list from the first page")
+        prune_pvc_settings_cache(set(record.uid for record in new_index.values()))
+        with self.lock:
+            self.index = new_index
+            self.resource_version = list_metadata['resource_version']
+            self.synced = True
+        if VERBOSE:
+            print("PVC informer listed {} PVCs at resourceVersion {}".format(len(new_index), self.resource_version))
+
+    # Apply the changes from a single watch stream to our index until it times out or we are told to stop.  Every
+    # event object is the raw JSON dict of the PVC, see RawWatch below
+    def watch(self):
+        self.watcher = RawWatch()
+        for event in self.watcher.stream(
+                    get_cluster().kubernetes_core_api.list_persistent_volume_claim_for_all_namespaces,
+                    resource_version=self.resource_version,
+                    allow_watch_bookmarks=True,
+                    timeout_seconds=self.watch_timeout,
+                ):
+            item = event['object']
+            if event['type'] in ['ADDED', 'MODIFIED']:
+                simple_pvc = convert_raw_pvc_to_simpler_dict(item)
+                with self.lock:
+                    self.index["{}.{}".format(item['metadata']['namespace'],item['metadata']['name'])] = simple_pvc
+            elif event['type'] == 'DELETED':
+                with self.lock:
+                    self.index.pop("{}.{}".format(item['metadata']['namespace'],item['metadata']['name']), None)
+                forget_pvc_settings(item['metadata'].get('uid'))
+            # Every event including bookmarks carries the latest resourceVersion, so we resume from there
+            if item.get('metadata', {}).get('resourceVersion'):
+                self.resource_version = item['metadata']['resourceVersion']
+            if self.stop_requested:
+                self.watcher.stop()
+
+    def run(self):
+        while not self.stop_requested:
+            try:
+                if self.resource_version is None:
+                    self.relist()
+                self.watch()
+            except ApiException as e:
+                if e.status == 410:
+                    print("PVC informer resourceVersion {} is too old, re-listing all PVCs".format(self.resource_version))
+                    self.resource_version = None
+                    continue
+                print("Exception in PVC informer while watching PVCs: {}".format(e))
+                time.sleep(self.retry_delay)
+            except Exception:
+                print("Exception in PVC informer while watching PVCs")
+                traceback.print_exc()
+                time.sleep(self.retry_delay)
+
+
 # Scale up an PVC in Kubernetes
 def scale_up_pvc(namespace, name, new_size):
     try:
-        result = kubernetes_core_api.patch_namespaced_persistent_volume_claim(
-                    name=name,
-                    namespace=namespace,
-                    body={
-                        "metadata": {"annotations": {"volume.autoscaler.kubernetes.io/last-resized-at": str(int(time.mktime(time.gmtime())))}},
-                        "spec": {"resources": {"requests": {"storage": new_size}} }
-                    }
-                )
+        with record_http_request('kubernetes'):
+            result = get_cluster().kubernetes_core_api.patch_namespaced_persistent_volume_claim(
+                        name=name,
+                        namespace=namespace,
+                        body={
+                            "metadata": {"annotations": {"volume.autoscaler.kubernetes.io/last-resized-at": str(int(time.mktime(time.gmtime())))}},
+                            "spec": {"resources": {"requests": {"storage": new_size}} }
+                        }
+                    )
 
         print("  Desired New Size: {}".format(new_size))
         print("  Actual New Size: {}".format(convert_storage_to_bytes(result.spec.resources.requests['storage'])))
@@ -457,30 +1215,98 @@ def testIfPrometheusIsAccessible(url):
     global PROMETHEUS_VERSION
     if VICTORIAMETRICS_COMPAT:
       # Victoriametrics roughly resembles a very recent prometheus
-      PROMETHEUS_VERSION = "2.41.0"
+      PROMETHEUS_VERSION = get_cluster().prometheus_version = "2.41.0"
       return # Victoria doesn't export stats/buildinfo endpoint, so just assume it's accessible.
 
     try:
-        response = requests.get(url + '/api/v1/status/buildinfo', timeout=HTTP_TIMEOUT, headers=headers)
+        response = prometheus_get(url + '/api/v1/status/buildinfo')
         if response.status_code != 200:
             raise Exception("ERROR: Received status code {} while trying to initialize on Prometheus: {}".format(response.status_code, url))
         response_object = response.json()
-        PROMETHEUS_VERSION = response_object['data']['version']
+        PROMETHEUS_VERSION = get_cluster().prometheus_version = response_object['data']['version']
     except Exception as e:
         print("Failed to verify that prometheus is accessible!")
         print(e)
         exit(-1)
 
 
-# Get a list of PVCs from Prometheus with their metrics of disk usage
-def fetch_pvcs_from_prometheus(url, label_match=PROMETHEUS_LABEL_MATCH):
+# Find the lowest scale-above-percent of all our PVCs (from the global default or their annotations), we never need
+# usage from Prometheus for PVCs below this.  Ignored PVCs don't count, since they will never be scaled anyways
+def get_lowest_scale_above_percent(pvcs):
+    lowest = None
+    for volume_description in pvcs:
+        if pvcs[volume_description]['ignore']:
+            continue
+        if lowest is None or pvcs[volume_description]['scale_above_percent'] < lowest:
+            lowest = pvcs[volume_description]['scale_above_percent']
+    return lowest
+
+
+# The longest forecast horizon of all our PVCs (which aren't ignored), so we can have Prometheus filter out everything
+# which isn't forecast to be full within it
+def get_largest_forecast_horizon(pvcs):
+    largest = None
+    for volume_description in pvcs:
+        if pvcs[volume_description]['ignore']:
+            continue
+        if largest is None or pvcs[volume_description]['forecast_horizon'] > largest:
+            largest = pvcs[volume_description]['forecast_horizon']
+    return largest
+
+
+# If any of our PVCs (which aren't ignored) are sized by how fast they are growing, so we need their growth from Prometheus
+def has_scale_up_growth_windows(pvcs):
+    for volume_description in pvcs:
+        if not pvcs[volume_description]['ignore'] and pvcs[volume_description]['scale_up_growth_windows'] > 0:
+            return True
+    return False
+
 
+# Build a single PromQL query for the percentage of disk space and inodes used of every PVC.  Both are returned in one
+# response, each series tagged with a metric_type label of "bytes" or "inodes" so we can tell them apart.  If
+# above_percent is set, Prometheus only returns PVCs which have their disk space or inodes used at or above it.  If
+# forecast_horizon is set we're forecasting, so we also want how fast (in bytes per second, over FORECAST_LOOKBACK) each
+# PVC is filling up as "growth" and its bytes available as "available", and PVCs forecast to be full within
+# forecast_horizon seconds are returned even if they are below above_percent.  If growth is set we also want "growth"
+# and "available", to size resizes by, but without returning any more PVCs
+def build_pvc_usage_query(label_match=PROMETHEUS_LABEL_MATCH, above_percent=None, forecast_horizon=None, growth=False):
     # This only works on Prometheus v2.30.0 or newer, using this helps prevent false-negatives only returning recent pvcs (in the last hour)
-    if version.parse(PROMETHEUS_VERSION) >= version.parse("2.30.0"):
-        response = requests.get(url + '/api/v1/query', params={'query': "ceil((1 - kubelet_volume_stats_available_bytes{{ {} }} / kubelet_volume_stats_capacity_bytes)*100) and present_over_time(kubelet_volume_stats_available_bytes{{ {} }}[1h])".format(label_match,label_match)}, timeout=HTTP_TIMEOUT, headers=headers)
+    if version.parse(get_cluster().prometheus_version) >= version.parse("2.30.0"):
+        bytes_query = "ceil((1 - kubelet_volume_stats_available_bytes{{ {} }} / kubelet_volume_stats_capacity_bytes)*100) and present_over_time(kubelet_volume_stats_available_bytes{{ {} }}[1h])".format(label_match,label_match)
+        inodes_query = "ceil((1 - kubelet_volume_stats_inodes_free{{ {} }} / kubelet_volume_stats_inodes)*100) and present_over_time(kubelet_volume_stats_inodes_free{{ {} }}[1h])".format(label_match,label_match)
     else:
-        response = requests.get(url + '/api/v1/query', params={'query': "ceil((1 - kubelet_volume_stats_available_bytes{{ {} }} / kubelet_volume_stats_capacity_bytes)*100)".format(label_match,label_match)}, timeout=HTTP_TIMEOUT, headers=headers)
-
+        bytes_query = "ceil((1 - kubelet_volume_stats_available_bytes{{ {} }} / kubelet_volume_stats_capacity_bytes)*100)".format(label_match)
+        inodes_query = "ceil((1 - kubelet_volume_stats_inodes_free{{ {} }} / kubelet_volume_stats_inodes)*100)".format(label_match)
+    queries = [("bytes", bytes_query), ("inodes", inodes_query)]
+
+    # deriv() fits a linear regression to every PVC's available bytes at once, falling available bytes is growth
+    if forecast_horizon is not None or growth:
+        growth_query = "-deriv(kubelet_volume_stats_available_bytes{{ {} }}[{}s])".format(label_match, FORECAST_LOOKBACK)
+        available_query = "kubelet_volume_stats_available_bytes{{ {} }}".format(label_match)
+        queries += [("growth", growth_query), ("available", available_query)]
+
+    # Keep all series of a PVC if either of them is at or above the threshold, so we still get its disk usage if only its inodes are high
+    if above_percent is not None:
+        above_query = "({}) >= {} or ({}) >= {}".format(bytes_query, int(above_percent), inodes_query, int(above_percent))
+        if forecast_horizon is not None:
+            above_query += " or ({}) / ({} > 0) < {}".format(available_query, growth_query, int(forecast_horizon))
+        queries = [(metric_type, "({}) and on(namespace, persistentvolumeclaim) ({})".format(query, above_query)) for metric_type, query in queries]
+
+    return " or ".join('label_replace({}, "metric_type", "{}", "__name__", ".*")'.format(query, metric_type) for metric_type, query in queries)
+
+
+# Get a list of PVCs from Prometheus with their metrics of disk usage, and inode usage (in value_inodes) where available.
+# If above_percent is set, only PVCs with disk or inode usage at or above it are returned.  If forecast_horizon is set,
+# PVCs forecast to be full within it are also returned, and their growth and available bytes are in value_growth and
+# value_available where available, as they are if growth is set
+def fetch_pvcs_from_prometheus(url, label_match=PROMETHEUS_LABEL_MATCH, above_percent=None, forecast_horizon=None, growth=False):
+
+    query = build_pvc_usage_query(label_match, above_percent, forecast_horizon, growth)
+    # Queries too long for a URL (eg: selecting our shard of PVCs by name) are sent in the body of a POST instead
+    if len(query) > PROMETHEUS_MAX_GET_QUERY_LENGTH:
+        response = prometheus_request('POST', url + '/api/v1/query', data={'query': query})
+    else:
+        response = prometheus_get(url + '/api/v1/query', params={'query': query})
     response_object = response.json()
 
     if response_object['status'] != 'success':
@@ -489,41 +1315,52 @@ def fetch_pvcs_from_prometheus(url, label_match=PROMETHEUS_LABEL_MATCH):
             print("Prometheus Error: {}".format(response_object['error']))
             exit(-1)
 
-    #TODO: Inject here "trying" to get inode percentage usage also
-    try:
-        if version.parse(PROMETHEUS_VERSION) >= version.parse("2.30.0"):
-            inodes_response = requests.get(url + '/api/v1/query', params={'query': "ceil((1 - kubelet_volume_stats_inodes_free{{ {} }} / kubelet_volume_stats_inodes)*100) and present_over_time(kubelet_volume_stats_inodes_free{{ {} }}[1h])".format(label_match,label_match)}, timeout=HTTP_TIMEOUT, headers=headers)
-        else:
-            inodes_response = requests.get(url + '/api/v1/query', params={'query': "ceil((1 - kubelet_volume_stats_inodes_free{{ {} }} / kubelet_volume_stats_inodes)*100)".format(label_match,label_match)}, timeout=HTTP_TIMEOUT, headers=headers)
-        inodes_response_object = inodes_response.json()
-
-        # Prepare values to merge/inject with our first response_object list/array above
-        inject_values = {}
-        for item in inodes_response_object['data']['result']:
-            ourkey = "{}_{}".format(item['metric']['namespace'], item['metric']['persistentvolumeclaim'])
-            inject_values[ourkey] = item['value'][1]
-
-        output_response_object = []
-        # Inject/merge them...
-        for item in response_object['data']['result']:
-            try:
-                ourkey = "{}_{}".format(item['metric']['namespace'], item['metric']['persistentvolumeclaim'])
-                if ourkey in inject_values:
-                    item['value_inodes'] = inject_values[ourkey]
-            except Exception as e:
-                print("Caught exception while trying to inject, please report me...")
-                print(e)
-            output_response_object.append(item)
-    except Exception as e:
-        print("Caught exception while trying to inject inode usage, please report me...")
-        print(e)
+    # Split the results by metric_type, keyed by (namespace, persistentvolumeclaim)
+    bytes_items = {}
+    other_values = collections.defaultdict(dict)
+    for item in response_object['data']['result']:
+        try:
+            ourkey = (item['metric']['namespace'], item['metric']['persistentvolumeclaim'])
+            metric_type = item['metric'].pop('metric_type', 'bytes')
+            if metric_type == 'bytes':
+                bytes_items[ourkey] = item
+            else:
+                other_values[metric_type][ourkey] = item['value'][1]
+        except Exception as e:
+            print("Caught exception while trying to parse a PVC from prometheus, please report me...")
+            print(item)
+            print(e)
+
+    # Inject/merge our inode usage (and growth and available bytes if forecasting or sizing by growth) into our disk usage
+    output_response_object = []
+    for ourkey, item in bytes_items.items():
+        for metric_type, values in other_values.items():
+            if ourkey in values:
+                item['value_' + metric_type] = values[ourkey]
+        output_response_object.append(item)
+
+    return output_response_object
+
+
+# Fetch the usage of our PVCs for every one of these label matches concurrently, no more at once than we keep connections
+# open to Prometheus for.  Our Prometheus client isn't async, so each query runs in a thread of our event loop
+async def fetch_pvcs_from_prometheus_concurrently(url, label_matches, above_percent=None, forecast_horizon=None, growth=False):
+    semaphore = asyncio.Semaphore(PROMETHEUS_POOL_SIZE)
+
+    async def fetch(label_match):
+        async with semaphore:
+            return await asyncio.to_thread(fetch_pvcs_from_prometheus, url=url, label_match=label_match, above_percent=above_percent, forecast_horizon=forecast_horizon, growth=growth)
 
+    output_response_object = []
+    for items in await asyncio.gather(*[fetch(label_match) for label_match in label_matches]):
+        output_response_object += items
     return output_response_object
 
 
 # Describe an specific PVC
 def describe_pvc(namespace, name, simple=False):
-    api_response = kubernetes_core_api.list_namespaced_persistent_volume_claim(namespace, limit=1, field_selector="metadata.name=" + name, timeout_seconds=HTTP_TIMEOUT)
+    with record_http_request('kubernetes'):
+        api_response = get_cluster().kubernetes_core_api.list_namespaced_persistent_volume_claim(namespace, limit=1, field_selector="metadata.name=" + name, timeout_seconds=HTTP_TIMEOUT)
     # print(api_response)
     for item in api_response.items:
         # If the user wants pre-parsed, making it a bit easier to work with than a huge map of map of maps
@@ -533,8 +1370,18 @@ def describe_pvc(namespace, name, simple=False):
     raise Exception("No PVC found for {}:{}".format(namespace,name))
 
 
-# Convert an PVC to an involved object for Kubernetes events
+# Convert an PVC to an involved object for Kubernetes events.  This accepts either a PVC from the kubernetes-client (eg: as
+# returned by describe_pvc or scale_up_pvc) or one of our records from convert_pvc_to_simpler_dict
 def get_involved_object_from_pvc(pvc):
+    if isinstance(pvc, (dict, PVCRecord)):
+        return kubernetes.client.V1ObjectReference(
+            api_version="v1",
+            kind="PersistentVolumeClaim",
+            name=pvc['name'],
+            namespace=pvc['namespace'],
+            resource_version=pvc['resource_version'],
+            uid=pvc['uid'],
+        )
     return kubernetes.client.V1ObjectReference(
         api_version="v1",
         kind="PersistentVolumeClaim",
@@ -544,35 +1391,78 @@ def get_involved_object_from_pvc(pvc):
         uid=pvc.metadata.uid,
     )
 
-# Send events to Kubernetes.  This is used when we modify PVCs
-def send_kubernetes_event(namespace, name, reason, message, type="Normal"):
+# Our events are named after the PVC and reason, so every repeat of the same event for the same PVC lands on the same object
+def get_event_name(pvc_uid, namespace, name, reason):
+    suffix = hashlib.sha1("{}/{}/{}/{}".format(pvc_uid, namespace, name, reason).encode('utf-8')).hexdigest()[:16]
+    return "{}.{}".format(name[:253 - len(suffix) - 1], suffix)
+
+# Events.k8s.io wants timestamps with microseconds
+def get_event_timestamp():
+    return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+# Bump the series of an event which already exists, instead of creating a new event object for every repeat.  Kubernetes
+# doesn't allow changing the note (or reason, action and regarding) of an event, so it keeps the note of its first occurrence
+def patch_event_series(namespace, event_name, count):
+    with record_http_request('kubernetes'):
+        get_cluster().kubernetes_events_api.patch_namespaced_event(
+            event_name, namespace,
+            body={"series": {"count": count, "lastObservedTime": get_event_timestamp()}},
+            field_manager="volume_autoscaler",
+        )
+    get_cluster().event_series_cache.set(event_name, count)
+
+# Send events to Kubernetes.  This is used when we modify PVCs.  If we already have the PVC (our record, or a PVC from
+# the kubernetes-client) pass it in as pvc, so we don't need to look it up from Kubernetes again.  Events are deduplicated
+# per PVC and reason using events.k8s.io/v1 series, so a PVC which keeps failing only ever has one event per reason
+def send_kubernetes_event(namespace, name, reason, message, type="Normal", pvc=None):
 
     try:
-        # Lookup our PVC
-        pvc = describe_pvc(namespace, name)
+        # Lookup our PVC, only if we weren't given one we can use
+        if pvc is None or (isinstance(pvc, (dict, PVCRecord)) and not pvc.get('uid')):
+            pvc = describe_pvc(namespace, name)
 
-        # Generate our metadata and object relation for this event
+        # Generate our object relation for this event, and the name this event always has for this PVC and reason
         involved_object = get_involved_object_from_pvc(pvc)
-        source = kubernetes.client.V1EventSource(component="volume-autoscaler")
-        metadata = kubernetes.client.V1ObjectMeta(
-            namespace=namespace,
-            name=name + ''.join([random.choice('123456789abcdef') for n in range(16)]),
-        )
+        event_name = get_event_name(involved_object.uid, namespace, name, reason)
+
+        # If we've sent this recently, simply bump its series.  If it has expired from Kubernetes since, create it again below
+        count = get_cluster().event_series_cache.get(event_name)
+        if count:
+            try:
+                patch_event_series(namespace, event_name, count + 1)
+                return
+            except ApiException as e:
+                if e.status != 404:
+                    raise
+                get_cluster().event_series_cache.unset(event_name)
 
         # Generate our event body with the reason and message set
-        body = kubernetes.client.CoreV1Event(
-                    involved_object=involved_object,
-                    metadata=metadata,
+        body = kubernetes.client.EventsV1Event(
+                    metadata=kubernetes.client.V1ObjectMeta(namespace=namespace, name=event_name),
+                    event_time=get_event_timestamp(),
+                    action="Resize",
                     reason=reason,
-                    message=message,
+                    note=message[:1024],
                     type=type,
-                    source=source,
-                    first_timestamp=datetime.datetime.now(datetime.timezone.utc).isoformat()
+                    regarding=involved_object,
+                    reporting_controller=EVENT_REPORTING_CONTROLLER,
+                    reporting_instance=EVENT_REPORTING_INSTANCE,
                )
 
-        api_response = kubernetes_core_api.create_namespaced_event(namespace, body, field_manager="volume_autoscaler")
+        try:
+            with record_http_request('kubernetes'):
+                get_cluster().kubernetes_events_api.create_namespaced_event(namespace, body, field_manager="volume_autoscaler")
+            get_cluster().event_series_cache.set(event_name, 1)
+        except ApiException as e:
+            # If it already exists (eg: we restarted and lost our cache) continue its series from where it was
+            if e.status != 409:
+                raise
+            with record_http_request('kubernetes'):
+                existing_event = get_cluster().kubernetes_events_api.read_namespaced_event(event_name, namespace)
+            count = existing_event.series.count if existing_event.series else 1
+            patch_event_series(namespace, event_name, count + 1)
     except ApiException as e:
-        print("Exception when calling CoreV1Api->create_namespaced_event: %s\n" % e)
+        print("Exception when calling EventsV1Api for event {} on {}.{}: {}\n".format(reason, namespace, name, e))
     except:
         traceback.print_exc()
 
@@ -581,8 +1471,8 @@ def print_human_readable_volume_dict(input_dict):
     for key in input_dict:
         print("    {}: {}".format(key.rjust(25), input_dict[key]), end='')
         if key in ['volume_size_spec','volume_size_spec_bytes','volume_size_status','volume_size_status_bytes','scale_up_min_increment','scale_up_max_increment','scale_up_max_size'] and is_integer_or_float(input_dict[key]):
-            print(" ({})".format(convert_bytes_to_storage(input_dict[key])), end='')
-        if key in ['scale_cooldown_time']:
+            print(" ({})".format(convert_bytes_to_storage(input_dict[key], is_binary_storage(input_dict.get('volume_size_spec', '')))), end='')
+        if key in ['scale_cooldown_time','forecast_horizon']:
             print(" ({})".format(time.strftime('%H:%M:%S', time.gmtime(input_dict[key]))), end='')
         if key in ['last_resized_at']:
             print(" ({})".format(time.strftime('%Y-%m-%d %H:%M:%S %Z %z', time.localtime(input_dict[key]))), end='')
@@ -1,276 +1,684 @@
 #!/usr/bin/env python3
 import os
 import time
-from helpers import INTERVAL_TIME, PROMETHEUS_URL, DRY_RUN, VERBOSE, get_settings_for_prometheus_metrics, is_integer_or_float, print_human_readable_volume_dict
-from helpers import convert_bytes_to_storage, scale_up_pvc, testIfPrometheusIsAccessible, describe_all_pvcs, send_kubernetes_event
-from helpers import fetch_pvcs_from_prometheus, printHeaderAndConfiguration, calculateBytesToScaleTo, GracefulKiller, cache
-from prometheus_client import start_http_server, Summary, Gauge, Counter, Info
+import asyncio
+from helpers import INTERVAL_TIME, DRY_RUN, VERBOSE, get_settings_for_prometheus_metrics, is_integer_or_float, print_human_readable_volume_dict
+from helpers import convert_bytes_to_storage, is_binary_storage, scale_up_pvc, testIfPrometheusIsAccessible, describe_all_pvcs, send_kubernetes_event
+from helpers import fetch_pvcs_from_prometheus_concurrently, printHeaderAndConfiguration, GracefulKiller
+from helpers import ADAPTIVE_SCHEDULING_ENABLED, PVCScheduler, build_namespace_label_matches, build_pvc_label_matches, PROMETHEUS_LABEL_MATCH
+from helpers import FORECAST_ENABLED, get_largest_forecast_horizon, has_scale_up_growth_windows, observe_http_request, PVC_WATCH_ENABLED, PVCInformer, ResizeExecutor, PROMETHEUS_FILTER_BY_THRESHOLD, get_lowest_scale_above_percent, estimate_memory_per_pvc
+from helpers import CLUSTERS_CONFIG, load_clusters, get_cluster, current_cluster, ClusterPrefixedStream
+from prometheus_client import start_http_server, Histogram, Gauge, Counter, Info
 import slack
+import state_store
+import sharding
+import decisions
 import sys, traceback
+import contextvars
+import threading
 
 # Initialize our Prometheus metrics (counters)
 PROMETHEUS_METRICS = {}
-PROMETHEUS_METRICS['resize_evaluated']  = Counter('volume_autoscaler_resize_evaluated',  'Counter which is increased every time we evaluate resizing PVCs')
-PROMETHEUS_METRICS['resize_attempted']  = Counter('volume_autoscaler_resize_attempted',  'Counter which is increased every time we attempt to resize')
-PROMETHEUS_METRICS['resize_successful'] = Counter('volume_autoscaler_resize_successful', 'Counter which is increased every time we successfully resize')
-PROMETHEUS_METRICS['resize_failure']    = Counter('volume_autoscaler_resize_failure',    'Counter which is increased every time we fail to resize')
+PROMETHEUS_METRICS['resize_evaluated']  = Counter('volume_autoscaler_resize_evaluated',  'Counter which is increased every time we evaluate resizing PVCs', ['cluster'])
+PROMETHEUS_METRICS['resize_attempted']  = Counter('volume_autoscaler_resize_attempted',  'Counter which is increased every time we attempt to resize', ['cluster'])
+PROMETHEUS_METRICS['resize_successful'] = Counter('volume_autoscaler_resize_successful', 'Counter which is increased every time we successfully resize', ['cluster'])
+PROMETHEUS_METRICS['resize_failure']    = Counter('volume_autoscaler_resize_failure',    'Counter which is increased every time we fail to resize', ['cluster'])
+PROMETHEUS_METRICS['pvcs_evaluated']    = Counter('volume_autoscaler_pvcs_evaluated',    'Counter which is increased for every PVC we evaluate, rate() of this is PVCs evaluated per second', ['cluster'])
+PROMETHEUS_METRICS['pvcs_skipped']      = Counter('volume_autoscaler_pvcs_skipped',      'Counter which is increased for every PVC we skip evaluating because nothing about it changed since we found it below its threshold', ['cluster'])
 # Initialize our Prometheus metrics (gauges)
-PROMETHEUS_METRICS['num_valid_pvcs'] = Gauge('volume_autoscaler_num_valid_pvcs', 'Gauge with the number of valid PVCs detected which we found to consider for scaling')
-PROMETHEUS_METRICS['num_valid_pvcs'].set(0)
-PROMETHEUS_METRICS['num_pvcs_above_threshold'] = Gauge('volume_autoscaler_num_pvcs_above_threshold', 'Gauge with the number of PVCs detected above the desired percentage threshold')
-PROMETHEUS_METRICS['num_pvcs_above_threshold'].set(0)
-PROMETHEUS_METRICS['num_pvcs_below_threshold'] = Gauge('volume_autoscaler_num_pvcs_below_threshold', 'Gauge with the number of PVCs detected below the desired percentage threshold')
-PROMETHEUS_METRICS['num_pvcs_below_threshold'].set(0)
+PROMETHEUS_METRICS['num_valid_pvcs'] = Gauge('volume_autoscaler_num_valid_pvcs', 'Gauge with the number of valid PVCs detected which we found to consider for scaling', ['cluster'])
+PROMETHEUS_METRICS['num_pvcs_above_threshold'] = Gauge('volume_autoscaler_num_pvcs_above_threshold', 'Gauge with the number of PVCs detected above the desired percentage threshold', ['cluster'])
+PROMETHEUS_METRICS['num_pvcs_below_threshold'] = Gauge('volume_autoscaler_num_pvcs_below_threshold', 'Gauge with the number of PVCs detected below the desired percentage threshold', ['cluster'])
+PROMETHEUS_METRICS['num_tracked_pvcs'] = Gauge('volume_autoscaler_num_tracked_pvcs', 'Gauge with the number of PVCs in Kubernetes we are tracking', ['cluster'])
+PROMETHEUS_METRICS['tracked_pvc_memory_bytes'] = Gauge('volume_autoscaler_tracked_pvc_memory_bytes', 'Gauge with the estimated memory used (in bytes) per PVC we are tracking', ['cluster'])
+PROMETHEUS_METRICS['num_pvcs_due'] = Gauge('volume_autoscaler_num_pvcs_due', 'Gauge with the number of PVCs which were due to be checked in our last loop, when scheduling adaptively', ['cluster'])
+PROMETHEUS_METRICS['shard_members'] = Gauge('volume_autoscaler_shard_members', 'Gauge with the number of replicas we are splitting our PVCs between, when sharding', ['cluster'])
+PROMETHEUS_METRICS['shard_owned_pvcs'] = Gauge('volume_autoscaler_shard_owned_pvcs', 'Gauge with the number of PVCs in our shard which we may resize, when sharding', ['cluster'])
+PROMETHEUS_METRICS['loop_lag'] = Gauge('volume_autoscaler_loop_lag_seconds', 'Gauge with how many seconds late our last loop started, compared to when it was scheduled every INTERVAL_TIME seconds (or when a PVC was next due, when scheduling adaptively)', ['cluster'])
+# Initialize our Prometheus metrics (histograms), our loops can take minutes on large clusters so go higher than the default buckets
+LOOP_DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float("inf"))
+PROMETHEUS_METRICS['loop_duration']  = Histogram('volume_autoscaler_loop_duration_seconds',       'Histogram of how long each run of our main loop took', ['cluster'], buckets=LOOP_DURATION_BUCKETS)
+PROMETHEUS_METRICS['phase_duration'] = Histogram('volume_autoscaler_loop_phase_duration_seconds', 'Histogram of how long each phase of our main loop took (describe_pvcs, fetch_prometheus, evaluate, save_state, resize)', ['phase', 'cluster'], buckets=LOOP_DURATION_BUCKETS)
 # Initialize our Prometheus metrics (info/settings)
 PROMETHEUS_METRICS['info'] = Info('volume_autoscaler_release', 'Release/version information about this volume autoscaler service')
 PROMETHEUS_METRICS['info'].info({'version': '1.0.7'})
 PROMETHEUS_METRICS['settings'] = Info('volume_autoscaler_settings', 'Settings currently used in this service')
 PROMETHEUS_METRICS['settings'].info(get_settings_for_prometheus_metrics())
 
+# One of our metrics, labelled with the cluster we're working on (an empty label when we only manage one)
+def metric(name, *labels):
+    return PROMETHEUS_METRICS[name].labels(*labels, get_cluster().name)
+
 # Other globals
 MAIN_LOOP_TIME = 1
+slack_notifier = None
+
+
+# Which of our requests failed, with the exception from it as its cause
+class FetchFailed(Exception):
+    pass
+
+
+# Resize a volume, sending events and Slack messages about it.  This runs on our ResizeExecutor worker threads.  If we're
+# sharding, it may have moved to another replica's shard since we queued it, then we leave it to them
+def resize_volume(volume_description, volume_name, volume_namespace, pvc, resize_to_bytes, status_output, shard=None):
+    with metric('phase_duration', 'resize').time():
+        if shard and not shard.owns(volume_namespace, volume_name):
+            print("SKIPPING resizing {} because it is no longer in our shard".format(volume_description))
+            return
+        metric('resize_attempted').inc()
+        binary = is_binary_storage(pvc['volume_size_spec'])
+        print("RESIZING {} from {} to {}".format(volume_description, convert_bytes_to_storage(pvc['volume_size_status_bytes'], binary), convert_bytes_to_storage(resize_to_bytes, binary)))
+
+        # Send event that we're starting to request a resize
+        send_kubernetes_event(
+            name=volume_name, namespace=volume_namespace, reason="VolumeResizeRequested",
+            message="Requesting {}".format(status_output), pvc=pvc
+        )
+
+        if scale_up_pvc(volume_namespace, volume_name, resize_to_bytes):
+            metric('resize_successful').inc()
+            # Save this to cache for debouncing
+            get_cluster().cache.set(f"{volume_description}-has-been-resized", True)
+            # Print success to console
+            status_output = "Successfully requested {}".format(status_output)
+            print(status_output)
+            # Intentionally skipping sending an event to Kubernetes on success, the above event is enough for now until we detect if resize succeeded
+            # Print success to Slack
+            if slack_notifier:
+                print(f"Queueing slack message to {slack.SLACK_CHANNEL}")
+                slack_notifier.notify(status_output)
+        else:
+            metric('resize_failure').inc()
+            # Print failure to console
+            status_output = "FAILED requesting {}".format(status_output)
+            print(status_output)
+            # Print failure to Kubernetes Events
+            send_kubernetes_event(
+                name=volume_name, namespace=volume_namespace, reason="VolumeResizeRequestFailed",
+                message=status_output, type="Warning", pvc=pvc
+            )
+            # Print failure to Slack
+            if slack_notifier:
+                print(f"Queueing slack message to {slack.SLACK_CHANNEL}")
+                slack_notifier.notify(status_output, severity="error")
+
+
+# Save our alert intervals and resize debounces to our state store.  When sharding, the other replicas share it, and we
+# only save those of the PVCs in our shard
+def save_state(pvc_state_store, shard=None):
+    with metric('phase_duration', 'save_state').time():
+        try:
+            pvc_state_store.save(get_cluster().cache.dump(), owns=shard.owns_cache_key if shard else None)
+        except Exception:
+            print("Exception while trying to save our state to the {} state store".format(pvc_state_store.backend))
+            traceback.print_exc()
 
-# Entry point and main application loop
-if __name__ == "__main__":
 
-    # Test if our prometheus URL works before continuing
-    testIfPrometheusIsAccessible(PROMETHEUS_URL)
+# The options of our usage query which depend on our PVCs (eg: their scale-above-percent and forecast-horizon annotations)
+def get_usage_query_options(pvcs_in_kubernetes, scheduler=None):
+    above_percent = None
+    # Only query the volumes which could be in alert unless we're verbose.  When scheduling adaptively we need the usage of
+    # every PVC we check, to know when to check it next
+    if PROMETHEUS_FILTER_BY_THRESHOLD and not VERBOSE and not scheduler:
+        above_percent = get_lowest_scale_above_percent(pvcs_in_kubernetes)
+    return {
+        'above_percent': above_percent,
+        'forecast_horizon': get_largest_forecast_horizon(pvcs_in_kubernetes) if FORECAST_ENABLED else None,
+        'growth': has_scale_up_growth_windows(pvcs_in_kubernetes),
+    }
+
+
+# Use our informer's index if it has finished its initial list, otherwise fallback to listing them all
+def describe_pvcs(pvc_informer):
+    with metric('phase_duration', 'describe_pvcs').time():
+        if pvc_informer and pvc_informer.has_synced():
+            return pvc_informer.get_pvcs()
+        return describe_all_pvcs(simple=True)
+
+
+async def fetch_usage(label_matches, usage_query_options):
+    with metric('phase_duration', 'fetch_prometheus').time():
+        return await fetch_pvcs_from_prometheus_concurrently(get_cluster().prometheus_url, label_matches, **usage_query_options)
+
+
+# Find our PVCs in Kubernetes and their usage in Prometheus.  Which usage we query for depends on our PVCs, but their
+# settings rarely change, so we query with the label matches and options from our last loop's PVCs while we wait for this
+# loop's, and only query again if they changed.  When scheduling adaptively our PVCs decide which are due, so we have to
+# wait for them first.  When sharding, our PVCs are only those in our shard.  Returns our PVCs, which of them are due (when
+# scheduling adaptively), their usage and the options we queried it with, or raises a FetchFailed saying which of these failed
+async def fetch_pvcs_and_usage(pvc_informer, scheduler=None, shard=None):
+    cluster = get_cluster()
+    describing = asyncio.create_task(asyncio.to_thread(describe_pvcs, pvc_informer))
+    fetching = None
+    if not scheduler and cluster.last_usage_query is not None:
+        fetching = asyncio.create_task(fetch_usage(*cluster.last_usage_query))
+
+    try:
+        pvcs_in_kubernetes = await describing
+    except Exception as e:
+        if fetching:
+            await asyncio.gather(fetching, return_exceptions=True)
+        raise FetchFailed("describe all PVCs") from e
+
+    # If we're sharding, only the PVCs in our shard are ours to check, we query for them by their names
+    label_matches = [PROMETHEUS_LABEL_MATCH]
+    if shard:
+        pvcs_in_kubernetes = shard.get_owned_pvcs(pvcs_in_kubernetes)
+        metric('shard_members').set(len(shard.get_members()))
+        metric('shard_owned_pvcs').set(len(pvcs_in_kubernetes))
+        label_matches = build_pvc_label_matches(pvcs_in_kubernetes.values())
+
+    # If we're scheduling adaptively, only the PVCs which are due need checking, we query for them by their namespaces
+    due = None
+    if scheduler:
+        scheduler.sync(pvcs_in_kubernetes)
+        due = scheduler.pop_due()
+        metric('num_pvcs_due').set(len(due))
+        if not due:
+            return pvcs_in_kubernetes, due, [], None
+        if shard:
+            label_matches = build_pvc_label_matches([pvcs_in_kubernetes[volume_description] for volume_description in due])
+        else:
+            label_matches = build_namespace_label_matches(
+                set(pvcs_in_kubernetes[volume_description]['namespace'] for volume_description in due),
+                set(pvcs_in_kubernetes[volume_description]['namespace'] for volume_description in pvcs_in_kubernetes),
+            )
+        print("Checking {} of {} PVCs which are due, in {} queries".format(len(due), len(pvcs_in_kubernetes), len(label_matches)))
+
+    try:
+        usage_query = (label_matches, get_usage_query_options(pvcs_in_kubernetes, scheduler))
+        pvcs_in_prometheus = None
+        if fetching:
+            try:
+                pvcs_in_prometheus = await fetching
+            except Exception:
+                # It may have failed because of options our PVCs no longer have, so try again below with theirs
+                print("Exception while trying to fetch PVC metrics from prometheus, retrying")
+                traceback.print_exc()
+        if pvcs_in_prometheus is None or usage_query != cluster.last_usage_query:
+            pvcs_in_prometheus = await fetch_usage(*usage_query)
+        cluster.last_usage_query = usage_query
+    except Exception as e:
+        raise FetchFailed("fetch PVC metrics from prometheus") from e
+
+    # Our label matches for our shard can match PVCs of the same names in other namespaces, which belong to other shards
+    if shard:
+        pvcs_in_prometheus = [item for item in pvcs_in_prometheus if "{}.{}".format(item['metric']['namespace'], item['metric']['persistentvolumeclaim']) in pvcs_in_kubernetes]
+    return pvcs_in_kubernetes, due, pvcs_in_prometheus, usage_query[1]
+
+
+# One run of our main loop: find our PVCs and their usage, decide which need resizing, queue those resizes on our
+# resize_executor, then save our state.  pvc_informer is optional, without it we list all PVCs from Kubernetes.  scheduler
+# is optional too, with it we only fetch the usage of the PVCs which are due and schedule when each is next due.  And so is
+# shard, with it we only check and resize the PVCs in our shard
+def run_loop(pvc_informer, resize_executor, pvc_state_store, scheduler=None, shard=None):
+    cluster = get_cluster()
+    # How many intervals each volume has been in alert, and which we recently resized
+    cache = cluster.cache
+    # The inputs (resourceVersion and usage) we last evaluated each PVC with, and what we decided.  A PVC we found below its
+    # threshold which hasn't changed since would be decided the same again, so we skip it.  Any other decision involves its
+    # alert interval counter, which is a timer due every loop, so those are always evaluated
+    last_evaluations = cluster.last_evaluations
+
+    # In every loop, fetch all our pvcs state from Kubernetes and their usage from Prometheus
+    metric('resize_evaluated').inc()
+    try:
+        pvcs_in_kubernetes, due, pvcs_in_prometheus, usage_query_options = asyncio.run(fetch_pvcs_and_usage(pvc_informer, scheduler, shard))
+    except FetchFailed as e:
+        print("Exception while trying to {}".format(e))
+        traceback.print_exception(type(e.__cause__), e.__cause__, e.__cause__.__traceback__)
+        return
+    metric('num_tracked_pvcs').set(len(pvcs_in_kubernetes))
+    metric('tracked_pvc_memory_bytes').set(estimate_memory_per_pvc(pvcs_in_kubernetes))
+    if scheduler and not due:
+        return
+
+    above_percent = usage_query_options['above_percent']
+    forecast_horizon = usage_query_options['forecast_horizon']
+    growth = usage_query_options['growth']
+    if above_percent is None:
+        print("Querying and found {} valid PVCs to assess in prometheus".format(len(pvcs_in_prometheus)))
+    elif forecast_horizon is not None:
+        print("Querying and found {} valid PVCs at or above {}% or forecast to be full within {} seconds to assess in prometheus".format(len(pvcs_in_prometheus), above_percent, forecast_horizon))
+    else:
+        print("Querying and found {} valid PVCs at or above {}% to assess in prometheus".format(len(pvcs_in_prometheus), above_percent))
+    metric('num_valid_pvcs').set(len(pvcs_in_prometheus))
+
+    # Iterate through every item and handle it accordingly
+    evaluate_started = time.perf_counter()
+    metric('num_pvcs_above_threshold').set(0)  # Reset these each loop
+    metric('num_pvcs_below_threshold').set(0)  # Reset these each loop
+    num_evaluated = 0
+    num_skipped = 0
+
+    # Forget what we decided for PVCs which no longer exist
+    for volume_description in [volume_description for volume_description in last_evaluations if volume_description not in pvcs_in_kubernetes]:
+        del last_evaluations[volume_description]
+
+    # If Prometheus only returned PVCs above the threshold (or forecast to be full soon), every other PVC is below it so reset its alert counter
+    if above_percent is not None:
+        volumes_in_prometheus = set("{}.{}".format(item['metric']['namespace'], item['metric']['persistentvolumeclaim']) for item in pvcs_in_prometheus)
+        for volume_description in pvcs_in_kubernetes:
+            if volume_description not in volumes_in_prometheus:
+                metric('num_pvcs_below_threshold').inc()
+                evaluation = ((pvcs_in_kubernetes[volume_description]['resource_version'], above_percent), 'below_threshold')
+                if last_evaluations.get(volume_description) == evaluation:
+                    num_skipped += 1
+                    continue
+                num_evaluated += 1
+                cache.unset(volume_description)
+                last_evaluations[volume_description] = evaluation
+
+    # PVCs which were due but have no usage in Prometheus (eg: they aren't mounted) don't need checking again any time soon
+    if scheduler:
+        volumes_in_prometheus = set("{}.{}".format(item['metric']['namespace'], item['metric']['persistentvolumeclaim']) for item in pvcs_in_prometheus)
+        for volume_description in due:
+            if volume_description not in volumes_in_prometheus:
+                scheduler.schedule(volume_description, scheduler.max_interval)
+
+    # First gather the usage and alert state of every volume we need to evaluate, as columns for our decision engine
+    evaluating = []
+    columns = {column: [] for column in decisions.COLUMN_TYPES}
+    for item in pvcs_in_prometheus:
+        try:
+            volume_name = str(item['metric']['persistentvolumeclaim'])
+            volume_namespace = str(item['metric']['namespace'])
+            volume_description = "{}.{}".format(item['metric']['namespace'], item['metric']['persistentvolumeclaim'])
+            volume_used_percent = int(item['value'][1])
+
+            # Precursor check to ensure we have info for this pvc in kubernetes object
+            if volume_description not in pvcs_in_kubernetes:
+                print("ERROR: The volume {} was not found in Kubernetes but had metrics in Prometheus.  This may be an old volume, was just deleted, or some random jitter is occurring.  If this continues to occur, please report an bug.  You might also be using an older version of Prometheus, please make sure you're using v2.30.0 or newer before reporting a bug for this.".format(volume_description))
+                continue
+            # Our PVCs may be the records in our informer's index, so add this loop's usage to a copy of them instead
+            pvc = pvcs_in_kubernetes[volume_description] = pvcs_in_kubernetes[volume_description].copy()
+
+            pvc['volume_used_percent'] = volume_used_percent
+            try:
+                volume_used_inode_percent = int(item['value_inodes'])
+            except:
+                volume_used_inode_percent = -1
+            pvc['volume_used_inode_percent'] = volume_used_inode_percent
+
+            # If we're forecasting or sizing by growth, how fast this volume is filling up and how soon it will be full at that rate (-1 if it isn't)
+            volume_growth = 0
+            volume_available = -1
+            volume_seconds_until_full = -1
+            if FORECAST_ENABLED or growth:
+                try:
+                    volume_growth = float(item['value_growth'])
+                    volume_available = float(item['value_available'])
+                    volume_seconds_until_full = int(volume_available / volume_growth) if volume_growth > 0 else -1
+                except:
+                    volume_growth = 0
+                    volume_available = -1
+                    volume_seconds_until_full = -1
+                pvc['volume_growth_bytes_per_second'] = volume_growth
+                pvc['volume_seconds_until_full'] = volume_seconds_until_full
+
+            # If we're scheduling adaptively, decide when to check this volume next from what we just learned about it
+            now = time.time()
+            if scheduler:
+                scheduler.schedule(volume_description, scheduler.get_next_check_delay(pvc), now)
+
+            # Skip this volume if it was below its threshold and nothing about it has changed since, unless we're verbose
+            evaluation_inputs = (pvc['resource_version'], volume_used_percent, volume_used_inode_percent, volume_growth, volume_available)
+            if not VERBOSE and last_evaluations.get(volume_description) == (evaluation_inputs, 'below_threshold'):
+                metric('num_pvcs_below_threshold').inc()
+                num_skipped += 1
+                continue
+            num_evaluated += 1
+
+            # How many intervals this has been in alert, and whether this is another one if it still is.  When scheduling adaptively
+            # we may check a volume more often than every INTERVAL_TIME, so then we only count once per INTERVAL_TIME to keep alerts as long
+            alert_intervals = cache.get(volume_description) or 0
+            count_interval = not scheduler or now - (cache.get(f"{volume_description}-alert-counted-at") or 0) >= INTERVAL_TIME
+
+            for column in decisions.RECORD_COLUMNS:
+                columns[column].append(pvc[column])
+            columns['volume_used_percent'].append(volume_used_percent)
+            columns['volume_used_inode_percent'].append(volume_used_inode_percent)
+            columns['volume_growth_bytes_per_second'].append(volume_growth)
+            columns['volume_available_bytes'].append(volume_available)
+            columns['alert_intervals'].append(alert_intervals)
+            columns['count_interval'].append(count_interval)
+            columns['recently_resized'].append(bool(cache.get(f"{volume_description}-has-been-resized")))
+            evaluating.append((volume_description, volume_name, volume_namespace, evaluation_inputs, now))
 
-    # Startup our prometheus metrics endpoint
-    start_http_server(8000)
+        except Exception:
+            print("Exception caught while trying to process record")
+            print(item)
+            traceback.print_exc()
 
-    # TODO: Test k8s access, or just test on-the-fly below?
+    # Then decide what to do with all of them at once
+    cooldown_now = int(time.mktime(time.gmtime()))
+    plan = decisions.plan(columns, now=cooldown_now, forecast_enabled=FORECAST_ENABLED)
+    actions = plan['action'].tolist()
+    planned_alert_intervals = plan['alert_intervals'].tolist()
+    space_alerts = plan['space_alert'].tolist()
+    inode_alerts = plan['inode_alert'].tolist()
+    forecast_alerts = plan['forecast_alert'].tolist()
+    seconds_until_full = plan['seconds_until_full'].tolist()
+    growth_sizes = plan['growth_size'].tolist()
+    resizes_to_bytes = plan['resize_to_bytes'].tolist()
+
+    # And act on what we decided for each of them
+    for index, (volume_description, volume_name, volume_namespace, evaluation_inputs, now) in enumerate(evaluating):
+        try:
+            pvc = pvcs_in_kubernetes[volume_description]
+            action = actions[index]
+            volume_used_percent = columns['volume_used_percent'][index]
+            volume_used_inode_percent = columns['volume_used_inode_percent'][index]
+            volume_growth = columns['volume_growth_bytes_per_second'][index]
+            volume_seconds_until_full = seconds_until_full[index]
+            alert_intervals = planned_alert_intervals[index]
 
-    # Reporting our configuration to the end-user
-    printHeaderAndConfiguration()
+            if VERBOSE:
+                print("  VERBOSE DETAILS:")
+                print("-------------------------------------------------------------------------------------------------------------")
+                print_human_readable_volume_dict(pvc)
+                print("-------------------------------------------------------------------------------------------------------------")
+                print("Volume {} has {}% disk space used of the {} available".format(volume_description,volume_used_percent,pvc['volume_size_status']))
+                if volume_used_inode_percent > -1:
+                    print("Volume {} has {}% inodes used".format(volume_description,volume_used_inode_percent))
+                if volume_seconds_until_full > -1:
+                    print("Volume {} is forecast to be full in {} seconds".format(volume_description,volume_seconds_until_full))
+
+            # Check if we are NOT in an alert condition
+            if action == decisions.BELOW_THRESHOLD:
+                metric('num_pvcs_below_threshold').inc()
+                cache.unset(volume_description)
+                last_evaluations[volume_description] = (evaluation_inputs, 'below_threshold')
+                if VERBOSE:
+                    print("  and is not above {}% used".format(pvc['scale_above_percent']))
+                    if volume_used_inode_percent > -1:
+                        print("  and is not above {}% inodes used".format(pvc['scale_above_percent']))
+                if VERBOSE:
+                    print("=============================================================================================================")
+                continue
+            else:
+                metric('num_pvcs_above_threshold').inc()
+                last_evaluations[volume_description] = (evaluation_inputs, 'in_alert')
+
+            # Describe sizes in the same base (eg: Gi or G) as this volume's size was originally requested in
+            binary = is_binary_storage(pvc['volume_size_spec'])
+
+            # If we are in alert condition, record this in our simple in-memory counter
+            if alert_intervals != columns['alert_intervals'][index]:
+                cache.set(volume_description, alert_intervals)
+                if scheduler:
+                    cache.set(f"{volume_description}-alert-counted-at", now)
+
+            # Incase we aren't verbose, and didn't print this above, now that we're in alert we will print this
+            if not VERBOSE:
+                print("Volume {} is {}% in-use of the {} available".format(volume_description,volume_used_percent,pvc['volume_size_status']))
+                print("Volume {} is {}% inode in-use".format(volume_description,volume_used_inode_percent))
+
+            # Print the alert status and reason
+            if space_alerts[index]:
+                print("  BECAUSE it has space used above {}%".format(pvc['scale_above_percent']))
+            elif inode_alerts[index]:
+                print("  BECAUSE it has inodes used above {}%".format(pvc['scale_above_percent']))
+            if forecast_alerts[index]:
+                print("  BECAUSE it is forecast to be full in {} seconds, within its forecast horizon of {} seconds".format(volume_seconds_until_full, pvc['forecast_horizon']))
+            print("  ALERT has been for {} period(s) which needs to at least {} period(s) to scale".format(alert_intervals, pvc['scale_after_intervals']))
+
+            # Check if we are NOT in a possible scale condition, unless it will be full too soon to wait
+            if action == decisions.WAITING_FOR_INTERVALS:
+                print("  BUT need to wait for {} intervals in alert before considering to scale".format( pvc['scale_after_intervals'] ))
+                print("  FYI this has desired_size {} and current size {}".format( convert_bytes_to_storage(pvc['volume_size_spec_bytes'], binary), convert_bytes_to_storage(pvc['volume_size_status_bytes'], binary)))
+                print("=============================================================================================================")
+                continue
 
-    # Setup our graceful handling of kubernetes signals
-    killer = GracefulKiller()
-    last_run = 0
+            # If we are in a possible scale condition, check if we recently scaled it and handle accordingly
+            if action == decisions.COOLING_DOWN:
+                print("  BUT need to wait {} seconds to scale since the last scale time {} seconds ago".format( abs(pvc['last_resized_at'] + pvc['scale_cooldown_time']) - cooldown_now, abs(pvc['last_resized_at'] - cooldown_now) ))
+                print("=============================================================================================================")
+                continue
+
+            # If we reach this far then we will be scaling the disk, all preconditions were passed from above
+            if pvc['last_resized_at'] == 0:
+                print("  AND we need to scale it immediately, it has never been scaled previously")
+            else:
+                print("  AND we need to scale it immediately, it last scaled {} seconds ago".format( abs((pvc['last_resized_at'] + pvc['scale_cooldown_time']) - cooldown_now) ))
+
+            # How many bytes to resize to based on the parameters provided globally and per-this pv annotations, and how fast it is growing if it is sized by that
+            growth_size = growth_sizes[index]
+            resize_to_bytes = resizes_to_bytes[index]
+            # TODO: Check here if storage class has the ALLOWVOLUMEEXPANSION flag set to true, read the SC from pvc['storage_class'] ?
+
+            # If our resize bytes is less than our original size (because the user set the max-bytes to something too low)
+            if action == decisions.INVALID_SIZE:
+                print("-------------------------------------------------------------------------------------------------------------")
+                print("  Error/Exception while trying to scale this up.  Is it possible your maximum SCALE_UP_MAX_SIZE is too small?")
+                print("-------------------------------------------------------------------------------------------------------------")
+                print("   Maximum Size: {} ({})".format(pvc['scale_up_max_size'], convert_bytes_to_storage(pvc['scale_up_max_size'], binary)))
+                print("  Original Size: {} ({})".format(pvc['volume_size_status_bytes'], convert_bytes_to_storage(pvc['volume_size_status_bytes'], binary)))
+                print("      Resize To: {} ({})".format(resize_to_bytes, convert_bytes_to_storage(resize_to_bytes, binary)))
+                print("-------------------------------------------------------------------------------------------------------------")
+                print(" Volume causing failure:")
+                print_human_readable_volume_dict(pvc)
+                print("=============================================================================================================")
+                continue
 
-    # Our main run loop, now using a signal handler to handle kubernetes signals gracefully (not mid-loop)
-    while not killer.kill_now:
+            # Check if we are already at the max volume size (either globally, or this-volume specific)
+            if action == decisions.AT_MAX_SIZE:
+                print("  SKIPPING scaling this because we are at the maximum size of {}".format(convert_bytes_to_storage(pvc['scale_up_max_size'], binary)))
+                print("=============================================================================================================")
+                continue
 
-        # If it's not our interval time yet, only run once every INTERVAL_TIME seconds.  This extra bit helps us handle signals gracefully quicker
-        if int(time.time()) - last_run <= INTERVAL_TIME:
-            time.sleep(MAIN_LOOP_TIME)
-            continue
-        last_run = int(time.time())
+            # Check if we set on this PV we want to ignore the volume autoscaler
+            if action == decisions.IGNORED:
+                print("  IGNORING scaling this because the ignore annotation was set to true")
+                print("=============================================================================================================")
+                continue
+
+            # Lets debounce this incase we did this resize last interval(s)
+            if action == decisions.DEBOUNCED:
+                print("  DEBOUNCING and skipping this scaling, we resized within recent intervals")
+                print("=============================================================================================================")
+                continue
+
+            # Explain how we sized this resize, by our scale up percent or by how fast the volume is growing
+            sizing = "by `{}%`".format(pvc['scale_up_percent'])
+            sizing_explanation = ""
+            if growth_size:
+                if growth_size > resize_to_bytes:
+                    sizing = "as far as its maximum increment or size allows for its growth"
+                elif growth_size == resize_to_bytes:
+                    sizing = "for its growth"
+                sizing_explanation = ", and growing `{}` per hour it needs `{}` to stay below `{}%` for `{}` cooldowns of `{} seconds`".format(
+                    convert_bytes_to_storage(int(volume_growth * 3600), binary),
+                    convert_bytes_to_storage(growth_size, binary),
+                    pvc['scale_above_percent'],
+                    pvc['scale_up_growth_windows'],
+                    pvc['scale_cooldown_time'],
+                )
+                print("  SIZING this {}{}".format(sizing, sizing_explanation))
+
+            # Check if we are DRY-RUN-ing and won't do anything
+            if DRY_RUN:
+                print("  DRY RUN was set, but we would have resized this disk from {} to {}".format(convert_bytes_to_storage(pvc['volume_size_status_bytes'], binary), convert_bytes_to_storage(resize_to_bytes, binary)))
+                print("=============================================================================================================")
+                continue
+
+            # If we aren't dry-run, lets queue this resize to run in the background
+            if forecast_alerts[index]:
+                reason = "it was forecast to be full in `{} seconds` at the rate it has been filling up".format(volume_seconds_until_full)
+            else:
+                reason = "it was using more than `{}%` disk or inode space over the last `{} seconds`".format(pvc['scale_above_percent'], alert_intervals * INTERVAL_TIME)
+            status_output = "to scale up `{}` {} from `{}` to `{}`, {}{}".format(
+                "{}/{}".format(cluster.name, volume_description) if cluster.name else volume_description,
+                sizing,
+                convert_bytes_to_storage(pvc['volume_size_status_bytes'], binary),
+                convert_bytes_to_storage(resize_to_bytes, binary),
+                reason,
+                sizing_explanation
+            )
+            if resize_executor.submit(volume_namespace, volume_description, resize_volume, volume_description, volume_name, volume_namespace, pvc, resize_to_bytes, status_output, shard):
+                print("  QUEUED resizing disk from {} to {}".format(convert_bytes_to_storage(pvc['volume_size_status_bytes'], binary), convert_bytes_to_storage(resize_to_bytes, binary)))
+            else:
+                print("  SKIPPING scaling this because a resize of it is already queued or in progress")
 
-        # In every loop, fetch all our pvcs state from Kubernetes
-        try:
-            PROMETHEUS_METRICS['resize_evaluated'].inc()
-            pvcs_in_kubernetes = describe_all_pvcs(simple=True)
         except Exception:
-            print("Exception while trying to describe all PVCs")
+            print("Exception caught while trying to act on our decision for {}".format(volume_description))
             traceback.print_exc()
-            time.sleep(MAIN_LOOP_TIME)
-            continue
 
-        # Fetch our volume usage from Prometheus
+        if VERBOSE:
+            print("=============================================================================================================")
+
+    metric('phase_duration', 'evaluate').observe(time.perf_counter() - evaluate_started)
+    metric('pvcs_evaluated').inc(num_evaluated)
+    metric('pvcs_skipped').inc(num_skipped)
+    print("Evaluated {} PVCs, skipped {} unchanged PVCs below their threshold".format(num_evaluated, num_skipped))
+
+    # Save our state once per loop, so a restart resumes where we left off
+    save_state(pvc_state_store, shard)
+
+# Manage the cluster we're working on until we're killed: the one we run in, or one of many with CLUSTERS_CONFIG, in a
+# thread of its own.  When we manage many, a cluster failing (its Prometheus or Kubernetes API being down, or an unexpected
+# exception) is only retried, so it never stops us managing the others
+def run_cluster(killer, many_clusters=False):
+    cluster = get_cluster()
+
+    # When managing many clusters, test if this one's prometheus URL works before continuing, and keep trying every interval until it does
+    while many_clusters:
         try:
-            pvcs_in_prometheus = fetch_pvcs_from_prometheus(url=PROMETHEUS_URL)
-            print("Querying and found {} valid PVCs to assess in prometheus".format(len(pvcs_in_prometheus)))
-            PROMETHEUS_METRICS['num_valid_pvcs'].set(len(pvcs_in_prometheus))
-        except Exception:
-            print("Exception while trying to fetch PVC metrics from prometheus")
-            traceback.print_exc()
+            testIfPrometheusIsAccessible(cluster.prometheus_url)
+            break
+        except SystemExit:
+            print("Retrying to verify that prometheus is accessible in {} seconds".format(INTERVAL_TIME))
+        for _ in range(INTERVAL_TIME):
+            if killer.kill_now:
+                return
             time.sleep(MAIN_LOOP_TIME)
-            continue
 
-        # Iterate through every item and handle it accordingly
-        PROMETHEUS_METRICS['num_pvcs_above_threshold'].set(0)  # Reset these each loop
-        PROMETHEUS_METRICS['num_pvcs_below_threshold'].set(0)  # Reset these each loop
-        for item in pvcs_in_prometheus:
-            try:
-                volume_name = str(item['metric']['persistentvolumeclaim'])
-                volume_namespace = str(item['metric']['namespace'])
-                volume_description = "{}.{}".format(item['metric']['namespace'], item['metric']['persistentvolumeclaim'])
-                volume_used_percent = int(item['value'][1])
-
-                # Precursor check to ensure we have info for this pvc in kubernetes object
-                if volume_description not in pvcs_in_kubernetes:
-                    print("ERROR: The volume {} was not found in Kubernetes but had metrics in Prometheus.  This may be an old volume, was just deleted, or some random jitter is occurring.  If this continues to occur, please report an bug.  You might also be using an older version of Prometheus, please make sure you're using v2.30.0 or newer before reporting a bug for this.".format(volume_description))
-                    continue
+    # Start our gauges at zero, so they exist from the start labelled with our cluster
+    for name in ['num_valid_pvcs', 'num_pvcs_above_threshold', 'num_pvcs_below_threshold', 'num_tracked_pvcs', 'tracked_pvc_memory_bytes', 'num_pvcs_due', 'shard_members', 'shard_owned_pvcs', 'loop_lag']:
+        metric(name).set(0)
+    last_run = 0
 
-                pvcs_in_kubernetes[volume_description]['volume_used_percent'] = volume_used_percent
-                try:
-                    volume_used_inode_percent = int(item['value_inodes'])
-                except:
-                    volume_used_inode_percent = -1
-                pvcs_in_kubernetes[volume_description]['volume_used_inode_percent'] = volume_used_inode_percent
+    # Resume the alert intervals and resize debounces we had before we were restarted
+    pvc_state_store = state_store.create_state_store(cluster=cluster.name, api_client=cluster.api_client)
+    try:
+        cluster.cache.load(pvc_state_store.load())
+        print("Loaded {} alert intervals and resize debounces from the {} state store".format(len(cluster.cache.dump()), pvc_state_store.backend))
+    except Exception:
+        print("Exception while trying to load our state, starting from scratch")
+        traceback.print_exc()
+
+    # Start watching our PVCs in the background, so we don't need to list all of them every interval
+    pvc_informer = None
+    if PVC_WATCH_ENABLED:
+        pvc_informer = PVCInformer()
+        pvc_informer.start()
+
+    # Resizes are queued to run in the background, so a slow one doesn't hold up evaluating the other volumes
+    resize_executor = ResizeExecutor()
+
+    # When scheduling adaptively, we run whenever a PVC is due instead of every INTERVAL_TIME
+    scheduler = PVCScheduler() if ADAPTIVE_SCHEDULING_ENABLED else None
+
+    # When sharding, we split our PVCs with the other replicas of us, starting with none until we've seen them all.  Each
+    # cluster we manage is split separately, in a shard group of its own
+    shard = None
+    if sharding.SHARDING_ENABLED:
+        shard = sharding.ShardMembership(group="{}-{}".format(sharding.SHARD_GROUP, cluster.name) if cluster.name else sharding.SHARD_GROUP, api_client=cluster.api_client)
+        print("Sharding our PVCs as {} in shard group {}, with leases in {}".format(shard.identity, shard.group, shard.namespace))
+        shard.start()
 
-                if VERBOSE:
-                    print("  VERBOSE DETAILS:")
-                    print("-------------------------------------------------------------------------------------------------------------")
-                    print_human_readable_volume_dict(pvcs_in_kubernetes[volume_description])
-                    print("-------------------------------------------------------------------------------------------------------------")
-                    print("Volume {} has {}% disk space used of the {} available".format(volume_description,volume_used_percent,pvcs_in_kubernetes[volume_description]['volume_size_status']))
-                    if volume_used_inode_percent > -1:
-                        print("Volume {} has {}% inodes used".format(volume_description,volume_used_inode_percent))
-
-                # Check if we are NOT in an alert condition
-                if volume_used_percent < pvcs_in_kubernetes[volume_description]['scale_above_percent'] and volume_used_inode_percent < pvcs_in_kubernetes[volume_description]['scale_above_percent']:
-                    PROMETHEUS_METRICS['num_pvcs_below_threshold'].inc()
-                    cache.unset(volume_description)
-                    if VERBOSE:
-                        print("  and is not above {}% used".format(pvcs_in_kubernetes[volume_description]['scale_above_percent']))
-                        if volume_used_inode_percent > -1:
-                            print("  and is not above {}% inodes used".format(pvcs_in_kubernetes[volume_description]['scale_above_percent']))
-                    if VERBOSE:
-                        print("=============================================================================================================")
-                    continue
-                else:
-                    PROMETHEUS_METRICS['num_pvcs_above_threshold'].inc()
-
-                # If we are in alert condition, record this in our simple in-memory counter
-                if cache.get(volume_description):
-                    cache.set(volume_description, cache.get(volume_description) + 1)
-                else:
-                    cache.set(volume_description, 1)
-
-                # Incase we aren't verbose, and didn't print this above, now that we're in alert we will print this
-                if not VERBOSE:
-                    print("Volume {} is {}% in-use of the {} available".format(volume_description,volume_used_percent,pvcs_in_kubernetes[volume_description]['volume_size_status']))
-                    print("Volume {} is {}% inode in-use".format(volume_description,volume_used_inode_percent))
-
-                # Print the alert status and reason
-                if volume_used_percent >= pvcs_in_kubernetes[volume_description]['scale_above_percent']:
-                    print("  BECAUSE it has space used above {}%".format(pvcs_in_kubernetes[volume_description]['scale_above_percent']))
-                elif volume_used_inode_percent >= pvcs_in_kubernetes[volume_description]['scale_above_percent']:
-                    print("  BECAUSE it has inodes used above {}%".format(pvcs_in_kubernetes[volume_description]['scale_above_percent']))
-                print("  ALERT has been for {} period(s) which needs to at least {} period(s) to scale".format(cache.get(volume_description), pvcs_in_kubernetes[volume_description]['scale_after_intervals']))
-
-                # Check if we are NOT in a possible scale condition
-                if cache.get(volume_description) < pvcs_in_kubernetes[volume_description]['scale_after_intervals']:
-                    print("  BUT need to wait for {} intervals in alert before considering to scale".format( pvcs_in_kubernetes[volume_description]['scale_after_intervals'] ))
-                    print("  FYI this has desired_size {} and current size {}".format( convert_bytes_to_storage(pvcs_in_kubernetes[volume_description]['volume_size_spec_bytes']), convert_bytes_to_storage(pvcs_in_kubernetes[volume_description]['volume_size_status_bytes'])))
-                    print("=============================================================================================================")
-                    continue
+    # Our main run loop, now using a signal handler to handle kubernetes signals gracefully (not mid-loop)
+    while not killer.kill_now:
 
-                # If we are in a possible scale condition, check if we recently scaled it and handle accordingly
-                if pvcs_in_kubernetes[volume_description]['last_resized_at'] + pvcs_in_kubernetes[volume_description]['scale_cooldown_time'] >= int(time.mktime(time.gmtime())):
-                    print("  BUT need to wait {} seconds to scale since the last scale time {} seconds ago".format( abs(pvcs_in_kubernetes[volume_description]['last_resized_at'] + pvcs_in_kubernetes[volume_description]['scale_cooldown_time']) - int(time.mktime(time.gmtime())), abs(pvcs_in_kubernetes[volume_description]['last_resized_at'] - int(time.mktime(time.gmtime()))) ))
-                    print("=============================================================================================================")
-                    continue
+        # If it's not our interval time yet, only run once every INTERVAL_TIME seconds.  This extra bit helps us handle signals gracefully quicker
+        if scheduler:
+            # Or when scheduling adaptively, when our next PVC is due but no more than once every ADAPTIVE_MIN_INTERVAL seconds
+            next_due_at = max(scheduler.next_due_at(), last_run + scheduler.min_interval)
+            if time.time() < next_due_at:
+                time.sleep(MAIN_LOOP_TIME)
+                continue
+            if last_run:
+                metric('loop_lag').set(max(0, time.time() - next_due_at))
+        else:
+            if int(time.time()) - last_run <= INTERVAL_TIME:
+                time.sleep(MAIN_LOOP_TIME)
+                continue
+            if last_run:
+                metric('loop_lag').set(max(0, time.time() - (last_run + INTERVAL_TIME)))
+        last_run = int(time.time())
+        loop_started = time.perf_counter()
 
-                # If we reach this far then we will be scaling the disk, all preconditions were passed from above
-                if pvcs_in_kubernetes[volume_description]['last_resized_at'] == 0:
-                    print("  AND we need to scale it immediately, it has never been scaled previously")
-                else:
-                    print("  AND we need to scale it immediately, it last scaled {} seconds ago".format( abs((pvcs_in_kubernetes[volume_description]['last_resized_at'] + pvcs_in_kubernetes[volume_description]['scale_cooldown_time']) - int(time.mktime(time.gmtime()))) ))
-
-                # Calculate how many bytes to resize to based on the parameters provided globally and per-this pv annotations
-                resize_to_bytes = calculateBytesToScaleTo(
-                    original_size     = pvcs_in_kubernetes[volume_description]['volume_size_status_bytes'],
-                    scale_up_percent  = pvcs_in_kubernetes[volume_description]['scale_up_percent'],
-                    min_increment     = pvcs_in_kubernetes[volume_description]['scale_up_min_increment'],
-                    max_increment     = pvcs_in_kubernetes[volume_description]['scale_up_max_increment'],
-                    maximum_size      = pvcs_in_kubernetes[volume_description]['scale_up_max_size'],
-                )
-                # TODO: Check here if storage class has the ALLOWVOLUMEEXPANSION flag set to true, read the SC from pvcs_in_kubernetes[volume_description]['storage_class'] ?
-
-                # If our resize bytes failed for some reason, eg putting invalid data into the annotations on the PV
-                if resize_to_bytes == False:
-                    print("-------------------------------------------------------------------------------------------------------------")
-                    print("  Error/Exception while trying to determine what to resize to, volume causing failure:")
-                    print("-------------------------------------------------------------------------------------------------------------")
-                    print(pvcs_in_kubernetes[volume_description])
-                    print("=============================================================================================================")
-                    continue
+        if many_clusters:
+            try:
+                run_loop(pvc_informer, resize_executor, pvc_state_store, scheduler, shard)
+            except BaseException:
+                print("Exception while trying to run our main loop, retrying next interval")
+                traceback.print_exc()
+        else:
+            run_loop(pvc_informer, resize_executor, pvc_state_store, scheduler, shard)
+        metric('loop_duration').observe(time.perf_counter() - loop_started)
 
-                # If our resize bytes is less than our original size (because the user set the max-bytes to something too low)
-                if resize_to_bytes < pvcs_in_kubernetes[volume_description]['volume_size_status_bytes']:
-                    print("-------------------------------------------------------------------------------------------------------------")
-                    print("  Error/Exception while trying to scale this up.  Is it possible your maximum SCALE_UP_MAX_SIZE is too small?")
-                    print("-------------------------------------------------------------------------------------------------------------")
-                    print("   Maximum Size: {} ({})".format(pvcs_in_kubernetes[volume_description]['scale_up_max_size'], convert_bytes_to_storage(pvcs_in_kubernetes[volume_description]['scale_up_max_size'])))
-                    print("  Original Size: {} ({})".format(pvcs_in_kubernetes[volume_description]['volume_size_status_bytes'], convert_bytes_to_storage(pvcs_in_kubernetes[volume_description]['volume_size_status_bytes'])))
-                    print("      Resize To: {} ({})".format(resize_to_bytes, convert_bytes_to_storage(resize_to_bytes)))
-                    print("-------------------------------------------------------------------------------------------------------------")
-                    print(" Volume causing failure:")
-                    print_human_readable_volume_dict(pvcs_in_kubernetes[volume_description])
-                    print("=============================================================================================================")
-                    continue
+        # Wait until our next interval
+        time.sleep(MAIN_LOOP_TIME)
 
-                # Check if we are already at the max volume size (either globally, or this-volume specific)
-                if resize_to_bytes == pvcs_in_kubernetes[volume_description]['volume_size_status_bytes']:
-                    print("  SKIPPING scaling this because we are at the maximum size of {}".format(convert_bytes_to_storage(pvcs_in_kubernetes[volume_description]['scale_up_max_size'])))
-                    print("=============================================================================================================")
-                    continue
+    if pvc_informer:
+        pvc_informer.stop()
+    # Let any resizes already queued or in progress finish before we exit, then send any Slack messages they queued
+    resize_executor.shutdown()
+    save_state(pvc_state_store, shard)
+    # Only once our resizes are done, hand our PVCs over to the other replicas
+    if shard:
+        shard.stop()
 
-                # Check if we set on this PV we want to ignore the volume autoscaler
-                if pvcs_in_kubernetes[volume_description]['ignore']:
-                    print("  IGNORING scaling this because the ignore annotation was set to true")
-                    print("=============================================================================================================")
-                    continue
 
-                # Lets debounce this incase we did this resize last interval(s)
-                if cache.get(f"{volume_description}-has-been-resized"):
-                    print("  DEBOUNCING and skipping this scaling, we resized within recent intervals")
-                    print("=============================================================================================================")
-                    continue
+# Work on one of many clusters, in a thread of its own
+def run_in_cluster(cluster, killer):
+    current_cluster.set(cluster)
+    run_cluster(killer, many_clusters=True)
 
-                # Check if we are DRY-RUN-ing and won't do anything
-                if DRY_RUN:
-                    print("  DRY RUN was set, but we would have resized this disk from {} to {}".format(convert_bytes_to_storage(pvcs_in_kubernetes[volume_description]['volume_size_status_bytes']), convert_bytes_to_storage(resize_to_bytes)))
-                    print("=============================================================================================================")
-                    continue
 
-                # If we aren't dry-run, lets resize
-                PROMETHEUS_METRICS['resize_attempted'].inc()
-                print("  RESIZING disk from {} to {}".format(convert_bytes_to_storage(pvcs_in_kubernetes[volume_description]['volume_size_status_bytes']), convert_bytes_to_storage(resize_to_bytes)))
-                status_output = "to scale up `{}` by `{}%` from `{}` to `{}`, it was using more than `{}%` disk or inode space over the last `{} seconds`".format(
-                    volume_description,
-                    pvcs_in_kubernetes[volume_description]['scale_up_percent'],
-                    convert_bytes_to_storage(pvcs_in_kubernetes[volume_description]['volume_size_status_bytes']),
-                    convert_bytes_to_storage(resize_to_bytes),
-                    pvcs_in_kubernetes[volume_description]['scale_above_percent'],
-                    cache.get(volume_description) * INTERVAL_TIME
-                )
-                # Send event that we're starting to request a resize
-                send_kubernetes_event(
-                    name=volume_name, namespace=volume_namespace, reason="VolumeResizeRequested",
-                    message="Requesting {}".format(status_output)
-                )
+# Entry point and main application loop
+if __name__ == "__main__":
 
-                if scale_up_pvc(volume_namespace, volume_name, resize_to_bytes):
-                    PROMETHEUS_METRICS['resize_successful'].inc()
-                    # Save this to cache for debouncing
-                    cache.set(f"{volume_description}-has-been-resized", True)
-                    # Print success to console
-                    status_output = "Successfully requested {}".format(status_output)
-                    print(status_output)
-                    # Intentionally skipping sending an event to Kubernetes on success, the above event is enough for now until we detect if resize succeeded
-                    # Print success to Slack
-                    if slack.SLACK_WEBHOOK_URL and len(slack.SLACK_WEBHOOK_URL) > 0:
-                        print(f"Sending slack message to {slack.SLACK_CHANNEL}")
-                        slack.send(status_output)
-                else:
-                    PROMETHEUS_METRICS['resize_failure'].inc()
-                    # Print failure to console
-                    status_output = "FAILED requesting {}".format(status_output)
-                    print(status_output)
-                    # Print failure to Kubernetes Events
-                    send_kubernetes_event(
-                        name=volume_name, namespace=volume_namespace, reason="VolumeResizeRequestFailed",
-                        message=status_output, type="Warning"
-                    )
-                    # Print failure to Slack
-                    if slack.SLACK_WEBHOOK_URL and len(slack.SLACK_WEBHOOK_URL) > 0:
-                        print(f"Sending slack message to {slack.SLACK_CHANNEL}")
-                        slack.send(status_output, severity="error")
+    # Load the clusters we manage when there are many, and label every line we print with the cluster it's about
+    clusters = None
+    if CLUSTERS_CONFIG:
+        clusters = load_clusters()
+        sys.stdout = ClusterPrefixedStream(sys.stdout)
+        sys.stderr = ClusterPrefixedStream(sys.stderr)
+    else:
+        # Test if our prometheus URL works before continuing
+        testIfPrometheusIsAccessible(get_cluster().prometheus_url)
 
-            except Exception:
-                print("Exception caught while trying to process record")
-                print(item)
-                traceback.print_exc()
+    # Startup our prometheus metrics endpoint
+    start_http_server(8000)
 
-            if VERBOSE:
-                print("=============================================================================================================")
+    # TODO: Test k8s access, or just test on-the-fly below?
 
-        # Wait until our next interval
-        time.sleep(MAIN_LOOP_TIME)
+    # Reporting our configuration to the end-user
+    printHeaderAndConfiguration(clusters)
+
+    # Setup our graceful handling of kubernetes signals
+    killer = GracefulKiller()
 
+    # Slack messages are also sent in the background, and bursts of them are combined into one
+    if slack.SLACK_WEBHOOK_URL and len(slack.SLACK_WEBHOOK_URL) > 0 and slack.SLACK_WEBHOOK_URL != "REPLACEME":
+        slack_notifier = slack.SlackNotifier(on_request=lambda seconds: observe_http_request('slack', seconds))
+
+    if clusters:
+        # Every cluster is managed concurrently in a thread of its own, so a slow or failing one doesn't hold up the others
+        threads = []
+        for cluster in clusters:
+            thread = threading.Thread(target=contextvars.copy_context().run, args=(run_in_cluster, cluster, killer), name="cluster-{}".format(cluster.name))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+    else:
+        run_cluster(killer)
+
+    if slack_notifier:
+        slack_notifier.stop()
     print("We were sent a signal handler to kill, exited gracefully")
     exit(0)
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+##########################################################################################
+# Replays the history of our volumes through our scaling decisions (decisions.plan), to see
+# what a set of settings would have done without running them live with DRY_RUN.  History is
+# kubelet_volume_stats_* from Prometheus query_range, fetched in chunks and saved to a dump
+# file, or a dump file (or files) from before.  Chunks are streamed from the dump one at a
+# time, so a long history doesn't need to fit in memory.
+#
+# Each volume's used bytes come from its history, and its size starts at its size in the
+# history but then only grows by the resizes our settings decide on.  For every set of
+# settings we report the resizes issued, the peak usage any volume reached, the time volumes
+# spent above 95% used, and the bytes provisioned above what was used on average.  Sweeping
+# settings runs each combination of them on its own core.
+#   Usage: python3 replay.py --prometheus-url http://prometheus:9090 --days 14 --dump history.jsonl
+#          python3 replay.py --file history.jsonl --sweep scale_above_percent=70,80,90 --sweep scale_up_percent=20,50
+##########################################################################################
+from os import getenv          # Environment variable handling
+import os
+import sys
+import json
+import time
+import tempfile
+import itertools
+import collections
+import multiprocessing
+from optparse import OptionParser
+import numpy
+import requests                # For fetching our history from Prometheus
+import decisions
+
+# The settings we can replay with, and their defaults which are the same as the autoscaler's.  These are the lowercase
+# names of the environment variables of the same setting, eg: scale_above_percent is SCALE_ABOVE_PERCENT
+REPLAY_DEFAULTS = {
+    'interval_time': 60,
+    'scale_above_percent': 80,
+    'scale_after_intervals': 5,
+    'scale_up_percent': 20,
+    'scale_up_min_increment': 1000000000,
+    'scale_up_max_increment': 16000000000000,
+    'scale_up_max_size': 16000000000000,
+    'scale_cooldown_time': 22200,
+    'forecast_enabled': False,
+    'forecast_horizon': 3600,
+    'forecast_lookback': 1800,
+    'scale_up_growth_windows': 0,
+}
+
+# How we tell which of our metrics each series in a dump is, by its metric_type label (from our query) or its name
+METRIC_NAMES = {
+    'kubelet_volume_stats_capacity_bytes': 'capacity',
+    'kubelet_volume_stats_available_bytes': 'available',
+    'kubelet_volume_stats_inodes': 'inodes_total',
+    'kubelet_volume_stats_inodes_free': 'inodes_free',
+}
+
+# How long a volume stays debounced after we resize it, the same as our alerts cache (10 intervals)
+DEBOUNCE_INTERVALS = 10
+FULL_PERCENT = 95
+
+
+# Parse a setting's value into the same type as its default
+def parse_setting(name, value):
+    if name not in REPLAY_DEFAULTS:
+        raise ValueError("Unknown setting {}, we can replay with: {}".format(name, ", ".join(REPLAY_DEFAULTS)))
+    if isinstance(REPLAY_DEFAULTS[name], bool):
+        return str(value).lower() == "true"
+    return int(value)
+
+
+# Every combination of our swept settings, on top of our defaults and the settings we set
+def build_parameter_sets(settings, sweeps):
+    base = dict(REPLAY_DEFAULTS)
+    for setting in settings:
+        name, value = setting.split('=', 1)
+        base[name] = parse_setting(name, value)
+    swept = []
+    for sweep in sweeps:
+        name, values = sweep.split('=', 1)
+        swept.append([(name, parse_setting(name, value)) for value in values.split(',')])
+    return [dict(base, **dict(combination)) for combination in itertools.product(*swept)]
+
+
+# One query for the capacity, available bytes and inode usage of every volume, each tagged with a metric_type label
+def build_history_query(label_match):
+    queries = [
+        ("capacity", "kubelet_volume_stats_capacity_bytes{{ {} }}".format(label_match)),
+        ("available", "kubelet_volume_stats_available_bytes{{ {} }}".format(label_match)),
+        ("inodes", "ceil((1 - kubelet_volume_stats_inodes_free{{ {} }} / kubelet_volume_stats_inodes)*100)".format(label_match)),
+    ]
+    return " or ".join('label_replace({}, "metric_type", "{}", "__name__", ".*")'.format(query, metric_type) for metric_type, query in queries)
+
+
+# Fetch our history from Prometheus one chunk of chunk_seconds at a time, writing each response as a line of dump_path
+def fetch_history(url, label_match, start, end, step, chunk_seconds, dump_path, orgid=''):
+    headers = {'X-Scope-OrgID': orgid} if orgid else {}
+    query = build_history_query(label_match)
+    chunks = 0
+    with open(dump_path, 'w') as dump_file:
+        chunk_start = start
+        while chunk_start < end:
+            # query_range includes both ends, so start the next chunk one step after this one ends
+            chunk_end = min(end, chunk_start + chunk_seconds)
+            response = requests.get(url + '/api/v1/query_range', params={'query': query, 'start': chunk_start, 'end': chunk_end, 'step': step}, headers=headers, timeout=120)
+            response.raise_for_status()
+            response_object = response.json()
+            if response_object['status'] != 'success':
+                raise Exception("Prometheus query_range failed: {}".format(response_object.get('error')))
+            dump_file.write(json.dumps(response_object) + "\n")
+            chunks += 1
+            print("Fetched {} series from {} to {}".format(len(response_object['data']['result']), time.strftime('%Y-%m-%d %H:%M', time.gmtime(chunk_start)), time.strftime('%Y-%m-%d %H:%M', time.gmtime(chunk_end))))
+            chunk_start = chunk_end + step
+    return chunks
+
+
+# Read the query_range responses from our dump files one at a time.  A .jsonl file has one response per line, as we dump
+# them, anything else is one response (eg: saved from the Prometheus API by hand)
+def read_history(paths):
+    for path in paths:
+        with open(path) as history_file:
+            if path.endswith('.jsonl'):
+                for line in history_file:
+                    if line.strip():
+                        yield json.loads(line)
+            else:
+                yield json.load(history_file)
+
+
+# Turn a query_range response into the volumes in it, its timestamps, and a matrix (timestamps x volumes, NaN where we
+# have no sample) of each of the capacity, available bytes and inodes used percent
+def parse_history_chunk(response_object):
+    series = collections.defaultdict(dict)
+    for item in response_object['data']['result']:
+        metric = item['metric']
+        metric_type = metric.get('metric_type') or METRIC_NAMES.get(metric.get('__name__'))
+        if metric_type is None or 'namespace' not in metric or 'persistentvolumeclaim' not in metric:
+            continue
+        series[metric_type][(metric['namespace'], metric['persistentvolumeclaim'])] = item['values']
+
+    volumes = sorted(set(volume for values in series.values() for volume in values))
+    timestamps = sorted(set(float(timestamp) for values in series.values() for samples in values.values() for timestamp, value in samples))
+    columns = {volume: index for index, volume in enumerate(volumes)}
+    rows = {timestamp: index for index, timestamp in enumerate(timestamps)}
+
+    def to_matrix(metric_type):
+        matrix = numpy.full((len(timestamps), len(volumes)), numpy.nan)
+        for volume, samples in series.get(metric_type, {}).items():
+            for timestamp, value in samples:
+                matrix[rows[float(timestamp)], columns[volume]] = float(value)
+        return matrix
+
+    inodes = to_matrix('inodes')
+    if 'inodes' not in series and 'inodes_total' in series:
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            inodes = numpy.ceil((1 - to_matrix('inodes_free') / to_matrix('inodes_total')) * 100)
+    return volumes, numpy.array(timestamps), to_matrix('capacity'), to_matrix('available'), inodes
+
+
+# The replay of one set of settings over our history, fed one chunk at a time
+class Replay:
+    def __init__(self, parameters):
+        self.parameters = parameters
+        self.volumes = {}
+        self.size = numpy.zeros(0)
+        self.last_resized_at = numpy.zeros(0, dtype=numpy.int64)
+        self.alert_intervals = numpy.zeros(0, dtype=numpy.int64)
+        self.resizes_per_volume = numpy.zeros(0, dtype=numpy.int64)
+        # The used bytes of every volume at each of our recent evaluations, for how fast they're growing
+        self.recent_usage = collections.deque()
+        self.last_timestamp = None
+        self.next_evaluation = 0
+        self.resizes = 0
+        self.peak_percent = 0
+        self.seconds_above_full_percent = 0
+        self.overprovisioned_byte_seconds = 0
+        self.seconds = 0
+
+    # The index of each of these volumes in our arrays, growing them for volumes we haven't seen yet
+    def index_volumes(self, volumes):
+        for volume in volumes:
+            if volume not in self.volumes:
+                self.volumes[volume] = len(self.volumes)
+        grow = len(self.volumes) - len(self.size)
+        if grow:
+            self.size = numpy.concatenate([self.size, numpy.zeros(grow)])
+            self.last_resized_at = numpy.concatenate([self.last_resized_at, numpy.zeros(grow, dtype=numpy.int64)])
+            self.alert_intervals = numpy.concatenate([self.alert_intervals, numpy.zeros(grow, dtype=numpy.int64)])
+            self.resizes_per_volume = numpy.concatenate([self.resizes_per_volume, numpy.zeros(grow, dtype=numpy.int64)])
+        return numpy.array([self.volumes[volume] for volume in volumes], dtype=numpy.int64)
+
+    def replay_chunk(self, volumes, timestamps, capacity, available, inodes):
+        indexes = self.index_volumes(volumes)
+        for row, timestamp in enumerate(timestamps):
+            # Volumes we have a sample of now, and know the size of (from this sample, or the first we saw of it)
+            known = self.size[indexes] > 0
+            present = ~numpy.isnan(available[row]) & (known | ~numpy.isnan(capacity[row]))
+            volume_indexes = indexes[present]
+            if not len(volume_indexes):
+                continue
+            first_seen = self.size[volume_indexes] == 0
+            self.size[volume_indexes[first_seen]] = capacity[row][present][first_seen]
+            used_bytes = numpy.maximum(0, numpy.where(numpy.isnan(capacity[row][present]), self.size[volume_indexes], capacity[row][present]) - available[row][present])
+            size = self.size[volume_indexes]
+
+            # How full our volumes are at the sizes we've resized them to, and how much we've provisioned above that
+            used_fraction = used_bytes / size
+            seconds = timestamp - self.last_timestamp if self.last_timestamp is not None else 0
+            self.last_timestamp = timestamp
+            self.peak_percent = max(self.peak_percent, float(used_fraction.max()) * 100)
+            self.seconds_above_full_percent += seconds * int((used_fraction * 100 > FULL_PERCENT).sum())
+            self.overprovisioned_byte_seconds += seconds * float(numpy.maximum(0, size - used_bytes).sum())
+            self.seconds += seconds
+
+            if timestamp >= self.next_evaluation:
+                self.next_evaluation = timestamp + self.parameters['interval_time']
+                inode_percent = numpy.nan_to_num(inodes[row][present], nan=-1)
+                self.evaluate(int(timestamp), volume_indexes, used_bytes, size, inode_percent)
+
+    # What our settings decide for these volumes, and resizing the ones we decided to
+    def evaluate(self, timestamp, volume_indexes, used_bytes, size, inode_percent):
+        parameters = self.parameters
+        count = len(volume_indexes)
+        growth = self.growth(timestamp, volume_indexes, used_bytes)
+        columns = {
+            'volume_size_status_bytes':       size,
+            'scale_above_percent':            numpy.full(count, parameters['scale_above_percent']),
+            'scale_after_intervals':          numpy.full(count, parameters['scale_after_intervals']),
+            'scale_up_percent':               numpy.full(count, parameters['scale_up_percent']),
+            'scale_up_min_increment':         numpy.full(count, parameters['scale_up_min_increment']),
+            'scale_up_max_increment':         numpy.full(count, parameters['scale_up_max_increment']),
+            'scale_up_max_size':              numpy.full(count, parameters['scale_up_max_size']),
+            'scale_cooldown_time':            numpy.full(count, parameters['scale_cooldown_time']),
+            'forecast_horizon':               numpy.full(count, parameters['forecast_horizon']),
+            'scale_up_growth_windows':        numpy.full(count, parameters['scale_up_growth_windows']),
+            'last_resized_at':                self.last_resized_at[volume_indexes],
+            'ignore':                         numpy.zeros(count, dtype=bool),
+            'volume_used_percent':            numpy.ceil(used_bytes / size * 100),
+            'volume_used_inode_percent':      inode_percent,
+            'volume_growth_bytes_per_second': growth,
+            'volume_available_bytes':         numpy.where(growth > 0, size - used_bytes, -1),
+            'alert_intervals':                self.alert_intervals[volume_indexes],
+            'count_interval':                 numpy.ones(count, dtype=bool),
+            'recently_resized':               (self.last_resized_at[volume_indexes] > 0) & (timestamp - self.last_resized_at[volume_indexes] < parameters['interval_time'] * DEBOUNCE_INTERVALS),
+        }
+        plan = decisions.plan(columns, now=timestamp, forecast_enabled=parameters['forecast_enabled'])
+        self.alert_intervals[volume_indexes] = plan['alert_intervals']
+
+        resize = plan['action'] == decisions.RESIZE
+        resized_indexes = volume_indexes[resize]
+        self.size[resized_indexes] = plan['resize_to_bytes'][resize]
+        self.last_resized_at[resized_indexes] = timestamp
+        self.resizes_per_volume[resized_indexes] += 1
+        self.resizes += int(resize.sum())
+
+    # How fast (in bytes per second) each volume has been growing over forecast_lookback, fit by a linear regression like
+    # Prometheus deriv() is.  Only worked out if we forecast or size by growth, otherwise every volume is 0
+    def growth(self, timestamp, volume_indexes, used_bytes):
+        parameters = self.parameters
+        if not parameters['forecast_enabled'] and not parameters['scale_up_growth_windows']:
+            return numpy.zeros(len(volume_indexes))
+        self.recent_usage.append((timestamp, volume_indexes, used_bytes))
+        while self.recent_usage and self.recent_usage[0][0] < timestamp - parameters['forecast_lookback']:
+            self.recent_usage.popleft()
+
+        samples = numpy.full((len(self.recent_usage), len(self.size)), numpy.nan)
+        for row, (sample_timestamp, sample_indexes, sample_used_bytes) in enumerate(self.recent_usage):
+            samples[row, sample_indexes] = sample_used_bytes
+        samples = samples[:, volume_indexes]
+        times = numpy.array([sample_timestamp for sample_timestamp, sample_indexes, sample_used_bytes in self.recent_usage], dtype=float)[:, None]
+
+        sampled = ~numpy.isnan(samples)
+        sample_count = sampled.sum(axis=0)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            mean_time = numpy.where(sampled, times, 0).sum(axis=0) / sample_count
+            mean_used = numpy.nansum(samples, axis=0) / sample_count
+            time_offsets = numpy.where(sampled, times - mean_time, 0)
+            covariance = numpy.nansum(time_offsets * (samples - mean_used), axis=0)
+            variance = (time_offsets ** 2).sum(axis=0)
+            slope = covariance / variance
+        return numpy.where((sample_count >= 2) & (variance > 0), slope, 0)
+
+    def results(self):
+        return {
+            'parameters': self.parameters,
+            'volumes': len(self.volumes),
+            'hours_replayed': round(self.seconds / 3600, 1),
+            'resizes': self.resizes,
+            'most_resizes_of_a_volume': int(self.resizes_per_volume.max()) if len(self.resizes_per_volume) else 0,
+            'peak_used_percent': round(self.peak_percent, 1),
+            'hours_above_{}_percent'.format(FULL_PERCENT): round(self.seconds_above_full_percent / 3600, 1),
+            'average_overprovisioned_bytes': int(self.overprovisioned_byte_seconds / self.seconds) if self.seconds else 0,
+        }
+
+
+# Replay all of our history with one set of settings, this runs in its own process when sweeping
+def replay_history(arguments):
+    paths, parameters = arguments
+    replay = Replay(parameters)
+    for response_object in read_history(paths):
+        replay.replay_chunk(*parse_history_chunk(response_object))
+    return replay.results()
+
+
+# A short human readable number of bytes, in the decimal units our defaults are in
+def format_bytes(bytes):
+    for suffix, size_multiplier in [('T', 1000**4), ('G', 1000**3), ('M', 1000**2)]:
+        if bytes >= size_multiplier:
+            return "{:.1f}{}".format(bytes / size_multiplier, suffix)
+    return str(bytes)
+
+
+def print_results(all_results, swept_names):
+    print("-------------------------------------------------------------------------------------------------------------")
+    for results in all_results:
+        settings = ", ".join("{}={}".format(name, results['parameters'][name]) for name in swept_names) or "defaults"
+        print("{}: {} resizes (at most {} of one volume), peak {}% used, {} volume-hours above {}%, {} over-provisioned on average".format(
+            settings, results['resizes'], results['most_resizes_of_a_volume'], results['peak_used_percent'],
+            results['hours_above_{}_percent'.format(FULL_PERCENT)], FULL_PERCENT, format_bytes(results['average_overprovisioned_bytes'])))
+    print("-------------------------------------------------------------------------------------------------------------")
+    if all_results:
+        print("Replayed {} volumes over {} hours".format(all_results[0]['volumes'], all_results[0]['hours_replayed']))
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog (--prometheus-url URL [--days N] [--dump FILE] | --file FILE ...) [--set name=value ...] [--sweep name=value,value ...]")
+    parser.add_option("--prometheus-url", dest="prometheus_url", default=None, help="Fetch our history from this Prometheus with query_range")
+    parser.add_option("--label-match", dest="label_match", default=getenv('PROMETHEUS_LABEL_MATCH') or '', help="A PromQL label query to restrict which volumes we fetch, without braces")
+    parser.add_option("--orgid", dest="orgid", default=getenv('SCOPE_ORGID_AUTH_HEADER') or '', help="An X-Scope-OrgID header to send to Prometheus, for Mimir or Cortex")
+    parser.add_option("--days", dest="days", type="float", default=7, help="How many days of history to fetch, up until now")
+    parser.add_option("--step", dest="step", type="int", default=60, help="The resolution (in seconds) of the history we fetch, this should be at most our interval_time")
+    parser.add_option("--chunk-hours", dest="chunk_hours", type="float", default=6, help="How many hours of history to fetch (and replay) at a time")
+    parser.add_option("--dump", dest="dump", default=None, help="Save the history we fetch to this file (.jsonl), to replay again later with --file")
+    parser.add_option("--file", dest="files", action="append", default=[], help="Replay the history in this dump file, can be given more than once for consecutive chunks of history")
+    parser.add_option("--set", dest="settings", action="append", default=[], help="Replay with this setting, eg: --set scale_up_percent=50.  Settings are: {}".format(", ".join(REPLAY_DEFAULTS)))
+    parser.add_option("--sweep", dest="sweeps", action="append", default=[], help="Replay with each of these values of a setting, eg: --sweep scale_above_percent=70,80,90.  More than one sweeps every combination of them")
+    parser.add_option("--processes", dest="processes", type="int", default=os.cpu_count(), help="How many sets of settings to replay at once, each on its own core")
+    parser.add_option("--json", action="store_true", dest="json", default=False, help="Print our results as JSON, one line per set of settings")
+    (options, args) = parser.parse_args()
+
+    if not options.prometheus_url and not options.files:
+        parser.error("Either --prometheus-url or --file is required")
+    try:
+        parameter_sets = build_parameter_sets(options.settings, options.sweeps)
+    except ValueError as e:
+        parser.error(str(e))
+
+    paths = options.files
+    temporary_dump = None
+    if options.prometheus_url:
+        dump_path = options.dump
+        if not dump_path:
+            temporary_dump = tempfile.NamedTemporaryFile(suffix='.jsonl', delete=False)
+            temporary_dump.close()
+            dump_path = temporary_dump.name
+        end = int(time.time())
+        chunks = fetch_history(options.prometheus_url.rstrip('/'), options.label_match, end - int(options.days * 86400), end, options.step,
+                               int(options.chunk_hours * 3600), dump_path, options.orgid)
+        print("Saved {} chunks of history to {}".format(chunks, dump_path))
+        paths = [dump_path]
+
+    try:
+        started = time.perf_counter()
+        with multiprocessing.Pool(max(1, min(options.processes, len(parameter_sets)))) as pool:
+            all_results = pool.map(replay_history, [(paths, parameters) for parameters in parameter_sets])
+        print("Replayed {} sets of settings in {:.1f} seconds".format(len(parameter_sets), time.perf_counter() - started), file=sys.stderr)
+    finally:
+        if temporary_dump:
+            os.unlink(temporary_dump.name)
+
+    if options.json:
+        for results in all_results:
+            print(json.dumps(results, sort_keys=True))
+    else:
+        print_results(all_results, [sweep.split('=', 1)[0] for sweep in options.sweeps])
@@ -0,0 +1,202 @@
+##########################################################################################
+# Splits our PVCs between replicas of us, so each replica only queries, evaluates and resizes
+# its own shard of them.  Every replica renews a Lease of its own, and the replicas whose Lease
+# hasn't expired are the members of our shard group.  Each PVC belongs to one member, by
+# consistent hashing of its namespace and name, so a member joining or leaving only moves its
+# own share of the PVCs.
+#
+# No PVC is ever resized by two replicas at once.  A replica stops resizing a PVC as soon as
+# it sees the PVC moved to another member, and stops resizing any PVC as soon as it fails to
+# renew its Lease.  It only starts resizing PVCs moved to it once SHARD_LEASE_DURATION has
+# passed since they moved, by when every other member has either seen the move, or failed
+# to renew and let its Lease expire.  This needs SHARD_RENEW_INTERVAL plus HTTP_TIMEOUT to be
+# shorter than SHARD_LEASE_DURATION.  Needs get, list, create, update and delete on Leases.
+##########################################################################################
+from os import getenv          # Environment variable handling
+import bisect
+import contextvars
+import datetime
+import hashlib                 # For hashing our PVCs and members onto our ring
+import socket
+import threading
+import time
+import traceback
+import kubernetes              # For talking to the Kubernetes API
+from kubernetes.client import ApiException
+from helpers import HTTP_TIMEOUT, get_pvc_of_cache_key
+from state_store import get_own_namespace
+
+SHARDING_ENABLED = True if getenv('SHARDING_ENABLED', "false").lower() == "true" else False   # If we want to split our PVCs between every replica of us with the same SHARD_GROUP
+SHARD_GROUP = getenv('SHARD_GROUP') or "volume-autoscaler"                                     # Our group of replicas sharing PVCs, this prefixes the name of our Leases
+SHARD_LEASE_NAMESPACE = getenv('SHARD_LEASE_NAMESPACE') or ""                                  # The namespace of our Leases, by default the namespace we're running in
+SHARD_LEASE_DURATION = int(getenv('SHARD_LEASE_DURATION') or 30)                               # How long (in seconds) a replica is a member after it last renewed its Lease
+SHARD_RENEW_INTERVAL = int(getenv('SHARD_RENEW_INTERVAL') or 10)                               # How often (in seconds) we renew our Lease and look for other members
+
+# How many points each member has on our ring, more of them split the PVCs more evenly between members
+SHARD_VIRTUAL_NODES = 100
+# Leases of members which expired this long (in seconds) ago are deleted, they crashed or were killed without deleting it
+SHARD_STALE_LEASE_SECONDS = 3600
+SHARD_GROUP_LABEL = "volume.autoscaler.kubernetes.io/shard-group"
+
+
+# Where a key lands on our ring
+def hash_key(key):
+    return int.from_bytes(hashlib.sha1(key.encode('utf-8')).digest()[:8], 'big')
+
+
+# Our members hashed onto a ring, many times each.  A key belongs to the member with the next point on the ring after it
+class HashRing:
+    def __init__(self, members, virtual_nodes=SHARD_VIRTUAL_NODES):
+        self.members = frozenset(members)
+        points = sorted((hash_key("{}#{}".format(member, number)), member) for member in self.members for number in range(virtual_nodes))
+        self.points = [point for point, member in points]
+        self.owners = [member for point, member in points]
+
+    def get_owner(self, key):
+        if not self.points:
+            return None
+        return self.owners[bisect.bisect(self.points, hash_key(key)) % len(self.points)]
+
+
+# Keeps our Lease renewed in the background, and which PVCs are ours from the members we see
+class ShardMembership:
+    # api_client is of the cluster whose PVCs we split, our Leases are kept there.  None is the cluster we run in
+    def __init__(self, identity=None, group=SHARD_GROUP, namespace=SHARD_LEASE_NAMESPACE, lease_duration=SHARD_LEASE_DURATION, renew_interval=SHARD_RENEW_INTERVAL, api_client=None):
+        # In Kubernetes our hostname is our pod name, which is unique between our replicas
+        self.identity = identity or getenv('HOSTNAME') or socket.gethostname()
+        self.group = group
+        self.namespace = namespace or get_own_namespace()
+        self.lease_name = "{}-{}".format(group, self.identity)[:253]
+        self.lease_duration = lease_duration
+        self.renew_interval = renew_interval
+        self.coordination_api = kubernetes.client.CoordinationV1Api(api_client)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        # When we last sent a renewal of our Lease which succeeded (from time.monotonic), None if the last one failed
+        self.renewed_at = None
+        # Every ring which was in effect within our last lease_duration, oldest first, with when it took effect.  We start out
+        # owning nothing, so we don't resize anything another replica could have until it has seen us
+        self.rings = [(time.monotonic(), HashRing([]))]
+
+    def start(self):
+        self.refresh()
+        self.thread = threading.Thread(target=contextvars.copy_context().run, args=(self.run,), name="shard-membership", daemon=True)
+        self.thread.start()
+
+    # Stop renewing our Lease and delete it, so the other members take over our PVCs without waiting for it to expire
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        with self.lock:
+            self.renewed_at = None
+        try:
+            self.coordination_api.delete_namespaced_lease(self.lease_name, self.namespace, _request_timeout=HTTP_TIMEOUT)
+        except Exception:
+            print("Exception while trying to delete our shard lease {}/{}, the other members will take over once it expires".format(self.namespace, self.lease_name))
+            traceback.print_exc()
+
+    def run(self):
+        while not self.stopped.wait(self.renew_interval):
+            self.refresh()
+
+    # Renew our Lease, then see who our members are.  If either fails we own nothing, until lease_duration after we succeed
+    def refresh(self):
+        started = time.monotonic()
+        try:
+            self.renew()
+            members = self.list_members()
+        except Exception:
+            print("Exception while trying to renew our shard lease {}/{}, not resizing any PVCs until we do".format(self.namespace, self.lease_name))
+            traceback.print_exc()
+            with self.lock:
+                self.renewed_at = None
+            self.set_members([])
+            return False
+        members.add(self.identity)
+        with self.lock:
+            self.renewed_at = started
+        self.set_members(members)
+        return True
+
+    def renew(self):
+        body = {
+            'apiVersion': 'coordination.k8s.io/v1',
+            'kind': 'Lease',
+            'metadata': {
+                'name': self.lease_name,
+                'namespace': self.namespace,
+                'labels': {'app.kubernetes.io/managed-by': 'volume-autoscaler', SHARD_GROUP_LABEL: self.group},
+            },
+            'spec': {
+                'holderIdentity': self.identity,
+                'leaseDurationSeconds': self.lease_duration,
+                'renewTime': datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+            },
+        }
+        try:
+            self.coordination_api.replace_namespaced_lease(self.lease_name, self.namespace, body, _request_timeout=HTTP_TIMEOUT)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            self.coordination_api.create_namespaced_lease(self.namespace, body, _request_timeout=HTTP_TIMEOUT)
+
+    # Everyone in our group whose Lease hasn't expired, and delete the Leases which expired long ago
+    def list_members(self):
+        leases = self.coordination_api.list_namespaced_lease(self.namespace, label_selector="{}={}".format(SHARD_GROUP_LABEL, self.group), _request_timeout=HTTP_TIMEOUT)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        members = set()
+        for lease in leases.items:
+            if not lease.spec or not lease.spec.holder_identity or not lease.spec.renew_time:
+                continue
+            expires_at = lease.spec.renew_time + datetime.timedelta(seconds=lease.spec.lease_duration_seconds or self.lease_duration)
+            if expires_at > now:
+                members.add(lease.spec.holder_identity)
+            elif (now - expires_at).total_seconds() > SHARD_STALE_LEASE_SECONDS and lease.metadata.name != self.lease_name:
+                try:
+                    self.coordination_api.delete_namespaced_lease(lease.metadata.name, self.namespace, _request_timeout=HTTP_TIMEOUT)
+                except ApiException as e:
+                    if e.status != 404:
+                        raise
+        return members
+
+    def set_members(self, members):
+        now = time.monotonic()
+        with self.lock:
+            if frozenset(members) != self.rings[-1][1].members:
+                self.rings.append((now, HashRing(members)))
+                print("Our shard group {} now has {} members: {}".format(self.group, len(members), ", ".join(sorted(members)) or "none, we failed to renew our lease"))
+            # Forget the rings which stopped being in effect more than lease_duration ago
+            while len(self.rings) > 1 and self.rings[1][0] <= now - self.lease_duration:
+                self.rings.pop(0)
+
+    def get_members(self):
+        with self.lock:
+            return self.rings[-1][1].members
+
+    # If we may act on a PVC: our Lease is renewed, and it has been ours in every ring within our last lease_duration
+    def owns(self, namespace, name):
+        with self.lock:
+            return self.is_renewed() and self.is_owner("{}/{}".format(namespace, name))
+
+    # If a key of our cache is about a PVC we may act on, those are the keys we store for the replicas sharing our state store
+    def owns_cache_key(self, key):
+        return self.owns(*get_pvc_of_cache_key(key))
+
+    # The PVCs (keyed by volume description) we may act on, of these
+    def get_owned_pvcs(self, pvcs):
+        with self.lock:
+            if not self.is_renewed():
+                return {}
+            return {volume_description: pvc for volume_description, pvc in pvcs.items() if self.is_owner("{}/{}".format(pvc['namespace'], pvc['name']))}
+
+    # Call these with our lock held
+    def is_renewed(self):
+        return self.renewed_at is not None and time.monotonic() - self.renewed_at < self.lease_duration
+
+    def is_owner(self, key):
+        for changed_at, ring in self.rings:
+            if ring.get_owner(key) != self.identity:
+                return False
+        return True
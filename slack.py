@@ -15,6 +15,12 @@ import os
 import select
 # Import for calling the slack URL
 import urllib.request
+import urllib.parse
+import http.client
+# Imports for our background notifier
+import time
+import queue
+import threading
 
 # Our helper to get STDIN if it exists in a non-blocking fashion
 def getBodyFromSTDIN():
@@ -49,6 +55,15 @@ SLACK_MESSAGE_SUFFIX = os.getenv('SLACK_MESSAGE_SUFFIX', "")
 if len(SLACK_MESSAGE_SUFFIX) > 0:
      SLACK_MESSAGE_SUFFIX = SLACK_MESSAGE_SUFFIX.strip()  # Note: We add a spacer before sending to slack
 
+# Background notifier settings, used when included from another script (see SlackNotifier below)
+SLACK_QUEUE_SIZE = int(os.getenv('SLACK_QUEUE_SIZE') or 100)      # How many messages can be waiting to be sent before we start dropping them
+SLACK_BATCH_WINDOW = float(os.getenv('SLACK_BATCH_WINDOW') or 10) # How long (in seconds) to wait for more messages to combine into one digest message
+SLACK_MAX_RETRIES = int(os.getenv('SLACK_MAX_RETRIES') or 5)      # How many times to retry sending a message if Slack is rate-limiting us (429), erroring (5xx) or unreachable
+
+# Slack rejects messages which are too long, so we split digests longer than this many characters.  It allows up to 40000,
+# but recommends no more than 4000
+SLACK_MAX_DIGEST_LENGTH = 3500
+
 # Usage and CLI opts handling
 usage = '  \n\
     %prog "Hi from this slack notifier" \n\
@@ -57,12 +72,8 @@ or \n\
 '
 
 
-def send(body, username="Kubernetes Volume Autoscaler", severity="info", channel=SLACK_CHANNEL, emoji="", iconurl="https://raw.githubusercontent.com/DevOps-Nirvana/Kubernetes-Volume-Autoscaler/master/icon.png", verbose=False):
-
-    # Skip if not set or set invalidly
-    if not SLACK_WEBHOOK_URL or len(SLACK_WEBHOOK_URL) == 0 or SLACK_WEBHOOK_URL == "REPLACEME":
-        print("Slack webhook URL not set, skipping")
-        return False
+# Build the payload we send to Slack
+def build_payload(body, username="Kubernetes Volume Autoscaler", severity="info", channel=SLACK_CHANNEL, emoji="", iconurl="https://raw.githubusercontent.com/DevOps-Nirvana/Kubernetes-Volume-Autoscaler/master/icon.png"):
 
     # lowercase our severity since thats our standard
     severity = str(severity).lower()
@@ -81,10 +92,21 @@ def send(body, username="Kubernetes Volume Autoscaler", severity="info", channel
     elif (len(emoji)):        payload['icon_emoji'] = emoji
     elif (len(iconurl)):      payload['icon_url'] = iconurl
     else:                     payload['icon_emoji'] = getEmojiFromSeverity(severity);
-    # Set verbose
-    if verbose:             print("VERBOSE: Payload: \n" + json.dumps(payload, sort_keys=True, indent=4, separators=(',', ': ')))
     # Prefix body if error
     if severity == 'error': payload['text'] = "<!channel> ERROR: " + payload['text']
+    return payload
+
+
+def send(body, username="Kubernetes Volume Autoscaler", severity="info", channel=SLACK_CHANNEL, emoji="", iconurl="https://raw.githubusercontent.com/DevOps-Nirvana/Kubernetes-Volume-Autoscaler/master/icon.png", verbose=False):
+
+    # Skip if not set or set invalidly
+    if not SLACK_WEBHOOK_URL or len(SLACK_WEBHOOK_URL) == 0 or SLACK_WEBHOOK_URL == "REPLACEME":
+        print("Slack webhook URL not set, skipping")
+        return False
+
+    payload = build_payload(body, username, severity, channel, emoji, iconurl)
+    # Set verbose
+    if verbose:             print("VERBOSE: Payload: \n" + json.dumps(payload, sort_keys=True, indent=4, separators=(',', ': ')))
 
     # Send the request to Slack
     try:
@@ -104,6 +126,126 @@ def send(body, username="Kubernetes Volume Autoscaler", severity="info", channel
         if verbose:         print("Error while sending: {}".format(e))
         return False
 
+
+# Sends Slack messages from a background thread, so a slow or rate-limited webhook never holds up the caller.  Messages
+# arriving within SLACK_BATCH_WINDOW seconds of each other are combined into one digest message, we keep our connection
+# to Slack open between messages, and we honor Retry-After when Slack rate-limits us.  The queue is bounded, if it is
+# full we drop the message instead of blocking.  Call stop() to send everything still queued before exiting.  If given,
+# on_request is called with how many seconds each request to Slack took (eg: to record it in a metric)
+class SlackNotifier:
+    def __init__(self, webhook_url=SLACK_WEBHOOK_URL, queue_size=SLACK_QUEUE_SIZE, batch_window=SLACK_BATCH_WINDOW, max_retries=SLACK_MAX_RETRIES, on_request=None):
+        self.webhook_url = urllib.parse.urlsplit(webhook_url)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_window = batch_window
+        self.max_retries = max_retries
+        self.on_request = on_request
+        self.connection = None
+        self.thread = threading.Thread(target=self.run, name="slack-notifier", daemon=True)
+        self.thread.start()
+
+    # Queue a message to be sent, returns False if our queue is full and it was dropped
+    def notify(self, body, severity="info"):
+        try:
+            self.queue.put_nowait((body, severity))
+            return True
+        except queue.Full:
+            print("Slack notification queue is full, dropping message: {}".format(body))
+            return False
+
+    # Send everything still queued, then stop our thread
+    def stop(self, timeout=60):
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            print("Slack notification queue is still full, some messages may not be sent")
+        self.thread.join(timeout)
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            message = self.queue.get()
+            if message is None:
+                return
+            # Wait a bit for more messages, to combine a burst of them into one
+            batch = [message]
+            deadline = time.time() + self.batch_window
+            while time.time() < deadline:
+                try:
+                    message = self.queue.get(timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if message is None:
+                    stopping = True
+                    break
+                batch.append(message)
+            try:
+                self.send_batch(batch)
+            except Exception as e:
+                print("Error while sending Slack notification: {}".format(e))
+
+    # Combine our batch into a single message with the highest severity of its messages.  If that would be too long for
+    # Slack, it's split into as few messages as fit
+    def send_batch(self, batch):
+        if len(batch) > 1 and len(self.build_digest(batch)) > SLACK_MAX_DIGEST_LENGTH:
+            digests = [[batch[0]]]
+            for message in batch[1:]:
+                if len(self.build_digest(digests[-1] + [message])) > SLACK_MAX_DIGEST_LENGTH:
+                    digests.append([])
+                digests[-1].append(message)
+            return all([self.send_batch(digest) for digest in digests])
+        if len(batch) == 1:
+            body, severity = batch[0]
+        else:
+            severities = [severity for body, severity in batch]
+            severity = 'error' if 'error' in severities else 'warning' if 'warning' in severities else 'info'
+            body = self.build_digest(batch)
+        rawpayload = json.dumps(build_payload(body, severity=severity)).encode('utf-8')
+
+        for attempt in range(self.max_retries + 1):
+            started = time.perf_counter()
+            status, retry_after, result = self.post(rawpayload)
+            if self.on_request:
+                self.on_request(time.perf_counter() - started)
+            if status == 200:
+                return True
+            # Anything else Slack returns (eg: 400 invalid_payload, 403/404 no_service, 410 channel_is_archived) fails again
+            if status is not None and status != 429 and status < 500:
+                print("Slack returned {} while sending notification, not retrying: {}".format(status, result))
+                return False
+            if attempt < self.max_retries:
+                # Slack tells us how long to back off for when rate-limiting us, otherwise backoff exponentially
+                delay = retry_after if status == 429 and retry_after else 2 ** attempt
+                print("Slack returned {} while sending notification, retrying in {} seconds".format(status, delay))
+                time.sleep(delay)
+        print("Giving up sending Slack notification after {} retries: {}".format(self.max_retries, result))
+        return False
+
+    def build_digest(self, batch):
+        return "{} notifications:\n".format(len(batch)) + "\n".join("• " + body for body, severity in batch)
+
+    # Post to our webhook over our kept-alive connection, re-connecting if it was closed since our last message
+    def post(self, rawpayload):
+        path = self.webhook_url.path + ('?' + self.webhook_url.query if self.webhook_url.query else '')
+        for reconnect in [False, True]:
+            try:
+                if self.connection is None or reconnect:
+                    if self.connection:
+                        self.connection.close()
+                    connection_class = http.client.HTTPSConnection if self.webhook_url.scheme == 'https' else http.client.HTTPConnection
+                    self.connection = connection_class(self.webhook_url.netloc, timeout=30)
+                self.connection.request('POST', path, rawpayload, {'Content-Type': 'application/json', 'Connection': 'keep-alive'})
+                response = self.connection.getresponse()
+                result = response.read().decode('utf-8', errors='replace')
+                try:
+                    retry_after = int(response.getheader('Retry-After') or 0)
+                except ValueError:
+                    retry_after = 0
+                return response.status, retry_after, result
+            except (http.client.HTTPException, OSError) as e:
+                if reconnect:
+                    return None, 0, str(e)
+
+
 if __name__ == "__main__":
 
     parser = OptionParser(usage=usage)
@@ -0,0 +1,199 @@
+##########################################################################################
+# Stores our in-memory state (how many intervals each volume has been in alert, and which
+# volumes we recently resized) somewhere which survives a restart, so a rollout, crash or
+# node drain doesn't send every volume back to zero intervals.  The state is written once per
+# loop (and only if it changed), and loaded once at startup.
+#   none      - Don't store state, everything starts from zero after a restart (the default)
+#   sqlite    - A local SQLite file, put STATE_FILE on a persistent volume for this to help
+#   configmap - A ConfigMap in our own namespace, needs get/create/update on configmaps
+# When sharding, every replica shares the same store.  Each only writes the keys of the PVCs
+# in its shard, keeping the other replicas' keys as they are, and the configmap backend only
+# replaces the ConfigMap if nobody else wrote it since we read it (retrying if they did).
+##########################################################################################
+from os import getenv          # Environment variable handling
+import os
+import json
+import sqlite3
+import kubernetes              # For talking to the Kubernetes API
+from kubernetes.client import ApiException
+from helpers import HTTP_TIMEOUT
+
+STATE_BACKEND = str(getenv('STATE_BACKEND') or "none").lower()                             # Where we store our state between restarts: none, sqlite, or configmap
+STATE_FILE = getenv('STATE_FILE') or "/tmp/volume-autoscaler-state.db"                      # The SQLite file we store our state in, for the sqlite backend
+STATE_CONFIGMAP_NAME = getenv('STATE_CONFIGMAP_NAME') or "volume-autoscaler-state"          # The ConfigMap we store our state in, for the configmap backend
+STATE_CONFIGMAP_NAMESPACE = getenv('STATE_CONFIGMAP_NAMESPACE') or ""                       # The namespace of that ConfigMap, by default the namespace we're running in
+
+# ConfigMaps can't be larger than 1MiB, leave a little room for its metadata
+CONFIGMAP_MAX_BYTES = 1000000
+# How many times we try to write our ConfigMap when other replicas keep writing it between our read and write
+CONFIGMAP_WRITE_ATTEMPTS = 5
+SERVICE_ACCOUNT_NAMESPACE_FILE = "/var/run/secrets/kubernetes.io/serviceaccount/namespace"
+
+
+# Keeps nothing, this is what we used to do before we had state stores
+class StateStore:
+    backend = "none"
+
+    def load(self):
+        return {}
+
+    def save(self, state, owns=None):
+        return False
+
+
+# Only writes when our state has actually changed since we last loaded or saved it, to go easy on the disk or API server
+class ChangedStateStore(StateStore):
+    def __init__(self):
+        self.last_saved = None
+
+    def load(self):
+        state = self.read()
+        self.last_saved = json.dumps(state, sort_keys=True)
+        return state
+
+    # When we share our store with other replicas, owns is which keys are ours to write, and the rest are left as they are
+    def save(self, state, owns=None):
+        if owns:
+            state = {key: value for key, value in state.items() if owns(key)}
+        serialized = json.dumps(state, sort_keys=True)
+        if serialized == self.last_saved:
+            return False
+        self.write(state, serialized, owns)
+        self.last_saved = serialized
+        return True
+
+
+# Stores every key as a row in a local SQLite database, replacing all of them (or all of ours) in one transaction per save
+class SQLiteStateStore(ChangedStateStore):
+    backend = "sqlite"
+
+    def __init__(self, path=STATE_FILE):
+        super().__init__()
+        self.path = path
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL, expiration REAL NOT NULL)")
+        finally:
+            connection.close()
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=HTTP_TIMEOUT)
+
+    def read(self):
+        connection = self.connect()
+        try:
+            rows = connection.execute("SELECT key, value, expiration FROM state").fetchall()
+        finally:
+            connection.close()
+        return {key: [json.loads(value), expiration] for key, value, expiration in rows}
+
+    def write(self, state, serialized, owns=None):
+        connection = self.connect()
+        try:
+            with connection:
+                if owns:
+                    # Lock the database before we read which keys are there, so no other replica writes in between
+                    connection.execute("BEGIN IMMEDIATE")
+                    ours = [(key,) for key, in connection.execute("SELECT key FROM state").fetchall() if owns(key)]
+                    connection.executemany("DELETE FROM state WHERE key = ?", ours)
+                else:
+                    connection.execute("DELETE FROM state")
+                connection.executemany("INSERT OR REPLACE INTO state (key, value, expiration) VALUES (?, ?, ?)",
+                                       [(key, json.dumps(value), expiration) for key, (value, expiration) in state.items()])
+        finally:
+            connection.close()
+
+
+# Stores all our state as one JSON document in a ConfigMap, replacing it once per save
+class ConfigMapStateStore(ChangedStateStore):
+    backend = "configmap"
+
+    # api_client is of the cluster whose state this is, the ConfigMap is kept there.  None is the cluster we run in
+    def __init__(self, name=STATE_CONFIGMAP_NAME, namespace=STATE_CONFIGMAP_NAMESPACE, api_client=None):
+        super().__init__()
+        self.configmap_name = name
+        self.namespace = namespace or get_own_namespace()
+        self.kubernetes_core_api = kubernetes.client.CoreV1Api(api_client)
+
+    def read(self):
+        configmap = self.read_configmap()
+        return json.loads(((configmap and configmap.data) or {}).get('state') or '{}')
+
+    # Our ConfigMap, None if it doesn't exist yet
+    def read_configmap(self):
+        try:
+            return self.kubernetes_core_api.read_namespaced_config_map(self.configmap_name, self.namespace, _request_timeout=HTTP_TIMEOUT)
+        except ApiException as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def write(self, state, serialized, owns=None):
+        if not owns:
+            body = self.build_configmap(serialized)
+            if not body:
+                return
+            try:
+                self.kubernetes_core_api.replace_namespaced_config_map(self.configmap_name, self.namespace, body, _request_timeout=HTTP_TIMEOUT)
+            except ApiException as e:
+                if e.status != 404:
+                    raise
+                self.kubernetes_core_api.create_namespaced_config_map(self.namespace, body, _request_timeout=HTTP_TIMEOUT)
+            return
+        # Merge our keys into what the other replicas stored.  Replacing it at the resourceVersion we read (or creating it)
+        # fails with a 409 if another replica wrote (or created) it since, then we read it again and retry
+        for attempt in range(CONFIGMAP_WRITE_ATTEMPTS):
+            configmap = self.read_configmap()
+            stored = json.loads(((configmap and configmap.data) or {}).get('state') or '{}')
+            merged = {key: value for key, value in stored.items() if not owns(key)}
+            merged.update(state)
+            body = self.build_configmap(json.dumps(merged, sort_keys=True), configmap.metadata.resource_version if configmap else None)
+            if not body:
+                return
+            try:
+                if configmap:
+                    self.kubernetes_core_api.replace_namespaced_config_map(self.configmap_name, self.namespace, body, _request_timeout=HTTP_TIMEOUT)
+                else:
+                    self.kubernetes_core_api.create_namespaced_config_map(self.namespace, body, _request_timeout=HTTP_TIMEOUT)
+                return
+            except ApiException as e:
+                if e.status != 409:
+                    raise
+        raise Exception("ConfigMap {}/{} was written by another replica every time we tried to write it, {} times".format(self.namespace, self.configmap_name, CONFIGMAP_WRITE_ATTEMPTS))
+
+    # Our ConfigMap holding this state, None if it's too large for one
+    def build_configmap(self, serialized, resource_version=None):
+        if len(serialized) > CONFIGMAP_MAX_BYTES:
+            print("WARNING: Our state is {} bytes, too large to store in ConfigMap {}/{}, not saving it".format(len(serialized), self.namespace, self.configmap_name))
+            return None
+        return kubernetes.client.V1ConfigMap(
+            metadata=kubernetes.client.V1ObjectMeta(name=self.configmap_name, namespace=self.namespace, resource_version=resource_version, labels={'app.kubernetes.io/managed-by': 'volume-autoscaler'}),
+            data={'state': serialized},
+        )
+
+
+# The namespace we're running in, from our service account
+def get_own_namespace():
+    try:
+        with open(SERVICE_ACCOUNT_NAMESPACE_FILE) as namespace_file:
+            return namespace_file.read().strip()
+    except OSError:
+        return "default"
+
+
+# Create the state store chosen by STATE_BACKEND.  When we manage many clusters, each keeps its state separately, named after
+# it, with the configmap backend in that cluster (api_client is of it)
+def create_state_store(backend=STATE_BACKEND, cluster="", api_client=None):
+    if backend == "sqlite":
+        if cluster:
+            base, extension = os.path.splitext(STATE_FILE)
+            return SQLiteStateStore("{}-{}{}".format(base, cluster, extension))
+        return SQLiteStateStore()
+    if backend == "configmap":
+        if cluster:
+            return ConfigMapStateStore("{}-{}".format(STATE_CONFIGMAP_NAME, cluster), api_client=api_client)
+        return ConfigMapStateStore(api_client=api_client)
+    if backend != "none":
+        print("WARNING: Unknown STATE_BACKEND {}, not storing state between restarts".format(backend))
+    return StateStore()